@@ -0,0 +1,234 @@
+"""
+Аналитика расходов пользователя на NumPy.
+
+История расходов берется из дневных сводок (daily_rollups) одним запросом
+и хранится в кэше столбцами: день (datetime64), индекс категории, сумма.
+Это три плотных массива на пользователя - несколько десятков килобайт даже
+за годы истории. Для расчета столбцы раскладываются в матрицу
+категория × день (np.bincount), и все показатели считаются над матрицей
+целиком, без циклов Python по строкам и объектам ORM:
+
+  - средние расходы в день за 7 и 30 дней (скользящие окна по накопленным
+    суммам);
+  - изменение к прошлому месяцу по категориям: расходы с начала месяца
+    против того же числа дней прошлого месяца;
+  - необычные расходы: дни последних ANALYTICS_ANOMALY_DAYS дней, когда
+    трата в категории больше медианы ее прошлых дневных трат на
+    ANALYTICS_ANOMALY_THRESHOLD робастных отклонений (MAD);
+  - прогноз на конец месяца: траты с начала месяца плюс средняя за 30 дней
+    на оставшиеся дни, против лимита каждого бюджета, приведенного к месяцу.
+
+Кэш пользователя сбрасывается, когда он записывает расходы.
+"""
+import warnings
+from datetime import date
+
+import numpy as np
+from sqlalchemy import select
+
+from cache import TTLCache
+from models import Budget, Category, DailyRollup
+
+MAD_TO_SIGMA = 1.4826  # MAD нормального распределения -> стандартное отклонение
+TOP_ANOMALIES = 5
+
+
+class History:
+    """Дневные расходы пользователя по категориям, столбцами"""
+    __slots__ = ("category_ids", "names", "days", "categories", "totals")
+
+    def __init__(self, category_ids, names, days, categories, totals):
+        self.category_ids = category_ids  # int64, по возрастанию
+        self.names = names  # имена в порядке category_ids
+        self.days = days  # datetime64[D]
+        self.categories = categories  # индекс в category_ids
+        self.totals = totals  # float64
+
+    def matrix(self, first_day, last_day):
+        """Матрица сумм [категория, день] за дни first_day..last_day включительно"""
+        n_days = int((last_day - first_day).astype(int)) + 1
+        offsets = (self.days - first_day).astype(np.int64)
+        inside = (offsets >= 0) & (offsets < n_days)
+        flat = self.categories[inside] * n_days + offsets[inside]
+        cells = np.bincount(flat, weights=self.totals[inside], minlength=len(self.category_ids) * n_days)
+        return cells.reshape(len(self.category_ids), n_days)
+
+
+class CategoryTrend:
+    """Показатели категории за текущий месяц"""
+    __slots__ = ("name", "month_to_date", "previous", "change", "avg30", "projected")
+
+    def __init__(self, name, month_to_date, previous, change, avg30, projected):
+        self.name = name
+        self.month_to_date = month_to_date
+        self.previous = previous  # за то же число дней прошлого месяца
+        self.change = change  # доля, None - в прошлом месяце трат не было
+        self.avg30 = avg30
+        self.projected = projected
+
+
+class Analysis:
+    def __init__(self):
+        self.avg7 = 0.0
+        self.avg30 = 0.0
+        self.month_to_date = 0.0
+        self.projected = 0.0
+        self.categories = []  # CategoryTrend по убыванию прогноза
+        self.anomalies = []  # (день, категория, сумма, обычная дневная трата)
+        self.budgets = []  # (категория, период, лимит, лимит на месяц, прогноз)
+        self.unknown_budgets = []  # (категория, период) с периодом, который не привести к месяцу
+
+
+# Периоды бюджетов, записанные старыми версиями бота
+LEGACY_PERIODS = {"day": "день", "week": "неделя", "month": "месяц", "year": "год"}
+
+
+def monthly_factors(month_days: int) -> dict:
+    """Во сколько раз месячный лимит больше лимита бюджета данного периода"""
+    return {"день": month_days, "неделя": month_days / 7, "месяц": 1.0, "год": 1 / 12}
+
+
+def rolling_mean(series, window: int):
+    """Скользящее среднее: элемент i - среднее series[i:i + window]"""
+    cumulative = np.concatenate(([0.0], np.cumsum(series)))
+    return (cumulative[window:] - cumulative[:-window]) / window
+
+
+def analyze(history: History, budgets, today: date, anomaly_days: int, anomaly_threshold: float,
+            min_history: int) -> Analysis:
+    """
+    Считает показатели по истории. budgets - строки (category_id, amount, period, имя категории).
+    Все вычисления по категориям и дням векторные; циклы Python только
+    собирают ответ из уже найденных строк.
+    """
+    result = Analysis()
+    today = np.datetime64(today, "D")
+    month_start = today.astype("datetime64[M]").astype("datetime64[D]")
+    previous_start = (today.astype("datetime64[M]") - 1).astype("datetime64[D]")
+    month_days = int(((month_start.astype("datetime64[M]") + 1).astype("datetime64[D]") - month_start).astype(int))
+    day_of_month = int((today - month_start).astype(int)) + 1
+
+    # Матрица хотя бы за прошлый месяц и 30 дней, даже если история короче
+    first_day = min(history.days.min(), previous_start, today - 29)
+    spent = history.matrix(first_day, today)
+    daily = spent.sum(axis=0)
+    result.avg7 = float(rolling_mean(daily, 7)[-1])
+    result.avg30 = float(rolling_mean(daily, 30)[-1])
+    avg30 = spent[:, -30:].sum(axis=1) / 30
+
+    # С начала месяца и за тот же отрезок прошлого месяца
+    month_column = int((month_start - first_day).astype(int))
+    previous_column = int((previous_start - first_day).astype(int))
+    month_to_date = spent[:, month_column:].sum(axis=1)
+    previous = spent[:, previous_column:min(previous_column + day_of_month, month_column)].sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        change = np.where(previous > 0, month_to_date / previous - 1, np.nan)
+    projected = month_to_date + avg30 * (month_days - day_of_month)
+    result.month_to_date = float(month_to_date.sum())
+    result.projected = float(projected.sum())
+
+    active = np.flatnonzero((month_to_date > 0) | (previous > 0) | (avg30 > 0))
+    for i in active[np.argsort(-projected[active], kind="stable")]:
+        result.categories.append(CategoryTrend(
+            history.names[i], float(month_to_date[i]), float(previous[i]),
+            None if np.isnan(change[i]) else float(change[i]), float(avg30[i]), float(projected[i])
+        ))
+
+    # Необычные траты: сравнение с днями до окна, когда в категории что-то тратилось
+    recent = spent[:, -anomaly_days:]
+    baseline = np.where(spent[:, :-anomaly_days] > 0, spent[:, :-anomaly_days], np.nan)
+    enough = (~np.isnan(baseline)).sum(axis=1) >= min_history
+    if enough.any():
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # категории без истории: медиана NaN
+            median = np.nanmedian(baseline, axis=1)
+            mad = np.nanmedian(np.abs(baseline - median[:, None]), axis=1)
+        # Постоянные платежи одной суммы дают MAD = 0: тогда мерой разброса служит 10% медианы
+        scale = np.maximum(MAD_TO_SIGMA * mad, 0.1 * median)
+        with np.errstate(invalid="ignore"):
+            score = (recent - median[:, None]) / scale[:, None]
+            flags = (recent > 0) & enough[:, None] & (score > anomaly_threshold)
+        rows, cols = np.nonzero(flags)
+        order = np.argsort(-score[rows, cols], kind="stable")[:TOP_ANOMALIES]
+        window_start = today - (recent.shape[1] - 1)
+        for i, j in zip(rows[order], cols[order]):
+            result.anomalies.append((
+                (window_start + j).astype(date), history.names[i], float(recent[i, j]), float(median[i])
+            ))
+
+    # Бюджеты: лимит, приведенный к месяцу, против прогноза категории
+    factors = monthly_factors(month_days)
+    budgets = [(category_id, amount, LEGACY_PERIODS.get(period, period), name)
+               for category_id, amount, period, name in budgets]
+    result.unknown_budgets = [(row[3], row[2]) for row in budgets if row[2] not in factors]
+    budgets = [row for row in budgets if row[2] in factors]
+    if budgets:
+        budget_categories = np.array([row[0] for row in budgets], dtype=np.int64)
+        limits = np.array([row[1] for row in budgets], dtype=np.float64)
+        factors = np.array([factors[row[2]] for row in budgets])
+        positions = np.searchsorted(history.category_ids, budget_categories)
+        positions = np.minimum(positions, len(history.category_ids) - 1)
+        known = history.category_ids[positions] == budget_categories
+        budget_projected = np.where(known, projected[positions], 0.0)
+        for (category_id, amount, period, name), monthly, forecast in zip(budgets, limits * factors, budget_projected):
+            result.budgets.append((name, period, amount, float(monthly), float(forecast)))
+    return result
+
+
+class SpendingAnalytics:
+    """Аналитика расходов с кэшем истории по пользователю"""
+
+    def __init__(self, read_session_factory, cache_size: int, ttl: float, anomaly_days: int,
+                 anomaly_threshold: float, min_history: int):
+        self.read_session_factory = read_session_factory
+        self.cache = TTLCache("analytics", cache_size, ttl)
+        self.anomaly_days = anomaly_days
+        self.anomaly_threshold = anomaly_threshold
+        self.min_history = min_history
+
+    async def analyze(self, user_id: int, today: date = None):
+        """Analysis по расходам пользователя или None, если расходов еще нет"""
+        async with self.read_session_factory() as session:
+            history = self.cache.get(user_id)
+            if history is None:
+                history = await self._load(session, user_id)
+                self.cache.set(user_id, history)
+            # Бюджеты меняются независимо от расходов и читаются каждый раз (их единицы)
+            budgets = (await session.execute(
+                select(Budget.category_id, Budget.amount, Budget.period, Category.name)
+                .outerjoin(Category, Category.id == Budget.category_id)
+                .filter(Budget.user_id == user_id)
+                .order_by(Budget.id)
+            )).all()
+        if not len(history.days):
+            return None
+        return analyze(
+            history, budgets, today or date.today(),
+            self.anomaly_days, self.anomaly_threshold, self.min_history
+        )
+
+    async def _load(self, session, user_id: int) -> History:
+        rows = (await session.execute(
+            select(DailyRollup.day, DailyRollup.category_id, DailyRollup.total).filter(
+                DailyRollup.user_id == user_id,
+                DailyRollup.is_income == False,  # noqa: E712
+            )
+        )).all()
+        names = dict((await session.execute(
+            select(Category.id, Category.name).filter(Category.user_id == user_id)
+        )).all())
+        if not rows:
+            return History(np.array([], dtype=np.int64), [], np.array([], dtype="datetime64[D]"),
+                           np.array([], dtype=np.int64), np.array([], dtype=np.float64))
+        days, category_ids, totals = zip(*rows)
+        category_ids, categories = np.unique(np.array(category_ids, dtype=np.int64), return_inverse=True)
+        return History(
+            category_ids,
+            [names.get(int(category_id), "Без категории") for category_id in category_ids],
+            np.array(days, dtype="datetime64[D]"),
+            categories.astype(np.int64),
+            np.array(totals, dtype=np.float64),
+        )
+
+    def invalidate(self, user_id: int):
+        self.cache.pop(user_id)
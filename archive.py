@@ -0,0 +1,267 @@
+"""
+Архив закрытых лет: транзакции года - в отдельном файле SQLite.
+
+Почти все запросы бота касаются последних месяцев, а таблица transactions
+и ее индексы растут вместе со всей историей. Команда
+
+    python manage.py archive
+
+переносит каждый закрытый год (целиком старше ARCHIVE_HOT_MONTHS месяцев)
+в файл ARCHIVE_DIR/transactions_<год>.db. Дневные сводки года заменяются
+годовыми (yearly_rollups), поэтому отчет «За все время» и статистика
+категорий складывают дневные сводки основной базы с годовыми и архивные
+строки не читают. Выгрузка CSV подключает файлы архива (ATTACH) на время
+чтения и отдает полную историю.
+
+Транзакции переносятся пачками по месяцу: бот продолжает писать, пока идет
+перенос. Основная база и файл архива фиксируются по отдельности, поэтому
+месяц сначала копируется в файл с номером поколения (gen) и только
+следующей транзакцией удаляется из основной базы - в той же транзакции
+archived_years.gen получает номер этого поколения. Выгрузка читает
+основную базу и все файлы архива в одной транзакции (см. exporter.py) и
+берет из файла только поколения не новее archived_years.gen своего
+снимка, так что в любой момент видит каждую строку ровно один раз. Id
+транзакций не повторяются (AUTOINCREMENT), поэтому строка архива
+возвращается в основную базу с прежним id. Годовые сводки считаются по
+файлу архива целиком в последнем шаге, и повторный запуск после сбоя (или
+после импорта старой выписки в уже архивный год) просто доносит строки.
+
+    python manage.py rehydrate 2021
+
+возвращает год в основную базу (например, чтобы листать историю категории
+за тот год): поколения копируются с конца, дневные сводки пересчитываются,
+а файл архива удаляется, только когда все его строки уже в основной базе.
+"""
+import contextlib
+import logging
+import os
+from datetime import date, datetime
+
+from sqlalchemy import Boolean, Column, DateTime, Float, Integer, MetaData, Table, text
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = "archive"  # Имя подключенного файла архива в запросах
+
+# Таблица транзакций в подключенном файле архива
+archived_transactions = Table(
+    "transactions", MetaData(),
+    Column("id", Integer, primary_key=True),
+    Column("user_id", Integer),
+    Column("amount", Float),
+    Column("category_id", Integer),
+    Column("is_income", Boolean),
+    Column("created_at", DateTime),
+    Column("gen", Integer),
+    schema=SCHEMA,
+)
+
+ARCHIVE_SCHEMA_SQL = [
+    f"""CREATE TABLE IF NOT EXISTS {SCHEMA}.transactions (
+        id INTEGER NOT NULL,
+        user_id INTEGER,
+        amount FLOAT,
+        category_id INTEGER,
+        is_income BOOLEAN,
+        created_at DATETIME,
+        gen INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (id)
+    )""",
+    # Выгрузка читает архив по пользователю в порядке даты
+    f"CREATE INDEX IF NOT EXISTS {SCHEMA}.ix_transactions_user_created ON transactions (user_id, created_at)",
+]
+_COLUMNS = "id, user_id, amount, category_id, is_income, created_at"
+
+# Годовые сводки архивного года по всем его строкам в файле архива
+YEARLY_FROM_ARCHIVE_SQL = f"""
+    INSERT INTO yearly_rollups (user_id, is_income, year, category_id, total, tx_count)
+    SELECT user_id, COALESCE(is_income, 0), :year, category_id, COALESCE(SUM(amount), 0), COUNT(*)
+    FROM {SCHEMA}.transactions
+    WHERE user_id IS NOT NULL AND category_id IS NOT NULL AND created_at IS NOT NULL
+    GROUP BY user_id, COALESCE(is_income, 0), category_id
+"""
+
+# Дневные сводки возвращенного года (как ROLLUP_BACKFILL_SQL, но за диапазон дат)
+DAILY_FOR_RANGE_SQL = """
+    INSERT INTO daily_rollups (user_id, is_income, day, category_id, total, tx_count)
+    SELECT user_id, COALESCE(is_income, 0), date(created_at), category_id,
+           COALESCE(SUM(amount), 0), COUNT(*)
+    FROM transactions
+    WHERE user_id IS NOT NULL AND category_id IS NOT NULL
+      AND created_at >= :start AND created_at < :end
+    GROUP BY user_id, COALESCE(is_income, 0), date(created_at), category_id
+"""
+
+
+def archive_path(directory: str, year: int) -> str:
+    return os.path.join(directory, f"transactions_{year}.db")
+
+
+def hot_cutoff(today: date, hot_months: int) -> date:
+    """Начало горячего периода: первое число месяца hot_months месяцев назад"""
+    months = today.year * 12 + today.month - 1 - hot_months
+    return date(months // 12, months % 12 + 1, 1)
+
+
+def is_closed(year: int, cutoff: date) -> bool:
+    return date(year + 1, 1, 1) <= cutoff
+
+
+def _months(year: int):
+    """Границы месяцев года строками, как их хранит SQLite: [(начало, конец), ...]"""
+    edges = [date(year, month, 1) for month in range(1, 13)] + [date(year + 1, 1, 1)]
+    return [(start.isoformat(), end.isoformat()) for start, end in zip(edges, edges[1:])]
+
+
+@contextlib.contextmanager
+def _attached(engine, path: str):
+    """sqlite3-соединение с подключенным файлом архива; транзакциями управляет вызывающий"""
+    raw = engine.raw_connection()
+    try:
+        conn = raw.driver_connection
+        isolation_level = conn.isolation_level
+        conn.isolation_level = None
+        conn.execute(f"ATTACH DATABASE ? AS {SCHEMA}", (path,))
+        try:
+            yield conn
+        finally:
+            conn.execute(f"DETACH DATABASE {SCHEMA}")
+            conn.isolation_level = isolation_level
+    finally:
+        raw.close()
+
+
+def _transaction(conn, *statements) -> list:
+    """Выполняет (sql, параметры) в одной транзакции, возвращает rowcount каждого"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        counts = [conn.execute(sql, params).rowcount for sql, params in statements]
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return counts
+
+
+def closed_years(engine, cutoff: date) -> list:
+    """Годы с транзакциями в основной базе, которые можно архивировать"""
+    with engine.connect() as conn:
+        years = conn.execute(text(
+            "SELECT DISTINCT CAST(strftime('%Y', day) AS INTEGER) FROM daily_rollups WHERE day < :cutoff"
+        ), {"cutoff": cutoff.isoformat()}).scalars().all()
+    return sorted(year for year in years if is_closed(year, cutoff))
+
+
+def _move_generation(conn, year: int, gen: int, start: str, end: str, *statements) -> int:
+    """
+    Переносит в архив строки года за [start, end) поколением gen: копия
+    в файл, затем удаление из основной базы вместе с номером поколения в
+    archived_years (и statements). Возвращает число перенесенных строк.
+    """
+    copied, = _transaction(conn, (
+        f"INSERT INTO {SCHEMA}.transactions ({_COLUMNS}, gen) "
+        f"SELECT {_COLUMNS}, ? FROM main.transactions WHERE created_at >= ? AND created_at < ?", (gen, start, end)
+    ))
+    if copied or statements:
+        _transaction(
+            conn,
+            (f"DELETE FROM main.transactions WHERE id IN (SELECT id FROM {SCHEMA}.transactions WHERE gen = ?)",
+             (gen,)),
+            ("UPDATE archived_years SET gen = ? WHERE year = ?", (gen, year)),
+            *statements,
+        )
+    return copied
+
+
+def archive_year(engine, year: int, directory: str) -> int:
+    """Переносит транзакции года в файл архива, возвращает число перенесенных строк"""
+    os.makedirs(directory, exist_ok=True)
+    path = archive_path(directory, year)
+    moved = 0
+    with _attached(engine, path) as conn:
+        for sql in ARCHIVE_SCHEMA_SQL:
+            conn.execute(sql)
+        # Сначала реестр: выгрузка подключает файл, пока строки еще переезжают
+        _transaction(conn, (
+            "INSERT INTO archived_years (year, path, tx_count, archived_at) VALUES (?, ?, 0, ?) "
+            "ON CONFLICT (year) DO UPDATE SET path = excluded.path",
+            (year, path, datetime.now()),
+        ))
+        gen = conn.execute("SELECT gen FROM archived_years WHERE year = ?", (year,)).fetchone()[0]
+        # Поколение, скопированное прерванным запуском, еще целиком в основной базе
+        _transaction(conn, (f"DELETE FROM {SCHEMA}.transactions WHERE gen > ?", (gen,)))
+        for start, end in _months(year):
+            copied = _move_generation(conn, year, gen + 1, start, end)
+            if copied:
+                gen += 1
+            moved += copied
+        # Строки, записанные в этот год за время переноса, уходят вместе с заменой сводок
+        start, end = _months(year)[0][0], _months(year)[-1][1]
+        moved += _move_generation(
+            conn, year, gen + 1, start, end,
+            ("DELETE FROM daily_rollups WHERE day >= ? AND day < ?", (start, end)),
+            ("DELETE FROM yearly_rollups WHERE year = ?", (year,)),
+            (YEARLY_FROM_ARCHIVE_SQL, {"year": year}),
+            (f"UPDATE archived_years SET tx_count = (SELECT COUNT(*) FROM {SCHEMA}.transactions), "
+             "archived_at = ? WHERE year = ?", (datetime.now(), year)),
+        )
+    logger.info(f"Год {year} в архиве {path}: перенесено {moved} транзакций")
+    return moved
+
+
+def rehydrate_year(engine, year: int):
+    """Возвращает транзакции архивного года в основную базу; None - года нет в архиве"""
+    with engine.connect() as conn:
+        row = conn.execute(
+            text("SELECT path, gen FROM archived_years WHERE year = :year"), {"year": year}
+        ).first()
+    if row is None:
+        return None
+    path, gen = row
+    if not os.path.exists(path):
+        # Без файла годовые сводки - единственное, что осталось от года: не трогаем
+        raise FileNotFoundError(f"Нет файла архива {path} за {year} год")
+    restored = 0
+    with _attached(engine, path) as conn:
+        # Файл архива не меняется: поколения возвращаются с конца, и вместе с копией
+        # в основную базу archived_years перестает отдавать их выгрузке из файла.
+        # Прежние id свободны (AUTOINCREMENT): конфликт - ошибка, а не пропуск строки
+        generations = [g for g, in conn.execute(
+            f"SELECT DISTINCT gen FROM {SCHEMA}.transactions WHERE gen <= ? ORDER BY gen DESC", (gen,)
+        )]
+        for g in generations:
+            copied, _ = _transaction(
+                conn,
+                (f"INSERT INTO main.transactions ({_COLUMNS}) "
+                 f"SELECT {_COLUMNS} FROM {SCHEMA}.transactions WHERE gen = ?", (g,)),
+                ("UPDATE archived_years SET gen = ? WHERE year = ?", (g - 1, year)),
+            )
+            restored += copied
+        missing = conn.execute(
+            f"SELECT COUNT(*) FROM {SCHEMA}.transactions AS archived "
+            "WHERE NOT EXISTS (SELECT 1 FROM main.transactions WHERE id = archived.id)"
+        ).fetchone()[0]
+        if missing:
+            raise RuntimeError(f"Год {year}: {missing} строк архива {path} нет в основной базе, файл сохранен")
+        start, end = _months(year)[0][0], _months(year)[-1][1]
+        _transaction(
+            conn,
+            ("DELETE FROM daily_rollups WHERE day >= ? AND day < ?", (start, end)),
+            (DAILY_FOR_RANGE_SQL, {"start": start, "end": end}),
+            ("DELETE FROM yearly_rollups WHERE year = ?", (year,)),
+            ("DELETE FROM archived_years WHERE year = ?", (year,)),
+        )
+    os.remove(path)
+    logger.info(f"Год {year} возвращен из архива: {restored} транзакций")
+    return restored
+
+
+@contextlib.asynccontextmanager
+async def attached(session, path: str, name: str = SCHEMA):
+    """Подключает файл архива к соединению асинхронной сессии на время блока.
+    name - другое имя, чтобы подключить несколько файлов (запросы - через schema_translate_map)."""
+    await session.execute(text(f"ATTACH DATABASE :path AS {name}"), {"path": path})
+    try:
+        yield
+    finally:
+        await session.execute(text(f"DETACH DATABASE {name}"))
@@ -0,0 +1,136 @@
+"""
+Сравнение синхронного и асинхронного слоя БД под конкурентной нагрузкой.
+
+Поток обновлений смешанный, как у живого бота: часть обновлений ходит в БД
+(агрегирующий запрос по транзакциям пользователя и вставка с commit),
+остальные только отвечают в Telegram (нажатия меню, «Помощь»). Ответ
+в Telegram имитируется задержкой сети. Синхронный вариант вызывает
+SessionLocal прямо внутри корутины, как это делали обработчики раньше,
+асинхронный использует AsyncSessionLocal.
+
+Запуск:
+    python benchmarks/bench_async_db.py --users 200 --updates 10 --seed 50000
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# База создается во временном каталоге, finance.db не трогаем
+_tmpdir = tempfile.mkdtemp(prefix="numbot-bench-")
+os.environ["DB_URL"] = f"sqlite:///{os.path.join(_tmpdir, 'bench.db')}"
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func, select  # noqa: E402
+
+from models import (  # noqa: E402
+    AsyncSessionLocal, SessionLocal, Transaction, async_engine, engine, init_db,
+)
+
+API_LATENCY = 0.02  # Имитация round trip до Bot API
+
+
+def seed(rows: int, users: int):
+    """Заполняет базу случайными транзакциями"""
+    init_db()
+    now = datetime.now()
+    with SessionLocal() as session:
+        session.bulk_insert_mappings(Transaction, [
+            {
+                "user_id": random.randint(1, users),
+                "amount": round(random.uniform(10, 5000), 2),
+                "category_id": random.randint(1, 20),
+                "is_income": random.random() < 0.2,
+                "created_at": now - timedelta(minutes=random.randint(0, 60 * 24 * 365)),
+            }
+            for _ in range(rows)
+        ])
+        session.commit()
+
+
+def _report_query(user_id: int):
+    return select(func.sum(Transaction.amount)).filter(
+        Transaction.user_id == user_id,
+        Transaction.is_income == False,
+        Transaction.created_at >= datetime.now() - timedelta(days=30)
+    )
+
+
+async def light_update(user_id: int):
+    await asyncio.sleep(API_LATENCY)
+
+
+async def sync_update(user_id: int):
+    with SessionLocal() as session:
+        session.scalar(_report_query(user_id))
+        session.add(Transaction(user_id=user_id, amount=1.0, category_id=1, is_income=False))
+        session.commit()
+    await asyncio.sleep(API_LATENCY)
+
+
+async def async_update(user_id: int):
+    async with AsyncSessionLocal() as session:
+        await session.scalar(_report_query(user_id))
+        session.add(Transaction(user_id=user_id, amount=1.0, category_id=1, is_income=False))
+        await session.commit()
+    await asyncio.sleep(API_LATENCY)
+
+
+async def run(handler, users: int, updates: int, db_ratio: float):
+    latencies = {"db": [], "light": []}
+    rnd = random.Random(0)  # Одинаковый сценарий для обоих вариантов
+
+    async def user_loop(user_id: int):
+        for _ in range(updates):
+            kind = "db" if rnd.random() < db_ratio else "light"
+            started = time.perf_counter()
+            await (handler if kind == "db" else light_update)(user_id)
+            latencies[kind].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user_loop(uid) for uid in range(1, users + 1)))
+    elapsed = time.perf_counter() - started
+    return elapsed, latencies
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def print_result(name, elapsed, latencies):
+    total = sorted(latencies["db"] + latencies["light"])
+    print(f"{name}: {len(total) / elapsed:.1f} upd/s")
+    for kind, values in (("all", total), ("db", sorted(latencies["db"])), ("light", sorted(latencies["light"]))):
+        print(
+            f"  {kind:<6} p50={percentile(values, 50) * 1000:7.1f}ms  "
+            f"p95={percentile(values, 95) * 1000:7.1f}ms  "
+            f"p99={percentile(values, 99) * 1000:7.1f}ms  "
+            f"mean={statistics.mean(values) * 1000:7.1f}ms"
+        )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200, help="Число одновременных пользователей")
+    parser.add_argument("--updates", type=int, default=10, help="Обновлений на пользователя")
+    parser.add_argument("--seed", type=int, default=50000, help="Транзакций в базе перед замером")
+    parser.add_argument("--db-ratio", type=float, default=0.3, help="Доля обновлений, которые ходят в БД")
+    args = parser.parse_args()
+
+    seed(args.seed, args.users)
+    print(f"users={args.users} updates/user={args.updates} seeded={args.seed} db_ratio={args.db_ratio}")
+    print_result("sync", *await run(sync_update, args.users, args.updates, args.db_ratio))
+    print_result("async", *await run(async_update, args.users, args.updates, args.db_ratio))
+
+    await async_engine.dispose()
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,177 @@
+"""
+Локальный поддельный Bot API с flood control, как у Telegram.
+
+Сервер принимает запросы вида /bot<token>/<method>, отвечает правдоподобными
+объектами (Message для отправок, True для остального, пустой getUpdates)
+и возвращает 429 с retry_after, если в чат уходит больше --chat-limit
+сообщений в секунду или боту в целом больше --global-limit.
+
+Без --serve скрипт сам поднимает сервер и отправляет через него пачку
+сообщений, как при рассылке или всплеске уведомлений: сначала через очередь
+outbound.OutboundQueue, затем (с --compare) напрямую, и печатает, сколько
+сообщений дошло, сколько было 429 и сколько текстов склеено.
+
+    python benchmarks/fake_bot_api.py --chats 20 --messages 10 --compare
+
+С --serve сервер работает, пока его не остановят, и к нему можно подключить
+сам бот:
+
+    python benchmarks/fake_bot_api.py --serve --port 8081
+    BOT_API_URL=http://127.0.0.1:8081 python bot.py
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import sys
+import time
+from collections import defaultdict, deque
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SEND_METHODS = {"sendmessage", "sendphoto", "senddocument", "editmessagetext", "editmessagereplymarkup"}
+
+
+class FakeBotAPI:
+    def __init__(self, chat_limit: int, global_limit: int, retry_after: int = 1):
+        self.chat_limit = chat_limit
+        self.global_limit = global_limit
+        self.retry_after = retry_after
+        self.requests = 0
+        self.flood_errors = 0
+        self.delivered = defaultdict(list)  # chat_id -> тексты
+        self._chat_times = defaultdict(deque)
+        self._global_times = deque()
+        self._ids = itertools.count(1)
+
+    @staticmethod
+    def _over_limit(times: deque, limit: int, now: float) -> bool:
+        while times and now - times[0] >= 1:
+            times.popleft()
+        return len(times) >= limit
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        method = request.match_info["method"].lower()
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+
+        if method == "getupdates":
+            await asyncio.sleep(min(float(params.get("timeout", 0) or 0), 1))
+            return web.json_response({"ok": True, "result": []})
+        if method == "getme":
+            return web.json_response({"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "fake", "username": "fake_bot"}})
+        if method not in SEND_METHODS:
+            return web.json_response({"ok": True, "result": True})
+
+        chat_id = str(params.get("chat_id"))
+        now = time.monotonic()
+        if self._over_limit(self._global_times, self.global_limit, now) or \
+                self._over_limit(self._chat_times[chat_id], self.chat_limit, now):
+            self.flood_errors += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+        self._global_times.append(now)
+        self._chat_times[chat_id].append(now)
+        text = params.get("text") or params.get("caption") or ""
+        self.delivered[chat_id].append(text)
+        return web.json_response({"ok": True, "result": {
+            "message_id": next(self._ids), "date": int(time.time()), "text": text,
+            "chat": {"id": int(chat_id) if chat_id.lstrip("-").isdigit() else 0, "type": "private"},
+        }})
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "requests": self.requests,
+            "flood_errors": self.flood_errors,
+            "delivered": sum(len(texts) for texts in self.delivered.values()),
+        })
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        app.router.add_get("/stats", self.stats)
+        return app
+
+
+async def burst(url: str, api: FakeBotAPI, chats: int, messages: int, use_queue: bool):
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from config import Config
+    from outbound import OutboundQueue
+
+    bot = Bot(token="123456:" + "A" * 35, session=AiohttpSession(api=TelegramAPIServer.from_base(url)))
+    queue = None
+    if use_queue:
+        queue = OutboundQueue(
+            Config.OUTBOUND_GLOBAL_RATE, Config.OUTBOUND_CHAT_RATE, Config.OUTBOUND_CHAT_BURST, Config.OUTBOUND_MAX_RETRIES
+        )
+        bot.session.middleware(queue)
+
+    errors = 0
+
+    async def send(chat_id: int, n: int):
+        nonlocal errors
+        try:
+            await bot.send_message(chat_id, f"Сообщение {n}")
+        except Exception:
+            errors += 1
+
+    api.flood_errors = api.requests = 0
+    api.delivered.clear()
+    started = time.perf_counter()
+    await asyncio.gather(*(send(chat, n) for n in range(messages) for chat in range(1, chats + 1)))
+    elapsed = time.perf_counter() - started
+    await bot.session.close()
+
+    lost = sum(
+        1 for chat in range(1, chats + 1) for n in range(messages)
+        if not any(f"Сообщение {n}" in text.split("\n\n") for text in api.delivered[str(chat)])
+    )
+    print(
+        f"{'через очередь' if use_queue else 'напрямую':<14} {chats * messages} сообщений за {elapsed:.2f}s: "
+        f"HTTP-запросов {api.requests}, 429 {api.flood_errors}, ошибок у вызывающих {errors}, потеряно {lost}"
+        + (f", склеено {queue.coalesced}, повторов {queue.retried}" if queue else "")
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--chat-limit", type=int, default=1, help="Сообщений в секунду в чат до 429")
+    parser.add_argument("--global-limit", type=int, default=30, help="Сообщений в секунду на бота до 429")
+    parser.add_argument("--serve", action="store_true", help="Только запустить сервер")
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=10, help="Сообщений в каждый чат")
+    parser.add_argument("--compare", action="store_true", help="Повторить пачку без очереди")
+    args = parser.parse_args()
+
+    os.environ.setdefault("BOT_TOKEN", "123456:" + "A" * 35)
+    api = FakeBotAPI(args.chat_limit, args.global_limit)
+    runner = web.AppRunner(api.app())
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    url = f"http://{args.host}:{args.port}"
+    try:
+        if args.serve:
+            print(f"Поддельный Bot API слушает {url}")
+            await asyncio.Event().wait()
+        await burst(url, api, args.chats, args.messages, use_queue=True)
+        if args.compare:
+            await asyncio.sleep(1)  # Окно ограничений сервера освобождается
+            await burst(url, api, args.chats, args.messages, use_queue=False)
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,349 @@
+"""
+Нагрузочный тест бота: синтетические пользователи против настоящего Dispatcher.
+
+Обновления Telegram (сообщения и нажатия inline-кнопок) собираются в виде
+JSON и подаются в dp.feed_raw_update, как это делает webhook. Сессия Bot
+подменена заглушкой вместе с ее middleware (очередь отправки, метрики,
+backpressure), так что путь отправки настоящий, а в сеть ничего не уходит:
+ответ Bot API имитируется задержкой --api-latency. Лимиты отправки
+Telegram при этом соблюдаются (OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE):
+чтобы мерить только обработчики, поднимите их через переменные окружения. База - временная копия схемы, заполненная
+пользователями, категориями, бюджетами, целями и --transactions транзакциями.
+
+Каждый пользователь последовательно проходит сценарии (ввод расхода и дохода,
+отчет, просмотр бюджетов, пополнение цели), пользователи работают
+одновременно. В конце печатаются пропускная способность, p50/p95/p99
+задержки обработчика по шагам сценариев и число SQL-запросов на обновление.
+
+Запуск:
+    python benchmarks/load_test.py --users 1000 --flows 5 --transactions 200000
+
+Для отслеживания регрессий результат можно сохранить и сравнить с прошлым:
+    python benchmarks/load_test.py --json base.json
+    python benchmarks/load_test.py --baseline base.json --tolerance 0.2
+"""
+import argparse
+import asyncio
+import contextvars
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# База создается во временном каталоге, finance.db не трогаем
+_tmpdir = tempfile.mkdtemp(prefix="numbot-load-")
+os.environ["DB_URL"] = f"sqlite:///{os.path.join(_tmpdir, 'load.db')}"
+os.environ.setdefault("BOT_TOKEN", "123456:" + "A" * 35)
+os.environ.setdefault("CACHE_STATS_INTERVAL", "0")
+os.environ.setdefault("CHARTS_ENABLED", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.methods import AnswerCallbackQuery, EditMessageText, SendMessage, TelegramMethod  # noqa: E402
+from aiogram.types import Chat, Message  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+import rollups  # noqa: E402
+from metrics import BotApiMetricsMiddleware  # noqa: E402
+from outbound import OutboundQueue  # noqa: E402
+from update_scheduler import PollingBackpressure  # noqa: E402
+from models import (  # noqa: E402
+    Budget, Category, SavingsGoal, SessionLocal, Transaction, User, async_engine, async_read_engine, engine,
+)
+
+CATEGORIES_PER_USER = 5
+
+
+class StubSession(BaseSession):
+    """Сессия Bot без сети: каждый запрос «отвечает» через latency секунд.
+    middleware - менеджер middleware настоящей сессии, чтобы запросы шли через них."""
+
+    def __init__(self, latency: float, middleware=None):
+        super().__init__()
+        if middleware is not None:
+            self.middleware = middleware
+        self.latency = latency
+        self.requests = 0
+        self._ids = itertools.count(1)
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def make_request(self, bot, method: TelegramMethod, timeout=None):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(method, (SendMessage, EditMessageText)):
+            return Message(
+                message_id=next(self._ids), date=datetime.now(),
+                chat=Chat(id=method.chat_id or 0, type="private"), text=method.text,
+            ).as_(bot)
+        if isinstance(method, AnswerCallbackQuery):
+            return True
+        return True
+
+
+# Счетчик SQL-запросов текущего обновления (None - запрос не из обработчика)
+_queries = contextvars.ContextVar("queries", default=None)
+total_queries = 0
+
+
+def _count_query(*args):
+    global total_queries
+    total_queries += 1
+    counter = _queries.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+def seed(users: int, transactions: int):
+    """Заполняет базу: у каждого пользователя категории, бюджет, цель и история"""
+    import bot  # noqa: F401  Импорт применяет миграции к временной базе
+
+    now = datetime.now()
+    rnd = random.Random(0)
+    with SessionLocal() as session:
+        session.bulk_insert_mappings(User, [{"id": uid, "telegram_id": uid} for uid in range(1, users + 1)])
+        session.bulk_insert_mappings(Category, [
+            {"id": category_id(uid, i), "name": f"Категория {i}", "user_id": uid}
+            for uid in range(1, users + 1) for i in range(CATEGORIES_PER_USER)
+        ])
+        session.bulk_insert_mappings(Budget, [
+            {"user_id": uid, "category_id": category_id(uid, 0), "amount": 50000.0, "period": "месяц",
+             "start_date": now.replace(day=1, hour=0, minute=0, second=0, microsecond=0),
+             "current_spent": 0.0, "alert_level": 0}
+            for uid in range(1, users + 1)
+        ])
+        session.bulk_insert_mappings(SavingsGoal, [
+            {"id": uid, "user_id": uid, "name": "Отпуск", "target_amount": 100000.0, "current_amount": 0.0}
+            for uid in range(1, users + 1)
+        ])
+        for start in range(0, transactions, 50000):
+            session.bulk_insert_mappings(Transaction, [
+                {
+                    "user_id": (uid := rnd.randint(1, users)),
+                    "amount": round(rnd.uniform(10, 5000), 2),
+                    "category_id": category_id(uid, rnd.randrange(CATEGORIES_PER_USER)),
+                    "is_income": rnd.random() < 0.2,
+                    "created_at": now - timedelta(minutes=rnd.randint(0, 60 * 24 * 365)),
+                }
+                for _ in range(min(50000, transactions - start))
+            ])
+        session.commit()
+    rollups.rebuild(engine)
+
+
+def category_id(uid: int, index: int) -> int:
+    return (uid - 1) * CATEGORIES_PER_USER + index + 1
+
+
+_update_ids = itertools.count(1)
+
+
+def message_update(uid: int, text: str) -> dict:
+    update_id = next(_update_ids)
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "text": text,
+        "chat": {"id": uid, "type": "private"},
+        "from": {"id": uid, "is_bot": False, "first_name": f"user{uid}"},
+    }}
+
+
+def callback_update(uid: int, data: str) -> dict:
+    update_id = next(_update_ids)
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "chat_instance": str(uid), "data": data,
+        "from": {"id": uid, "is_bot": False, "first_name": f"user{uid}"},
+        "message": {
+            "message_id": update_id, "date": int(time.time()), "text": "...",
+            "chat": {"id": uid, "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "bot"},
+        },
+    }}
+
+
+# Сценарии: список шагов (название шага, функция uid, rnd -> обновление) и вес
+FLOWS = {
+    "expense": (40, [
+        ("expense:start", lambda uid, rnd: message_update(uid, "➖ Расход")),
+        ("expense:amount", lambda uid, rnd: message_update(uid, str(rnd.randint(50, 3000)))),
+        ("expense:category", lambda uid, rnd: callback_update(
+            uid, f"transaction_cat_{category_id(uid, rnd.randrange(CATEGORIES_PER_USER))}")),
+    ]),
+    "income": (10, [
+        ("income:start", lambda uid, rnd: message_update(uid, "➕ Доход")),
+        ("income:amount", lambda uid, rnd: message_update(uid, str(rnd.randint(1000, 100000)))),
+        ("income:category", lambda uid, rnd: callback_update(uid, f"transaction_cat_{category_id(uid, 0)}")),
+    ]),
+    "report": (20, [
+        ("report:menu", lambda uid, rnd: message_update(uid, "📊 Отчет")),
+        ("report:period", lambda uid, rnd: message_update(uid, rnd.choice(["За месяц", "За год", "За все время"]))),
+    ]),
+    "budgets": (15, [
+        ("budgets:view", lambda uid, rnd: message_update(uid, "💰 Бюджеты")),
+    ]),
+    "deposit": (15, [
+        ("deposit:menu", lambda uid, rnd: message_update(uid, "🎯 Накопления")),
+        ("deposit:start", lambda uid, rnd: message_update(uid, "💵 Пополнить")),
+        ("deposit:goal", lambda uid, rnd: callback_update(uid, f"deposit_{uid}")),
+        ("deposit:amount", lambda uid, rnd: message_update(uid, str(rnd.randint(100, 5000)))),
+    ]),
+}
+
+
+async def run(dp, bot, users: int, flows: int, think: float):
+    latencies = {}
+    queries = {}
+    errors = 0
+    names = list(FLOWS)
+    weights = [FLOWS[name][0] for name in names]
+
+    async def user_loop(uid: int):
+        nonlocal errors
+        rnd = random.Random(uid)
+        for _ in range(flows):
+            for step, build in FLOWS[rnd.choices(names, weights)[0]][1]:
+                update = build(uid, rnd)
+                counter = [0]
+                token = _queries.set(counter)
+                started = time.perf_counter()
+                try:
+                    await dp.feed_raw_update(bot, update)
+                except Exception:
+                    errors += 1
+                finally:
+                    latencies.setdefault(step, []).append(time.perf_counter() - started)
+                    queries.setdefault(step, []).append(counter[0])
+                    _queries.reset(token)
+                if think:
+                    await asyncio.sleep(rnd.uniform(0, think))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user_loop(uid) for uid in range(1, users + 1)))
+    return time.perf_counter() - started, latencies, queries, errors
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def summarize(elapsed, latencies, queries, errors) -> dict:
+    def stats(lat, qs):
+        lat = sorted(lat)
+        return {
+            "count": len(lat),
+            "p50_ms": percentile(lat, 50) * 1000,
+            "p95_ms": percentile(lat, 95) * 1000,
+            "p99_ms": percentile(lat, 99) * 1000,
+            "mean_ms": statistics.mean(lat) * 1000,
+            "queries_per_update": sum(qs) / len(qs),
+        }
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    all_queries = [value for values in queries.values() for value in values]
+    return {
+        "updates": len(all_latencies),
+        "elapsed_s": elapsed,
+        "throughput_ups": len(all_latencies) / elapsed,
+        "errors": errors,
+        "sql_total": total_queries,
+        "all": stats(all_latencies, all_queries),
+        "steps": {step: stats(latencies[step], queries[step]) for step in sorted(latencies)},
+    }
+
+
+def print_result(result: dict):
+    print(
+        f"{result['updates']} обновлений за {result['elapsed_s']:.2f}s: "
+        f"{result['throughput_ups']:.1f} upd/s, ошибок {result['errors']}, "
+        f"SQL-запросов всего {result['sql_total']}"
+    )
+    print(f"  {'шаг':<18} {'n':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'mean':>9} {'q/upd':>6}")
+    for step, row in [("all", result["all"])] + list(result["steps"].items()):
+        print(
+            f"  {step:<18} {row['count']:>6} {row['p50_ms']:>7.1f}ms {row['p95_ms']:>7.1f}ms "
+            f"{row['p99_ms']:>7.1f}ms {row['mean_ms']:>7.1f}ms {row['queries_per_update']:>6.2f}"
+        )
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    """Метрики, ухудшившиеся больше чем на tolerance относительно baseline"""
+    regressions = []
+    if result["throughput_ups"] < baseline["throughput_ups"] * (1 - tolerance):
+        regressions.append(f"throughput: {baseline['throughput_ups']:.1f} -> {result['throughput_ups']:.1f} upd/s")
+    for step, row in [("all", result["all"])] + list(result["steps"].items()):
+        base = baseline["all"] if step == "all" else baseline["steps"].get(step)
+        if base is None:
+            continue
+        # p99 по отдельному шагу слишком шумный, его сравниваем только для всех обновлений
+        for metric in ("p95_ms", "p99_ms") if step == "all" else ("p95_ms",):
+            if row[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f"{step} {metric}: {base[metric]:.1f} -> {row[metric]:.1f}")
+        # Число запросов детерминировано: любой рост - регрессия
+        if row["queries_per_update"] > base["queries_per_update"] + 0.01:
+            regressions.append(
+                f"{step} q/upd: {base['queries_per_update']:.2f} -> {row['queries_per_update']:.2f}"
+            )
+    return regressions
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000, help="Число одновременных пользователей")
+    parser.add_argument("--flows", type=int, default=5, help="Сценариев на пользователя")
+    parser.add_argument("--transactions", type=int, default=100000, help="Транзакций в базе перед замером")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="Имитация ответа Bot API, секунд")
+    parser.add_argument("--think", type=float, default=0.0, help="Максимальная пауза пользователя между шагами")
+    parser.add_argument("--json", help="Сохранить результат в файл")
+    parser.add_argument("--baseline", help="Сравнить с сохраненным результатом")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Допустимое ухудшение относительно baseline")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    seed(args.users, args.transactions)
+    print(f"База: {args.users} пользователей, {args.transactions} транзакций ({time.perf_counter() - started:.1f}s)")
+
+    import bot as app
+    app.bot.session = StubSession(args.api_latency, app.bot.session.middleware)
+    required = [OutboundQueue, PollingBackpressure] + ([BotApiMetricsMiddleware] if app.Config.METRICS_ENABLED else [])
+    missing = [cls.__name__ for cls in required if not any(isinstance(m, cls) for m in app.bot.session.middleware)]
+    if missing:
+        sys.exit(f"У сессии бота нет middleware отправки: {', '.join(missing)} - замер не отражал бы путь отправки")
+    for sync_engine in (async_engine.sync_engine, async_read_engine.sync_engine):
+        event.listen(sync_engine, "before_cursor_execute", _count_query)
+
+    await app.dp.emit_startup(bot=app.bot)
+    try:
+        result = summarize(*await run(app.dp, app.bot, args.users, args.flows, args.think))
+    finally:
+        await app.dp.emit_shutdown(bot=app.bot)
+        await async_engine.dispose()
+        await async_read_engine.dispose()
+        engine.dispose()
+
+    print(f"users={args.users} flows/user={args.flows} api_latency={args.api_latency} think={args.think}")
+    print_result(result)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(result, file, indent=2, ensure_ascii=False)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(result, json.load(file), args.tolerance)
+        if regressions:
+            print("Регрессии относительно baseline:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("Регрессий относительно baseline нет")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
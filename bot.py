@@ -1,23 +1,121 @@
 import logging
 import asyncio
+import os
+import tempfile
 from datetime import datetime, timedelta
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command
+from aiogram import Bot, types, F
+from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, Message, CallbackQuery
-from sqlalchemy.orm import Session
-from sqlalchemy import func
-from models import Base, engine, SessionLocal, init_db, User, Category, Transaction, SavingsGoal, Budget
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, Message, CallbackQuery, FSInputFile, BufferedInputFile
+from sqlalchemy.orm import selectinload
+from sqlalchemy import select, update
+from models import Base, engine, AsyncSessionLocal, AsyncReadSessionLocal, async_engine, async_read_engine, init_db, User, Category, Transaction, SavingsGoal, Budget
 from config import Config
+from cache import TTLCache, all_stats
+from write_pipeline import DirectWriter, WritePipeline
+from webhook import reply_in_response, run_webhook
+from fsm_storage import SQLiteStorage
+from scheduler import BudgetScheduler
+from budget_index import ALERT_EXCEEDED, BudgetIndex, charge, stored_alert_level
+from rollups import add_transaction, category_stats, monthly_totals, totals_by_category
+from importer import StatementError, import_statement, open_statement, parse_statement, recover_imports
+from exporter import export_transactions
+from analytics import SpendingAnalytics
+from savings import SavingsLedger, project
+import quick_entry
+import history
+from screens import ScreenTracker
+import charts
+import metrics
+from outbound import OutboundQueue
+from update_scheduler import OrderedDispatcher, PollingBackpressure
 
 # Инициализация
 init_db()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
-bot = Bot(token=Config.BOT_TOKEN)
-dp = Dispatcher()
+if Config.BOT_API_URL:
+    bot = Bot(token=Config.BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(Config.BOT_API_URL)))
+else:
+    bot = Bot(token=Config.BOT_TOKEN)
+if Config.FSM_STORAGE == "sqlite":
+    storage = SQLiteStorage(
+        AsyncSessionLocal, AsyncReadSessionLocal,
+        ttl=Config.FSM_STATE_TTL,
+        sweep_interval=Config.FSM_SWEEP_INTERVAL,
+        cache_size=Config.FSM_CACHE_SIZE
+    )
+else:
+    storage = MemoryStorage()
+dp = OrderedDispatcher(
+    storage=storage,
+    max_concurrency=Config.UPDATE_MAX_CONCURRENCY,
+    max_user_queue=Config.UPDATE_USER_QUEUE,
+    max_pending=Config.UPDATE_MAX_PENDING
+)
+budget_index = BudgetIndex(AsyncReadSessionLocal, Config.BUDGET_INDEX_SIZE, Config.BUDGET_INDEX_TTL)
+budget_scheduler = BudgetScheduler(
+    AsyncSessionLocal,
+    max_sleep=Config.BUDGET_SCHEDULER_MAX_SLEEP,
+    on_rollover=budget_index.invalidate_budgets,
+    # Воркер шарда: бюджеты перенесенных пользователей появляются в базе в обход бота
+    resync_interval=Config.SHARD_RESYNC_INTERVAL if Config.SHARD_ID is not None else None
+)
+spending_analytics = SpendingAnalytics(
+    AsyncReadSessionLocal, Config.ANALYTICS_CACHE_SIZE, Config.ANALYTICS_CACHE_TTL,
+    anomaly_days=Config.ANALYTICS_ANOMALY_DAYS,
+    anomaly_threshold=Config.ANALYTICS_ANOMALY_THRESHOLD,
+    min_history=Config.ANALYTICS_MIN_HISTORY
+)
+savings_ledger = SavingsLedger(
+    AsyncSessionLocal, AsyncReadSessionLocal,
+    Config.SAVINGS_SUMMARY_CACHE_SIZE, Config.SAVINGS_SUMMARY_CACHE_TTL
+)
+
+# Метрики: задержки обработчиков, SQL и Bot API по каждому обновлению
+metrics_server = None
+if Config.METRICS_ENABLED:
+    slow_log = metrics.setup(
+        dp, bot,
+        {"write": async_engine.sync_engine, "read": async_read_engine.sync_engine, "sync": engine},
+        slow_threshold=Config.SLOW_UPDATE_THRESHOLD,
+        slow_keep=Config.SLOW_UPDATE_KEEP
+    )
+    metrics_server = metrics.MetricsServer(slow_log, Config.METRICS_HOST, Config.METRICS_PORT)
+
+# Все отправки идут через общую очередь с ограничением скорости (после метрик:
+# метрики видят время ответа вместе с ожиданием в очереди)
+outbound = OutboundQueue(
+    global_rate=Config.OUTBOUND_GLOBAL_RATE,
+    chat_rate=Config.OUTBOUND_CHAT_RATE,
+    chat_burst=Config.OUTBOUND_CHAT_BURST,
+    max_retries=Config.OUTBOUND_MAX_RETRIES
+)
+bot.session.middleware(outbound)
+bot.session.middleware(PollingBackpressure(dp))
+
+# Графики к отчетам рисуются в отдельных процессах
+chart_renderer = None
+if Config.CHARTS_ENABLED:
+    if charts.available():
+        chart_renderer = charts.ChartRenderer(Config.CHART_WORKERS, Config.CHART_CACHE_SIZE, Config.CHART_CACHE_TTL)
+    else:
+        logger.warning("matplotlib не установлен, графики к отчетам отключены")
+
+# Режим inline: экраны меню - одно сообщение, которое правится на месте
+INLINE_NAVIGATION = Config.NAVIGATION_MODE == "inline"
+screens = ScreenTracker(Config.SCREEN_CACHE_SIZE, Config.SCREEN_CACHE_TTL)
+
+# Запись транзакций: групповой commit или отдельная транзакция на каждую запись
+if Config.WRITE_PIPELINE_ENABLED:
+    writer = WritePipeline(AsyncSessionLocal, Config.WRITE_BATCH_INTERVAL, Config.WRITE_BATCH_MAX)
+else:
+    writer = DirectWriter(AsyncSessionLocal)
 
 # Состояния FSM
 class Form(StatesGroup):
@@ -38,30 +136,100 @@ class Form(StatesGroup):
 # КЛАВИАТУРЫ
 # =====================
 
+# Кнопки меню: (текст, callback_data в режиме inline). В обычном режиме
+# нажатие присылает текст кнопки, в inline - callback с тем же обработчиком
+MAIN_MENU = [
+    [("➕ Доход", "nav_income"), ("➖ Расход", "nav_expense")],
+    [("📊 Отчет", "nav_report"), ("📝 Категории", "nav_categories")],
+    [("💰 Бюджеты", "nav_budgets"), ("🎯 Накопления", "nav_savings")],
+    [("ℹ️ Помощь", "nav_help")]
+]
+CANCEL_ROW = [("❌ Отмена", "nav_cancel")]
+BACK_ROW = [("🔙 На главную", "nav_main")]
+
+def menu_kb(rows):
+    if INLINE_NAVIGATION:
+        return InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text=text, callback_data=data) for text, data in row] for row in rows
+        ])
+    return ReplyKeyboardMarkup(
+        keyboard=[[KeyboardButton(text=text) for text, _ in row] for row in rows],
+        resize_keyboard=True
+    )
+
+def with_back_row(markup: InlineKeyboardMarkup, row=BACK_ROW):
+    """Inline-клавиатура экрана с кнопкой возврата (только в режиме inline)"""
+    if not INLINE_NAVIGATION:
+        return markup
+    return InlineKeyboardMarkup(inline_keyboard=[
+        *markup.inline_keyboard, [InlineKeyboardButton(text=text, callback_data=data) for text, data in row]
+    ])
+
 def get_main_kb():
-    kb = [
-        [KeyboardButton(text="➕ Доход"), KeyboardButton(text="➖ Расход")],
-        [KeyboardButton(text="📊 Отчет"), KeyboardButton(text="📝 Категории")],
-        [KeyboardButton(text="💰 Бюджеты"), KeyboardButton(text="🎯 Накопления")],
-        [KeyboardButton(text="ℹ️ Помощь")]
-    ]
-    return ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True)
+    return menu_kb(MAIN_MENU)
 
 def get_cancel_kb():
-    return ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="❌ Отмена")]], resize_keyboard=True)
+    return menu_kb([CANCEL_ROW])
+
+async def show(event, text: str, reply_markup=None, parse_mode=None):
+    """
+    Ответ на сообщение или нажатие кнопки. В режиме inline нажатие правит
+    тот же экран, а ответ на текст становится новым экраном чата. Нажатие
+    подтверждается в ответе на запрос webhook, если обновление пришло так.
+    """
+    if isinstance(event, CallbackQuery):
+        if INLINE_NAVIGATION:
+            await screens.edit(event.message, text, reply_markup, parse_mode)
+        else:
+            await event.message.answer(text, reply_markup=reply_markup, parse_mode=parse_mode)
+        answer = event.answer()
+        if not reply_in_response(answer):
+            await answer
+    elif INLINE_NAVIGATION:
+        await screens.send(event, text, reply_markup, parse_mode)
+    else:
+        await event.answer(text, reply_markup=reply_markup, parse_mode=parse_mode)
+
+def build_categories_kb(categories, action: str = "transaction"):
+    """Клавиатура по уже загруженным категориям (нужны поля id и name)"""
+    builder = InlineKeyboardBuilder()
+    for cat in categories:
+        builder.button(text=cat.name, callback_data=f"{action}_cat_{cat.id}")
+    
+    if action in ["transaction", "budget"]:
+        builder.button(text="➕ Создать категорию", callback_data=f"new_{action}_category")
+    
+    builder.adjust(1)
+    return builder.as_markup()
+
+# Готовые клавиатуры категорий по (user_id, action) и индекс категорий для
+# быстрого ввода по user_id; категории меняются редко
+categories_kb_cache = TTLCache("categories_kb", Config.CATEGORY_CACHE_SIZE, Config.CATEGORY_CACHE_TTL)
+category_index_cache = TTLCache("category_index", Config.CATEGORY_CACHE_SIZE, Config.CATEGORY_CACHE_TTL)
+CATEGORY_KB_ACTIONS = ("transaction", "budget", "view")
+
+def invalidate_categories_kb(user_id: int):
+    for action in CATEGORY_KB_ACTIONS:
+        categories_kb_cache.pop((user_id, action))
+    category_index_cache.pop(user_id)
+
+async def get_category_index(user_id: int) -> quick_entry.CategoryIndex:
+    index = category_index_cache.get(user_id)
+    if index is None:
+        async with AsyncReadSessionLocal() as session:
+            categories = (await session.execute(
+                select(Category.id, Category.name).filter_by(user_id=user_id).order_by(Category.id)
+            )).all()
+        index = quick_entry.CategoryIndex(categories)
+        category_index_cache.set(user_id, index)
+    return index
 
 async def get_categories_kb(user_id: int, action: str = "transaction"):
-    with SessionLocal() as session:
-        categories = session.query(Category).filter_by(user_id=user_id).all()
-        builder = InlineKeyboardBuilder()
-        for cat in categories:
-            builder.button(text=cat.name, callback_data=f"{action}_cat_{cat.id}")
-        
-        if action in ["transaction", "budget"]:
-            builder.button(text="➕ Создать категорию", callback_data=f"new_{action}_category")
-        
-        builder.adjust(1)
-        return builder.as_markup()
+    markup = categories_kb_cache.get((user_id, action))
+    if markup is None:
+        markup = build_categories_kb((await get_category_index(user_id)).categories, action)
+        categories_kb_cache.set((user_id, action), markup)
+    return markup
 
 # =====================
 # ОСНОВНЫЕ КОМАНДЫ
@@ -69,14 +237,15 @@ async def get_categories_kb(user_id: int, action: str = "transaction"):
 
 @dp.message(Command("start"))
 async def cmd_start(message: Message):
-    with SessionLocal() as session:
-        user = session.query(User).filter_by(telegram_id=message.from_user.id).first()
+    async with AsyncSessionLocal() as session:
+        user = await session.scalar(select(User).filter_by(telegram_id=message.from_user.id))
         if not user:
             user = User(telegram_id=message.from_user.id)
             session.add(user)
-            session.commit()
+            await session.commit()
     
-    await message.answer(
+    await show(
+        message,
         "💰 <b>Финансовый помощник</b>\n\n"
         "Выберите действие:",
         reply_markup=get_main_kb(),
@@ -84,7 +253,8 @@ async def cmd_start(message: Message):
     )
 
 @dp.message(F.text == "ℹ️ Помощь")
-async def cmd_help(message: Message):
+@dp.callback_query(F.data == "nav_help")
+async def cmd_help(event: Message | CallbackQuery):
     help_text = (
         "📚 <b>Доступные команды:</b>\n\n"
         "➕ Доход - добавить доход\n"
@@ -92,26 +262,34 @@ async def cmd_help(message: Message):
         "📊 Отчет - просмотреть статистику\n"
         "📝 Категории - управление категориями\n"
         "💰 Бюджеты - установка лимитов\n"
-        "🎯 Накопления - цели сбережений"
+        "🎯 Накопления - цели сбережений\n\n"
+        "📥 Пришлите CSV-выписку банка файлом, чтобы загрузить историю операций\n"
+        "📤 /export - выгрузить всю историю операций в CSV\n"
+        "⚡️ Быстрый ввод: «-450 кофе» - расход, «+50000 зарплата» - доход\n"
+        "📈 /analytics - средние траты, сравнение с прошлым месяцем и прогноз по бюджетам"
     )
-    await message.answer(help_text, parse_mode="HTML")
+    await show(event, help_text, reply_markup=menu_kb([BACK_ROW]) if INLINE_NAVIGATION else None, parse_mode="HTML")
 
 # =====================
 # ОБРАБОТКА ОТМЕНЫ И ВОЗВРАТА
 # =====================
 
 @dp.message(F.text == "❌ Отмена")
-async def cancel_operation(message: Message, state: FSMContext):
+@dp.callback_query(F.data == "nav_cancel")
+async def cancel_operation(event: Message | CallbackQuery, state: FSMContext):
     await state.clear()
-    await message.answer(
+    await show(
+        event,
         "Операция отменена",
         reply_markup=get_main_kb()
     )
 
 @dp.message(F.text == "🔙 На главную")
-async def back_to_main(message: Message, state: FSMContext):
+@dp.callback_query(F.data == "nav_main")
+async def back_to_main(event: Message | CallbackQuery, state: FSMContext):
     await state.clear()
-    await message.answer(
+    await show(
+        event,
         "Главное меню:",
         reply_markup=get_main_kb()
     )
@@ -121,10 +299,12 @@ async def back_to_main(message: Message, state: FSMContext):
 # =====================
 
 @dp.message(F.text.in_(["➕ Доход", "➖ Расход"]))
-async def start_transaction(message: Message, state: FSMContext):
-    await state.update_data(transaction_type="income" if message.text == "➕ Доход" else "expense")
+@dp.callback_query(F.data.in_(["nav_income", "nav_expense"]))
+async def start_transaction(event: Message | CallbackQuery, state: FSMContext):
+    is_income = event.text == "➕ Доход" if isinstance(event, Message) else event.data == "nav_income"
+    await state.update_data(transaction_type="income" if is_income else "expense")
     await state.set_state(Form.amount)
-    await message.answer("Введите сумму:", reply_markup=get_cancel_kb())
+    await show(event, "Введите сумму:", reply_markup=get_cancel_kb())
 
 @dp.message(Form.amount)
 async def process_amount(message: Message, state: FSMContext):
@@ -136,53 +316,18 @@ async def process_amount(message: Message, state: FSMContext):
         await state.set_state(Form.category)
         
         user_id = message.from_user.id
-        await message.answer(
+        await show(
+            message,
             "Выберите категорию:",
-            reply_markup=await get_categories_kb(user_id, "transaction")
+            reply_markup=with_back_row(await get_categories_kb(user_id, "transaction"), CANCEL_ROW)
         )
     except ValueError:
         await message.answer("Введите корректную сумму (число больше 0):", reply_markup=get_cancel_kb())
 
-@dp.callback_query(Form.category, F.data.startswith("transaction_cat_"))
-async def select_category(callback: CallbackQuery, state: FSMContext):
-    try:
-        category_id = int(callback.data.split("_")[2])
-        data = await state.get_data()
-        
-        with SessionLocal() as session:
-            transaction = Transaction(
-                user_id=callback.from_user.id,
-                amount=data['amount'],
-                category_id=category_id,
-                is_income=data['transaction_type'] == 'income',
-                created_at=datetime.now()
-            )
-            
-            if not data['transaction_type'] == 'income':
-                budgets = session.query(Budget).filter_by(category_id=category_id).all()
-                for budget in budgets:
-                    budget.current_spent += data['amount']
-            
-            session.add(transaction)
-            session.commit()
-        
-        await callback.message.answer(
-            f"✅ {'Доход' if data['transaction_type'] == 'income' else 'Расход'} {data['amount']} ₽ сохранен!",
-            reply_markup=get_main_kb()
-        )
-    except Exception as e:
-        logger.error(f"Ошибка сохранения транзакции: {e}")
-        await callback.message.answer(
-            "❌ Ошибка при сохранении транзакции",
-            reply_markup=get_main_kb()
-        )
-    finally:
-        await state.clear()
-
 @dp.callback_query(Form.category, F.data == "new_transaction_category")
 async def new_category(callback: CallbackQuery, state: FSMContext):
-    await callback.message.answer("Введите название категории:", reply_markup=get_cancel_kb())
     await state.set_state(Form.new_category)
+    await show(callback, "Введите название категории:", reply_markup=get_cancel_kb())
 
 @dp.message(Form.new_category)
 async def save_category(message: Message, state: FSMContext):
@@ -191,154 +336,193 @@ async def save_category(message: Message, state: FSMContext):
         await message.answer("Название не может быть пустым!", reply_markup=get_cancel_kb())
         return
     
-    with SessionLocal() as session:
-        exists = session.query(Category).filter_by(
+    data = await state.get_data()
+    # Соединение на запись единственное: отвечаем пользователю уже после выхода из сессии
+    async with AsyncSessionLocal() as session:
+        exists = await session.scalar(select(Category).filter_by(
             user_id=message.from_user.id,
             name=name
-        ).first()
-        if exists:
-            await message.answer("Категория уже существует!", reply_markup=get_main_kb())
-            await state.clear()
-            return
-        
-        category = Category(
-            name=name,
-            user_id=message.from_user.id
-        )
-        session.add(category)
-        session.commit()
-        
-        data = await state.get_data()
-        if 'amount' in data:
-            transaction = Transaction(
-                user_id=message.from_user.id,
-                amount=data['amount'],
-                category_id=category.id,
-                is_income=data['transaction_type'] == 'income',
-                created_at=datetime.now()
+        ))
+        if not exists:
+            category = Category(
+                name=name,
+                user_id=message.from_user.id
             )
-            session.add(transaction)
-            session.commit()
+            session.add(category)
+            await session.commit()
+            invalidate_categories_kb(message.from_user.id)
             
-            await message.answer(
-                f"✅ Категория создана и транзакция сохранена!\n"
-                f"Сумма: {data['amount']} ₽",
-                reply_markup=get_main_kb()
-            )
-        else:
-            await message.answer(
-                f"✅ Категория «{name}» создана!",
-                reply_markup=get_main_kb()
-            )
-        
-        await state.clear()
+            if 'amount' in data:
+                transaction = Transaction(
+                    user_id=message.from_user.id,
+                    amount=data['amount'],
+                    category_id=category.id,
+                    is_income=data['transaction_type'] == 'income',
+                    created_at=datetime.now()
+                )
+                await add_transaction(session, transaction)
+                await session.commit()
+                spending_analytics.invalidate(message.from_user.id)
+    
+    if exists:
+        await show(message, "Категория уже существует!", reply_markup=get_main_kb())
+    elif 'amount' in data:
+        await show(
+            message,
+            f"✅ Категория создана и транзакция сохранена!\n"
+            f"Сумма: {data['amount']} ₽",
+            reply_markup=get_main_kb()
+        )
+    else:
+        await show(
+            message,
+            f"✅ Категория «{name}» создана!",
+            reply_markup=get_main_kb()
+        )
+    
+    await state.clear()
 
 # =====================
 # КАТЕГОРИИ (ИСПРАВЛЕННЫЕ)
 # =====================
 
 @dp.message(F.text == "📝 Категории")
-async def categories_menu(message: Message):
-    with SessionLocal() as session:
-        categories = session.query(Category).filter_by(user_id=message.from_user.id).all()
-        
-        if not categories:
-            await message.answer("У вас пока нет категорий", reply_markup=get_main_kb())
-            return
-        
-        text = "📝 Ваши категории:\n\n"
-        for cat in categories:
-            count = session.query(Transaction).filter_by(category_id=cat.id).count()
-            total = session.query(func.sum(Transaction.amount)).filter_by(category_id=cat.id).scalar() or 0
-            text += f"- {cat.name} ({count} транзакций, сумма: {total:.2f} ₽)\n"
-        
-        await message.answer(
-            text,
-            reply_markup=await get_categories_kb(message.from_user.id, "view")
-        )
+@dp.callback_query(F.data == "nav_categories")
+async def categories_menu(event: Message | CallbackQuery):
+    # Список, статистика и клавиатура строятся из одного запроса к сводкам
+    async with AsyncReadSessionLocal() as session:
+        categories = (await session.execute(category_stats(event.from_user.id))).all()
+    
+    if not categories:
+        await show(event, "У вас пока нет категорий", reply_markup=get_main_kb())
+        return
+    
+    text = "📝 Ваши категории:\n\n"
+    for cat in categories:
+        text += f"- {cat.name} ({cat.tx_count} транзакций, сумма: {cat.total:.2f} ₽)\n"
+    
+    await show(
+        event,
+        text,
+        reply_markup=with_back_row(build_categories_kb(categories, "view"))
+    )
 
 @dp.callback_query(F.data.startswith("view_cat_"))
 async def view_category(callback: CallbackQuery):
     category_id = int(callback.data.split("_")[2])
-    with SessionLocal() as session:
-        category = session.get(Category, category_id)
-        if not category:
-            await callback.answer("Категория не найдена")
-            return
-        
-        transactions = session.query(Transaction).filter_by(
-            category_id=category_id
-        ).order_by(Transaction.created_at.desc()).limit(10).all()
-        
-        response = [f"📊 <b>{category.name}</b>\n"]
-        for t in transactions:
-            response.append(
-                f"{'➕' if t.is_income else '➖'} {t.amount} ₽ "
-                f"({t.created_at.strftime('%d.%m.%Y')})"
-            )
-        
-        if not transactions:
-            response.append("\nВ этой категории пока нет транзакций")
-        
-        await callback.message.answer(
-            "\n".join(response),
-            parse_mode="HTML",
-            reply_markup=get_main_kb()
+    text, markup = await render_history_page(callback.from_user.id, category_id, "a", "all", history.FIRST_PAGE)
+    if text is None:
+        await callback.answer("Категория не найдена")
+        return
+    await show(callback, text, reply_markup=markup, parse_mode="HTML")
+
+async def render_history_page(user_id: int, category_id: int, kind: str, period_key: str, cursor: str):
+    """Текст и клавиатура страницы истории категории; (None, None), если категория не пользователя"""
+    # Название и принадлежность категории - из индекса категорий в кэше
+    category = (await get_category_index(user_id)).by_id.get(category_id)
+    if category is None:
+        return None, None
+    async with AsyncReadSessionLocal() as session:
+        page = await history.fetch_page(
+            session, category_id, kind, report_date_from(period_key), cursor, Config.HISTORY_PAGE_SIZE
         )
-    await callback.answer()
+    
+    response = [f"📊 <b>{category.name}</b> · {history.KINDS[kind][0].lower()} · {REPORT_PERIODS[period_key][0].lower()}\n"]
+    for t in page.rows:
+        response.append(
+            f"{'➕' if t.is_income else '➖'} {t.amount:.2f} ₽ "
+            f"({t.created_at.strftime('%d.%m.%Y %H:%M')})"
+        )
+    if not page.rows:
+        response.append("Операций не найдено")
+    
+    # Фильтры начинают просмотр с первой страницы, стрелки листают от крайней операции
+    builder = InlineKeyboardBuilder()
+    prefix = f"hist_{category_id}"
+    for code, (label, _) in history.KINDS.items():
+        builder.button(text=f"• {label}" if code == kind else label, callback_data=f"{prefix}_{code}_{period_key}_{history.FIRST_PAGE}")
+    for key, (label, _) in REPORT_PERIODS.items():
+        builder.button(text=f"• {label}" if key == period_key else label, callback_data=f"{prefix}_{kind}_{key}_{history.FIRST_PAGE}")
+    newer, older = page.newer_cursor(), page.older_cursor()
+    if newer:
+        builder.button(text="⬅️ Новее", callback_data=f"{prefix}_{kind}_{period_key}_{newer}")
+    if older:
+        builder.button(text="Старее ➡️", callback_data=f"{prefix}_{kind}_{period_key}_{older}")
+    builder.adjust(len(history.KINDS), len(REPORT_PERIODS), 2)
+    return "\n".join(response), with_back_row(builder.as_markup(), [("🔙 К категориям", "nav_categories")])
+
+@dp.callback_query(F.data.startswith("hist_"))
+async def history_page(callback: CallbackQuery):
+    try:
+        _, category_id, kind, period_key, cursor = callback.data.split("_")
+        category_id = int(category_id)
+        if kind not in history.KINDS or period_key not in REPORT_PERIODS:
+            raise ValueError
+        text, markup = await render_history_page(callback.from_user.id, category_id, kind, period_key, cursor)
+    except ValueError:
+        await callback.answer("Устаревшая кнопка")
+        return
+    if text is None:
+        await callback.answer("Категория не найдена")
+        return
+    # Страница заменяет предыдущую в том же сообщении; повторное нажатие текущего фильтра правку не шлет
+    await screens.edit(callback.message, text, markup, "HTML")
+    answer = callback.answer()
+    if not reply_in_response(answer):
+        await answer
 
 # =====================
 # ОТЧЕТЫ (ИСПРАВЛЕННЫЕ)
 # =====================
 
 @dp.message(F.text == "📊 Отчет")
-async def report_menu(message: Message, state: FSMContext):
-    kb = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="За месяц")],
-            [KeyboardButton(text="За год")],
-            [KeyboardButton(text="За все время")],
-            [KeyboardButton(text="❌ Отмена")]
-        ],
-        resize_keyboard=True
-    )
-    await message.answer("Выберите период для отчета:", reply_markup=kb)
+@dp.callback_query(F.data == "nav_report")
+async def report_menu(event: Message | CallbackQuery, state: FSMContext):
+    kb = menu_kb([
+        *([(label, f"report_{key}")] for key, (label, _) in REPORT_PERIODS.items()),
+        CANCEL_ROW
+    ])
     await state.set_state(Form.report_period)
+    await show(event, "Выберите период для отчета:", reply_markup=kb)
 
-@dp.message(Form.report_period)
-async def generate_report(message: Message, state: FSMContext):
-    period = message.text
-    with SessionLocal() as session:
+# Периоды отчета: ключ для callback_data -> (кнопка, дней; None - за все время)
+REPORT_PERIODS = {
+    "month": ("За месяц", 30),
+    "year": ("За год", 365),
+    "all": ("За все время", None),
+}
+
+def report_date_from(period_key: str):
+    days = REPORT_PERIODS[period_key][1]
+    return datetime.now() - timedelta(days=days) if days else datetime.min
+
+# Сообщением выбирается только период: быстрый ввод, выписка и прочий текст
+# проходят к своим обработчикам, хотя клавиатура периодов еще на экране
+@dp.message(Form.report_period, F.text.in_([label for label, _ in REPORT_PERIODS.values()]))
+@dp.callback_query(Form.report_period, F.data.startswith("report_"))
+async def generate_report(event: Message | CallbackQuery, state: FSMContext):
+    if isinstance(event, CallbackQuery):
+        period_key = event.data.split("_", 1)[1]
+        period_key = period_key if period_key in REPORT_PERIODS else "all"
+    else:
+        period_key = next(key for key, (label, _) in REPORT_PERIODS.items() if label == event.text)
+    period = REPORT_PERIODS[period_key][0]
+    keep_periods = False
+    async with AsyncReadSessionLocal() as session:
         try:
-            if period == "За месяц":
-                date_from = datetime.now() - timedelta(days=30)
-            elif period == "За год":
-                date_from = datetime.now() - timedelta(days=365)
-            else:
-                date_from = datetime.min
-            
-            # Доходы и расходы
-            income = session.query(func.sum(Transaction.amount)).filter(
-                Transaction.user_id == message.from_user.id,
-                Transaction.is_income == True,
-                Transaction.created_at >= date_from
-            ).scalar() or 0
-            
-            expense = session.query(func.sum(Transaction.amount)).filter(
-                Transaction.user_id == message.from_user.id,
-                Transaction.is_income == False,
-                Transaction.created_at >= date_from
-            ).scalar() or 0
+            date_from = report_date_from(period_key)
             
-            # Категории расходов
-            expense_by_cat = session.query(
-                Category.name,
-                func.sum(Transaction.amount).label('total')
-            ).join(Transaction).filter(
-                Transaction.user_id == message.from_user.id,
-                Transaction.is_income == False,
-                Transaction.created_at >= date_from
-            ).group_by(Category.name).order_by(func.sum(Transaction.amount).desc()).all()
+            # Доходы, расходы и расходы по категориям одним запросом к дневным сводкам
+            rows = (await session.execute(
+                totals_by_category(event.from_user.id, date_from.date())
+            )).all()
+            income = sum(row.total for row in rows if row.is_income)
+            expense = sum(row.total for row in rows if not row.is_income)
+            expense_by_cat = sorted(
+                (row for row in rows if not row.is_income and row.name is not None),
+                key=lambda row: row.total,
+                reverse=True
+            )
             
             # Формируем отчет
             report = [
@@ -356,42 +540,140 @@ async def generate_report(message: Message, state: FSMContext):
             if not expense_by_cat:
                 report.append("\nНет данных о расходах")
             
-            await message.answer(
-                "\n".join(report),
-                reply_markup=get_main_kb(),
-                parse_mode="HTML"
-            )
+            charts_kb = None
+            if chart_renderer and rows:
+                builder = InlineKeyboardBuilder()
+                for kind, (label, _) in charts.KINDS.items():
+                    if kind == "trend" or expense_by_cat:
+                        builder.button(text=label, callback_data=f"chart_{kind}_{period_key}")
+                builder.adjust(3)
+                charts_kb = builder.as_markup()
+            
+            # Кнопки графиков помещаются под самим отчетом - одно сообщение вместо двух
+            if INLINE_NAVIGATION:
+                markup = with_back_row(charts_kb) if charts_kb else get_main_kb()
+            else:
+                # Сообщение несет одну клавиатуру: с кнопками графиков остается клавиатура
+                # периодов - можно выбрать другой период или вернуться «Отмена»
+                markup = charts_kb or get_main_kb()
+                keep_periods = charts_kb is not None
+            await show(event, "\n".join(report), reply_markup=markup, parse_mode="HTML")
             
         except Exception as e:
             logger.error(f"Ошибка генерации отчета: {e}")
-            await message.answer(
+            await show(
+                event,
                 "Ошибка при генерации отчета",
                 reply_markup=get_main_kb()
             )
+            keep_periods = False
         finally:
-            await state.clear()
+            if not keep_periods:
+                await state.clear()
+
+@dp.callback_query(F.data.startswith("chart_"))
+async def send_chart(callback: CallbackQuery):
+    _, kind, period_key = callback.data.split("_")
+    if chart_renderer is None or kind not in charts.KINDS or period_key not in REPORT_PERIODS:
+        await callback.answer("Графики недоступны")
+        return
+    user_id = callback.from_user.id
+    day_from = report_date_from(period_key).date()
+    
+    # Данные графика - агрегаты из дневных сводок, запрос дешевый
+    async with AsyncReadSessionLocal() as session:
+        if kind == "trend":
+            months = {}
+            for row in (await session.execute(monthly_totals(user_id, day_from))).all():
+                income, expense = months.get(row.month, (0.0, 0.0))
+                months[row.month] = (income + row.total, expense) if row.is_income else (income, expense + row.total)
+            data = [(month, round(income, 2), round(expense, 2)) for month, (income, expense) in months.items()]
+        else:
+            rows = (await session.execute(totals_by_category(user_id, day_from))).all()
+            data = sorted(
+                ((row.name, round(row.total, 2)) for row in rows if not row.is_income and row.name is not None),
+                key=lambda item: item[1],
+                reverse=True
+            )
+    if not data:
+        await callback.answer("Нет данных для графика")
+        return
+    
+    await callback.answer()
+    key = (user_id, kind, period_key, charts.fingerprint(data))
+    photo = chart_renderer.cache.get(key)
+    try:
+        if photo is None:
+            title = f"{charts.KINDS[kind][1]} {REPORT_PERIODS[period_key][0].lower()}"
+            png = await chart_renderer.render(kind, title, data)
+            photo = BufferedInputFile(png, filename=f"{kind}.png")
+        sent = await callback.message.answer_photo(photo)
+        # Повторно отправляем уже загруженный в Telegram файл по file_id
+        chart_renderer.cache.set(key, sent.photo[-1].file_id)
+    except Exception as e:
+        logger.error(f"Ошибка построения графика: {e}")
+        await callback.message.answer("❌ Не удалось построить график")
+
+@dp.message(Command("analytics"))
+async def spending_report(message: Message):
+    try:
+        analysis = await spending_analytics.analyze(message.from_user.id)
+    except Exception as e:
+        logger.error(f"Ошибка расчета аналитики: {e}")
+        await message.answer("Ошибка при расчете аналитики", reply_markup=get_main_kb())
+        return
+    if analysis is None:
+        await message.answer("Пока нет расходов для анализа", reply_markup=get_main_kb())
+        return
+    
+    report = [
+        "📈 <b>Аналитика расходов</b>",
+        f"В среднем в день: за 7 дней {analysis.avg7:.2f} ₽, за 30 дней {analysis.avg30:.2f} ₽",
+        f"С начала месяца: {analysis.month_to_date:.2f} ₽",
+        f"Прогноз на конец месяца: {analysis.projected:.2f} ₽",
+    ]
+    
+    if analysis.categories:
+        report += ["", "<b>По категориям</b> (с начала месяца, к тому же периоду прошлого месяца, прогноз):"]
+        for cat in analysis.categories:
+            change = f"{cat.change:+.0%}" if cat.change is not None else "новое"
+            report.append(f"- {cat.name}: {cat.month_to_date:.2f} ₽ ({change}), прогноз {cat.projected:.2f} ₽")
+    
+    if analysis.anomalies:
+        report += ["", "<b>Необычные траты:</b>"]
+        for day, name, amount, usual in analysis.anomalies:
+            report.append(f"- {day:%d.%m} {name}: {amount:.2f} ₽ (обычно {usual:.2f} ₽)")
+    
+    if analysis.budgets or analysis.unknown_budgets:
+        report += ["", "<b>Бюджеты к концу месяца:</b>"]
+        for name, period, amount, monthly, projected in analysis.budgets:
+            status = "✅" if projected <= monthly else f"⚠️ превышение на {projected - monthly:.2f} ₽"
+            limit = f"{amount:.2f} ₽ ({period})" + (f" = {monthly:.2f} ₽ в месяц" if period != "месяц" else "")
+            report.append(f"- {name}: лимит {limit}, прогноз {projected:.2f} ₽ {status}")
+        for name, period in analysis.unknown_budgets:
+            report.append(f"- {name}: период «{period}» не распознан, прогноз не строится")
+    
+    await message.answer("\n".join(report), reply_markup=get_main_kb(), parse_mode="HTML")
 
 # =====================
 # НАКОПЛЕНИЯ (ИСПРАВЛЕННЫЕ)
 # =====================
 
 @dp.message(F.text == "🎯 Накопления")
-async def savings_menu(message: Message):
-    with SessionLocal() as session:
-        goals = session.query(SavingsGoal).filter_by(user_id=message.from_user.id).all()
+@dp.callback_query(F.data == "nav_savings")
+async def savings_menu(event: Message | CallbackQuery):
+    # Темп пополнений - из кэша сводок журнала, журнал не перечитывается
+    summaries = await savings_ledger.summaries(event.from_user.id)
+    async with AsyncReadSessionLocal() as session:
+        goals = (await session.scalars(select(SavingsGoal).filter_by(user_id=event.from_user.id))).all()
         
         if not goals:
-            kb = ReplyKeyboardMarkup(
-                keyboard=[
-                    [KeyboardButton(text="➕ Создать цель")],
-                    [KeyboardButton(text="🔙 На главную")]
-                ],
-                resize_keyboard=True
-            )
-            await message.answer("У вас пока нет целей накопления.", reply_markup=kb)
+            kb = menu_kb([[("➕ Создать цель", "nav_goal_create")], BACK_ROW])
+            await show(event, "У вас пока нет целей накопления.", reply_markup=kb)
             return
         
         text = "🎯 Ваши цели накопления:\n\n"
+        today = datetime.now().date()
         for goal in goals:
             progress = (goal.current_amount / goal.target_amount) * 100
             remaining = goal.target_amount - goal.current_amount
@@ -400,23 +682,32 @@ async def savings_menu(message: Message):
                 f"Цель: {goal.target_amount:.2f} ₽\n"
                 f"Накоплено: {goal.current_amount:.2f} ₽ ({progress:.1f}%)\n"
                 f"Осталось: {remaining:.2f} ₽\n"
-                f"{'Срок: ' + goal.target_date.strftime('%d.%m.%Y') if goal.target_date else ''}\n\n"
+                f"{'Срок: ' + goal.target_date.strftime('%d.%m.%Y') if goal.target_date else ''}\n"
             )
+            summary = summaries.get(goal.id)
+            projection = project(goal, summary, today, Config.SAVINGS_MIN_PACE_DAYS) if summary else None
+            if projection:
+                text += f"Темп: ~{projection.rate * 30:.2f} ₽ в месяц\n"
+                if projection.completion:
+                    text += f"Прогноз: {projection.completion.strftime('%d.%m.%Y')}\n"
+                if projection.on_track:
+                    text += "✅ Успеваете к сроку\n"
+                elif projection.on_track is False:
+                    text += "⚠️ К сроку не успеваете"
+                    if projection.required_rate:
+                        text += f": нужно ~{projection.required_rate * 30:.2f} ₽ в месяц"
+                    text += "\n"
+            text += "\n"
         
-        kb = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="➕ Создать цель"), KeyboardButton(text="💵 Пополнить")],
-                [KeyboardButton(text="🔙 На главную")]
-            ],
-            resize_keyboard=True
-        )
+        kb = menu_kb([[("➕ Создать цель", "nav_goal_create"), ("💵 Пополнить", "nav_deposit")], BACK_ROW])
         
-        await message.answer(text, reply_markup=kb, parse_mode="HTML")
+        await show(event, text, reply_markup=kb, parse_mode="HTML")
 
 @dp.message(F.text == "➕ Создать цель")
-async def start_create_goal(message: Message, state: FSMContext):
-    await message.answer("Введите название цели:", reply_markup=get_cancel_kb())
+@dp.callback_query(F.data == "nav_goal_create")
+async def start_create_goal(event: Message | CallbackQuery, state: FSMContext):
     await state.set_state(Form.savings_name)
+    await show(event, "Введите название цели:", reply_markup=get_cancel_kb())
 
 @dp.message(Form.savings_name)
 async def process_goal_name(message: Message, state: FSMContext):
@@ -432,28 +723,25 @@ async def process_target_amount(message: Message, state: FSMContext):
             raise ValueError
         await state.update_data(target_amount=amount)
         
-        kb = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="Пропустить")],
-                [KeyboardButton(text="❌ Отмена")]
-            ],
-            resize_keyboard=True
-        )
+        kb = menu_kb([[("Пропустить", "goal_skip_date")], CANCEL_ROW])
         
-        await message.answer(
+        await state.set_state(Form.savings_date)
+        await show(
+            message,
             "Введите дату цели (ДД.ММ.ГГГГ) или нажмите 'Пропустить':",
             reply_markup=kb
         )
-        await state.set_state(Form.savings_date)
     except ValueError:
         await message.answer("Пожалуйста, введите корректную сумму:", reply_markup=get_cancel_kb())
 
 @dp.message(Form.savings_date)
-async def process_target_date(message: Message, state: FSMContext):
+@dp.callback_query(Form.savings_date, F.data == "goal_skip_date")
+async def process_target_date(event: Message | CallbackQuery, state: FSMContext):
     data = await state.get_data()
     target_date = None
     
-    if message.text.lower() != "пропустить":
+    if isinstance(event, Message) and event.text.lower() != "пропустить":
+        message = event
         try:
             target_date = datetime.strptime(message.text, "%d.%m.%Y").date()
             if target_date < datetime.now().date():
@@ -463,32 +751,34 @@ async def process_target_date(message: Message, state: FSMContext):
             await message.answer("Неверный формат даты! Используйте ДД.ММ.ГГГГ", reply_markup=get_cancel_kb())
             return
     
-    with SessionLocal() as session:
+    async with AsyncSessionLocal() as session:
         goal = SavingsGoal(
-            user_id=message.from_user.id,
+            user_id=event.from_user.id,
             name=data['name'],
             target_amount=data['target_amount'],
             current_amount=0.0,
             target_date=target_date
         )
         session.add(goal)
-        session.commit()
+        await session.commit()
     
-    await message.answer(
+    await state.clear()
+    await show(
+        event,
         f"✅ Цель «{data['name']}» создана!\n"
         f"Целевая сумма: {data['target_amount']} ₽\n"
         f"{'Срок: ' + target_date.strftime('%d.%m.%Y') if target_date else 'Без срока'}",
         reply_markup=get_main_kb()
     )
-    await state.clear()
 
 @dp.message(F.text == "💵 Пополнить")
-async def start_deposit(message: Message, state: FSMContext):
-    with SessionLocal() as session:
-        goals = session.query(SavingsGoal).filter_by(user_id=message.from_user.id).all()
+@dp.callback_query(F.data == "nav_deposit")
+async def start_deposit(event: Message | CallbackQuery, state: FSMContext):
+    async with AsyncReadSessionLocal() as session:
+        goals = (await session.scalars(select(SavingsGoal).filter_by(user_id=event.from_user.id))).all()
         
         if not goals:
-            await message.answer("У вас пока нет целей для пополнения", reply_markup=get_main_kb())
+            await show(event, "У вас пока нет целей для пополнения", reply_markup=get_main_kb())
             return
         
         builder = InlineKeyboardBuilder()
@@ -499,21 +789,22 @@ async def start_deposit(message: Message, state: FSMContext):
             )
         builder.adjust(1)
         
-        await message.answer(
+        await state.set_state(Form.savings_deposit)
+        await show(
+            event,
             "Выберите цель для пополнения:",
-            reply_markup=builder.as_markup()
+            reply_markup=with_back_row(builder.as_markup(), CANCEL_ROW)
         )
-        await state.set_state(Form.savings_deposit)
 
 @dp.callback_query(Form.savings_deposit, F.data.startswith("deposit_"))
 async def select_goal_for_deposit(callback: CallbackQuery, state: FSMContext):
     goal_id = int(callback.data.split("_")[1])
     await state.update_data(goal_id=goal_id)
-    await callback.message.answer(
+    await show(
+        callback,
         "Введите сумму для пополнения:",
         reply_markup=get_cancel_kb()
     )
-    await callback.answer()
 
 @dp.message(Form.savings_deposit)
 async def process_deposit_amount(message: Message, state: FSMContext):
@@ -524,34 +815,33 @@ async def process_deposit_amount(message: Message, state: FSMContext):
         
         data = await state.get_data()
         
-        with SessionLocal() as session:
-            goal = session.get(SavingsGoal, data['goal_id'])
-            if not goal:
-                await message.answer("Цель не найдена")
-                await state.clear()
-                return
-            
-            goal.current_amount += amount
-            session.commit()
-            
-            progress = (goal.current_amount / goal.target_amount) * 100
-            remaining = goal.target_amount - goal.current_amount
-            
-            response = [
-                f"✅ Вы пополнили цель <b>«{goal.name}»</b> на {amount:.2f} ₽",
-                f"💰 Текущий баланс: {goal.current_amount:.2f} ₽ из {goal.target_amount:.2f} ₽",
-                f"📊 Прогресс: {progress:.1f}%",
-                f"📌 Осталось накопить: {remaining:.2f} ₽"
-            ]
-            
-            if goal.target_amount <= goal.current_amount:
-                response.append("\n🎉 Поздравляем! Цель достигнута!")
-            
-            await message.answer(
-                "\n".join(response),
-                reply_markup=get_main_kb(),
-                parse_mode="HTML"
-            )
+        # Сумма цели увеличивается в SQL, вместе с записью в журнал пополнений
+        goal = await savings_ledger.deposit(message.from_user.id, data['goal_id'], amount)
+        
+        if not goal:
+            await message.answer("Цель не найдена")
+            await state.clear()
+            return
+        
+        progress = (goal.current_amount / goal.target_amount) * 100
+        remaining = goal.target_amount - goal.current_amount
+        
+        response = [
+            f"✅ Вы пополнили цель <b>«{goal.name}»</b> на {amount:.2f} ₽",
+            f"💰 Текущий баланс: {goal.current_amount:.2f} ₽ из {goal.target_amount:.2f} ₽",
+            f"📊 Прогресс: {progress:.1f}%",
+            f"📌 Осталось накопить: {remaining:.2f} ₽"
+        ]
+        
+        if goal.target_amount <= goal.current_amount:
+            response.append("\n🎉 Поздравляем! Цель достигнута!")
+        
+        await show(
+            message,
+            "\n".join(response),
+            reply_markup=get_main_kb(),
+            parse_mode="HTML"
+        )
         
         await state.clear()
     
@@ -563,19 +853,16 @@ async def process_deposit_amount(message: Message, state: FSMContext):
 # =====================
 
 @dp.message(F.text == "💰 Бюджеты")
-async def budgets_menu(message: Message):
-    with SessionLocal() as session:
-        budgets = session.query(Budget).filter_by(user_id=message.from_user.id).all()
+@dp.callback_query(F.data == "nav_budgets")
+async def budgets_menu(event: Message | CallbackQuery):
+    async with AsyncReadSessionLocal() as session:
+        budgets = (await session.scalars(
+            select(Budget).filter_by(user_id=event.from_user.id).options(selectinload(Budget.category))
+        )).all()
         
         if not budgets:
-            kb = ReplyKeyboardMarkup(
-                keyboard=[
-                    [KeyboardButton(text="➕ Создать бюджет")],
-                    [KeyboardButton(text="🔙 На главную")]
-                ],
-                resize_keyboard=True
-            )
-            await message.answer("У вас пока нет установленных бюджетов.", reply_markup=kb)
+            kb = menu_kb([[("➕ Создать бюджет", "nav_budget_create")], BACK_ROW])
+            await show(event, "У вас пока нет установленных бюджетов.", reply_markup=kb)
             return
         
         text = "💰 Ваши бюджеты:\n\n"
@@ -593,56 +880,50 @@ async def budgets_menu(message: Message):
                 f"Статус: {status}\n\n"
             )
         
-        kb = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="➕ Создать бюджет"), KeyboardButton(text="🔄 Сбросить")],
-                [KeyboardButton(text="🔙 На главную")]
-            ],
-            resize_keyboard=True
-        )
+        kb = menu_kb([[("➕ Создать бюджет", "nav_budget_create"), ("🔄 Сбросить", "nav_budget_reset")], BACK_ROW])
         
-        await message.answer(text, reply_markup=kb, parse_mode="HTML")
+        await show(event, text, reply_markup=kb, parse_mode="HTML")
 
 @dp.message(F.text == "➕ Создать бюджет")
-async def start_create_budget(message: Message, state: FSMContext):
-    user_id = message.from_user.id
-    await message.answer(
+@dp.callback_query(F.data == "nav_budget_create")
+async def start_create_budget(event: Message | CallbackQuery, state: FSMContext):
+    user_id = event.from_user.id
+    await state.set_state(Form.budget_category)
+    await show(
+        event,
         "Выберите категорию для бюджета:",
-        reply_markup=await get_categories_kb(user_id, "budget")
+        reply_markup=with_back_row(await get_categories_kb(user_id, "budget"), CANCEL_ROW)
     )
-    await state.set_state(Form.budget_category)
 
 @dp.callback_query(Form.budget_category, F.data.startswith("budget_cat_"))
 async def select_budget_category(callback: CallbackQuery, state: FSMContext):
     category_id = int(callback.data.split("_")[2])
     await state.update_data(category_id=category_id)
     
-    kb = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="День"), KeyboardButton(text="Неделя")],
-            [KeyboardButton(text="Месяц"), KeyboardButton(text="Год")],
-            [KeyboardButton(text="❌ Отмена")]
-        ],
-        resize_keyboard=True
-    )
+    kb = menu_kb([
+        [("День", "budget_period_день"), ("Неделя", "budget_period_неделя")],
+        [("Месяц", "budget_period_месяц"), ("Год", "budget_period_год")],
+        CANCEL_ROW
+    ])
     
-    await callback.message.answer(
+    await state.set_state(Form.budget_period)
+    await show(
+        callback,
         "Выберите период для бюджета:",
         reply_markup=kb
     )
-    await state.set_state(Form.budget_period)
-    await callback.answer()
 
 @dp.message(Form.budget_period)
-async def process_budget_period(message: Message, state: FSMContext):
-    period = message.text.lower()
+@dp.callback_query(Form.budget_period, F.data.startswith("budget_period_"))
+async def process_budget_period(event: Message | CallbackQuery, state: FSMContext):
+    period = event.text.lower() if isinstance(event, Message) else event.data[len("budget_period_"):]
     if period not in ["день", "неделя", "месяц", "год"]:
-        await message.answer("Пожалуйста, выберите период из предложенных вариантов")
+        await show(event, "Пожалуйста, выберите период из предложенных вариантов")
         return
     
     await state.update_data(period=period)
-    await message.answer("Введите сумму бюджета:", reply_markup=get_cancel_kb())
     await state.set_state(Form.budget_amount)
+    await show(event, "Введите сумму бюджета:", reply_markup=get_cancel_kb())
 
 @dp.message(Form.budget_amount)
 async def process_budget_amount(message: Message, state: FSMContext):
@@ -653,19 +934,21 @@ async def process_budget_amount(message: Message, state: FSMContext):
         
         data = await state.get_data()
         
-        with SessionLocal() as session:
+        async with AsyncSessionLocal() as session:
             # Проверяем, не существует ли уже бюджет для этой категории и периода
-            existing = session.query(Budget).filter_by(
+            existing = await session.scalar(select(Budget).filter_by(
                 user_id=message.from_user.id,
                 category_id=data['category_id'],
                 period=data['period']
-            ).first()
+            ))
             
             if existing:
-                existing.amount = amount
-                existing.current_spent = 0
-                existing.start_date = datetime.now()
-                session.commit()
+                budget = existing
+                budget.amount = amount
+                budget.current_spent = 0
+                budget.alert_level = 0
+                budget.start_date = datetime.now()
+                await session.commit()
                 action = "обновлен"
             else:
                 budget = Budget(
@@ -677,17 +960,20 @@ async def process_budget_amount(message: Message, state: FSMContext):
                     start_date=datetime.now()
                 )
                 session.add(budget)
-                session.commit()
+                await session.commit()
                 action = "создан"
+            budget_scheduler.schedule(budget.id, budget.period, budget.start_date)
+            budget_index.invalidate(message.from_user.id)
             
-            category = session.get(Category, data['category_id'])
-            
-            await message.answer(
-                f"✅ Бюджет для категории <b>«{category.name}»</b> {action}!\n"
-                f"Лимит: {amount:.2f} ₽ ({data['period']})",
-                reply_markup=get_main_kb(),
-                parse_mode="HTML"
-            )
+            category = await session.get(Category, data['category_id'])
+        
+        await show(
+            message,
+            f"✅ Бюджет для категории <b>«{category.name}»</b> {action}!\n"
+            f"Лимит: {amount:.2f} ₽ ({data['period']})",
+            reply_markup=get_main_kb(),
+            parse_mode="HTML"
+        )
         
         await state.clear()
     
@@ -695,97 +981,307 @@ async def process_budget_amount(message: Message, state: FSMContext):
         await message.answer("Пожалуйста, введите корректную сумму (число больше 0):", reply_markup=get_cancel_kb())
 
 @dp.message(F.text == "🔄 Сбросить")
-async def reset_budgets(message: Message):
-    with SessionLocal() as session:
-        budgets = session.query(Budget).filter_by(user_id=message.from_user.id).all()
-        
-        if not budgets:
-            await message.answer("У вас нет бюджетов для сброса", reply_markup=get_main_kb())
-            return
+@dp.callback_query(F.data == "nav_budget_reset")
+async def reset_budgets(event: Message | CallbackQuery):
+    async with AsyncSessionLocal() as session:
+        budgets = (await session.scalars(select(Budget).filter_by(user_id=event.from_user.id))).all()
         
         for budget in budgets:
             budget.current_spent = 0
+            budget.alert_level = 0
             budget.start_date = datetime.now()
         
-        session.commit()
+        await session.commit()
     
-    await message.answer(
+    for budget in budgets:
+        budget_scheduler.schedule(budget.id, budget.period, budget.start_date)
+    budget_index.invalidate(event.from_user.id)
+    
+    if not budgets:
+        await show(event, "У вас нет бюджетов для сброса", reply_markup=get_main_kb())
+        return
+    
+    await show(
+        event,
         "✅ Все бюджеты сброшены (текущие траты обнулены, период начат заново)",
         reply_markup=get_main_kb()
     )
 
-# Обновим обработчик транзакций для проверки бюджета
+# =====================
+# ИМПОРТ ВЫПИСКИ
+# =====================
+
+importing_users = set()  # Один импорт на пользователя одновременно
+
+@dp.message(F.document)
+async def import_csv(message: Message):
+    document = message.document
+    if not (document.file_name or "").lower().endswith(".csv"):
+        await message.answer("Для импорта пришлите выписку в формате CSV", reply_markup=get_main_kb())
+        return
+    if document.file_size and document.file_size > Config.IMPORT_MAX_FILE_SIZE:
+        await message.answer(
+            f"Файл слишком большой (больше {Config.IMPORT_MAX_FILE_SIZE // (1024 * 1024)} МБ)",
+            reply_markup=get_main_kb()
+        )
+        return
+    user_id = message.from_user.id
+    if user_id in importing_users:
+        await message.answer("Предыдущий импорт еще не закончен", reply_markup=get_main_kb())
+        return
+    
+    importing_users.add(user_id)
+    status = await message.answer("📥 Загружаю выписку...")
+    progress_edit = None
+    last_progress = 0.0
+    
+    def on_progress(processed: int):
+        # Статус обновляется в фоне: запись в БД не ждет ответа Telegram
+        nonlocal progress_edit, last_progress
+        now = asyncio.get_running_loop().time()
+        if now - last_progress < Config.IMPORT_PROGRESS_INTERVAL or (progress_edit and not progress_edit.done()):
+            return
+        last_progress = now
+        progress_edit = asyncio.create_task(bot(status.edit_text(f"📥 Обработано строк: {processed}")))
+    
+    try:
+        # Файл скачивается на диск и читается потоком, в память целиком не попадает
+        with tempfile.TemporaryFile() as raw:
+            await bot.download(document, destination=raw)
+            text = open_statement(raw)
+            result = await import_statement(
+                AsyncSessionLocal, user_id,
+                parse_statement(text, Config.IMPORT_DEFAULT_CATEGORY),
+                Config.IMPORT_BATCH_SIZE,
+                on_progress
+            )
+    except StatementError as e:
+        await status.edit_text(f"❌ Не удалось разобрать выписку: {e}")
+        return
+    except Exception as e:
+        logger.error(f"Ошибка импорта выписки: {e}")
+        await status.edit_text("❌ Ошибка при импорте выписки, ничего не сохранено")
+        return
+    finally:
+        importing_users.discard(user_id)
+        # Пачки видны до конца импорта и при сбое откатываются: кэши сбрасываем в любом случае
+        invalidate_categories_kb(user_id)
+        budget_index.invalidate(user_id)
+        spending_analytics.invalidate(user_id)
+        if progress_edit:
+            await asyncio.gather(progress_edit, return_exceptions=True)
+    
+    lines = [
+        "✅ Импорт завершен",
+        f"Загружено операций: {result.imported}",
+        f"Создано категорий: {result.categories_created}",
+    ]
+    if result.skipped:
+        lines.append(
+            f"Пропущено строк: {result.skipped} "
+            f"(например: {', '.join(map(str, result.bad_lines))})"
+        )
+    await status.edit_text("\n".join(lines))
+
+# =====================
+# ВЫГРУЗКА ИСТОРИИ
+# =====================
+
+# Выгрузки читают через общий пул чтения: ограничиваем их число,
+# чтобы меню и отчеты всегда находили свободное соединение
+export_semaphore = asyncio.Semaphore(Config.EXPORT_MAX_CONCURRENCY)
+exporting_users = set()
+
+@dp.message(Command("export"))
+async def export_csv(message: Message):
+    user_id = message.from_user.id
+    if user_id in exporting_users:
+        await message.answer("Выгрузка уже готовится", reply_markup=get_main_kb())
+        return
+    
+    exporting_users.add(user_id)
+    try:
+        if export_semaphore.locked():
+            await message.answer("⏳ Выгрузка поставлена в очередь")
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, f"transactions_{datetime.now():%Y%m%d}.csv")
+            async with export_semaphore:
+                rows = await export_transactions(AsyncReadSessionLocal, user_id, path, Config.EXPORT_CHUNK_SIZE)
+            if not rows:
+                await message.answer("У вас пока нет операций для выгрузки", reply_markup=get_main_kb())
+                return
+            await message.answer_document(
+                FSInputFile(path),
+                caption=f"📤 Операций в выгрузке: {rows}",
+                reply_markup=get_main_kb()
+            )
+    except Exception as e:
+        logger.error(f"Ошибка выгрузки истории: {e}")
+        await message.answer("❌ Ошибка при выгрузке истории", reply_markup=get_main_kb())
+    finally:
+        exporting_users.discard(user_id)
+
+async def save_transaction(user_id: int, category_id: int, amount: float, is_income: bool) -> str:
+    """Сохраняет транзакцию с проверкой бюджетов; возвращает текст ответа"""
+    # Бюджеты пользователя по категории берутся из индекса в памяти
+    budgets = [] if is_income else await budget_index.for_category(user_id, category_id)
+    alerts = []
+    for budget in budgets:
+        level = charge(budget, amount, Config.BUDGET_ALERT_PERCENT)
+        if level:
+            alerts.append((budget, level))
+    
+    async def save(session):
+        transaction = Transaction(
+            user_id=user_id,
+            amount=amount,
+            category_id=category_id,
+            is_income=is_income,
+            created_at=datetime.now()
+        )
+        await add_transaction(session, transaction)
+        for budget in budgets:
+            await session.execute(update(Budget).where(Budget.id == budget.id).values(
+                current_spent=Budget.current_spent + amount,
+                alert_level=stored_alert_level(amount, Config.BUDGET_ALERT_PERCENT)
+            ))
+    
+    # Ответ отправляется только после того, как запись зафиксирована
+    try:
+        await writer.submit(save)
+    except Exception:
+        budget_index.invalidate(user_id)  # Траты в индексе уже увеличены - перечитаем из БД
+        raise
+    if not is_income:
+        spending_analytics.invalidate(user_id)
+    
+    response = [
+        f"✅ {'Доход' if is_income else 'Расход'} {amount} ₽ сохранен!"
+    ]
+    
+    for budget, level in alerts:
+        remaining = budget.amount - budget.current_spent
+        if level == ALERT_EXCEEDED:
+            response.append(
+                f"⚠️ Превышен бюджет для категории {budget.category_name}!\n"
+                f"Лимит: {budget.amount:.2f} ₽ ({budget.period})\n"
+                f"Потрачено: {budget.current_spent:.2f} ₽\n"
+                f"Превышение: {abs(remaining):.2f} ₽"
+            )
+        else:
+            response.append(
+                f"🔔 Бюджет категории {budget.category_name} почти исчерпан\n"
+                f"Лимит: {budget.amount:.2f} ₽ ({budget.period})\n"
+                f"Потрачено: {budget.current_spent:.2f} ₽\n"
+                f"Остаток: {remaining:.2f} ₽"
+            )
+    return "\n".join(response)
+
+# Сохранение транзакции с проверкой бюджета
 @dp.callback_query(Form.category, F.data.startswith("transaction_cat_"))
 async def select_category(callback: CallbackQuery, state: FSMContext):
     try:
         category_id = int(callback.data.split("_")[2])
         data = await state.get_data()
-        
-        with SessionLocal() as session:
-            transaction = Transaction(
-                user_id=callback.from_user.id,
-                amount=data['amount'],
-                category_id=category_id,
-                is_income=data['transaction_type'] == 'income',
-                created_at=datetime.now()
-            )
-            
-            if not data['transaction_type'] == 'income':
-                budgets = session.query(Budget).filter_by(category_id=category_id).all()
-                budget_warnings = []
-                
-                for budget in budgets:
-                    budget.current_spent += data['amount']
-                    remaining = budget.amount - budget.current_spent
-                    
-                    if remaining < 0:
-                        budget_warnings.append(
-                            f"⚠️ Превышен бюджет для категории {budget.category.name}!\n"
-                            f"Лимит: {budget.amount:.2f} ₽ ({budget.period})\n"
-                            f"Потрачено: {budget.current_spent:.2f} ₽\n"
-                            f"Превышение: {abs(remaining):.2f} ₽"
-                        )
-                
-                session.add(transaction)
-                session.commit()
-                
-                response = [
-                    f"✅ {'Доход' if data['transaction_type'] == 'income' else 'Расход'} {data['amount']} ₽ сохранен!"
-                ]
-                
-                if budget_warnings:
-                    response.append("\n".join(budget_warnings))
-                
-                await callback.message.answer(
-                    "\n".join(response),
-                    reply_markup=get_main_kb()
-                )
-            else:
-                session.add(transaction)
-                session.commit()
-                await callback.message.answer(
-                    f"✅ {'Доход' if data['transaction_type'] == 'income' else 'Расход'} {data['amount']} ₽ сохранен!",
-                    reply_markup=get_main_kb()
-                )
+        response = await save_transaction(
+            callback.from_user.id, category_id, data['amount'], data['transaction_type'] == 'income'
+        )
+        await state.clear()
+        await show(callback, response, reply_markup=get_main_kb())
                 
     except Exception as e:
         logger.error(f"Ошибка сохранения транзакции: {e}")
-        await callback.message.answer(
+        await state.clear()
+        await show(
+            callback,
             "❌ Ошибка при сохранении транзакции",
             reply_markup=get_main_kb()
         )
-    finally:
-        await state.clear()
+
+# Быстрый ввод одним сообщением: «-450 кофе», «+50000 зарплата»
+@dp.message(StateFilter(None, Form.report_period), F.text.regexp(quick_entry.QUICK_ENTRY_RE))
+async def quick_transaction(message: Message, state: FSMContext):
+    entry = quick_entry.parse(message.text)
+    if entry is None:
+        await message.answer("Введите корректную сумму (число больше 0), например: -450 кофе", reply_markup=get_main_kb())
+        return
+    user_id = message.from_user.id
+    index = await get_category_index(user_id)
+    category, candidates = index.match(entry.category, Config.QUICK_ENTRY_MATCH_CUTOFF)
+    
+    if category is None:
+        # Неоднозначно: обычный сценарий с уже введенной суммой, категория - кнопкой
+        await state.update_data(transaction_type="income" if entry.is_income else "expense", amount=entry.amount)
+        await state.set_state(Form.category)
+        if candidates:
+            text, markup = "Уточните категорию:", build_categories_kb(candidates, "transaction")
+        elif entry.category:
+            text, markup = f"Категория «{entry.category}» не найдена, выберите:", await get_categories_kb(user_id, "transaction")
+        else:
+            text, markup = "Выберите категорию:", await get_categories_kb(user_id, "transaction")
+        await show(message, text, reply_markup=with_back_row(markup, CANCEL_ROW))
+        return
+    
+    try:
+        response = await save_transaction(user_id, category.id, entry.amount, entry.is_income)
+        if await state.get_state() is not None:
+            await state.clear()  # Клавиатура периодов отчета сменяется главной
+        await show(message, f"{response}\nКатегория: {category.name}", reply_markup=get_main_kb())
+    except Exception as e:
+        logger.error(f"Ошибка сохранения транзакции: {e}")
+        await message.answer("❌ Ошибка при сохранении транзакции", reply_markup=get_main_kb())
 
 # =====================
 # ЗАПУСК БОТА
 # =====================
 
+async def log_cache_stats():
+    while True:
+        await asyncio.sleep(Config.CACHE_STATS_INTERVAL)
+        for name, stats in all_stats().items():
+            logger.info(
+                f"Кэш {name}: {stats['hits']} попаданий, {stats['misses']} промахов "
+                f"({stats['hit_rate']:.1%}), записей {stats['size']}, вытеснено {stats['evictions']}"
+            )
+
+@dp.startup()
+async def on_startup():
+    if chart_renderer:
+        chart_renderer.start()  # До первых потоков aiosqlite: воркеры создаются через fork
+    recovered = await recover_imports(AsyncSessionLocal)
+    if recovered:
+        logger.warning(f"Откачено незавершенных импортов выписки: {recovered}")
+    await writer.start()
+    if isinstance(storage, SQLiteStorage):
+        await storage.start()
+    await budget_scheduler.start()
+    if metrics_server:
+        await metrics_server.start()
+
+@dp.shutdown()
+async def on_shutdown():
+    if metrics_server:
+        await metrics_server.stop()
+    await budget_scheduler.stop()
+    await writer.stop()
+    await storage.close()
+    if chart_renderer:
+        chart_renderer.close()
+    await outbound.close(Config.OUTBOUND_DRAIN_TIMEOUT)
+
 async def main():
     logger.info("Бот запущен")
+    stats_task = asyncio.create_task(log_cache_stats()) if Config.CACHE_STATS_INTERVAL > 0 else None
     try:
-        await dp.start_polling(bot)
+        if Config.DELIVERY_MODE == "webhook":
+            await run_webhook(dp, bot)
+        else:
+            await dp.start_polling(bot)
     finally:
+        if stats_task:
+            stats_task.cancel()
+        await async_engine.dispose()
+        await async_read_engine.dispose()
         logger.info("Бот остановлен")
 
 if __name__ == "__main__":
@@ -0,0 +1,107 @@
+"""
+Индекс бюджетов пользователя в памяти для сохранения расходов.
+
+На каждый расход нужно знать бюджеты этой категории у этого пользователя,
+их лимит, текущие траты и уже отправленные уведомления. Индекс загружает
+все бюджеты пользователя одним запросом при первом обращении и дальше
+отвечает без обращения к БД. Траты увеличиваются в индексе сразу, а в БД -
+атомарным UPDATE в той же записи, что и транзакция.
+
+Индекс сбрасывается при создании, изменении и ручном сбросе бюджетов,
+а также когда планировщик начинает новый период.
+
+Уровни уведомлений хранятся в budgets.alert_level, чтобы каждое
+предупреждение отправлялось один раз за период даже после перезапуска.
+"""
+from sqlalchemy import case, func, select
+
+from cache import TTLCache
+from models import Budget, Category
+
+ALERT_NONE = 0
+ALERT_EARLY = 1  # Остаток лимита опустился до BUDGET_ALERT_PERCENT
+ALERT_EXCEEDED = 2  # Лимит превышен
+
+
+class BudgetEntry:
+    """Бюджет в индексе"""
+    __slots__ = ("id", "category_id", "category_name", "amount", "period", "current_spent", "alert_level")
+
+    def __init__(self, id, category_id, category_name, amount, period, current_spent, alert_level):
+        self.id = id
+        self.category_id = category_id
+        self.category_name = category_name
+        self.amount = amount
+        self.period = period
+        self.current_spent = current_spent or 0.0
+        self.alert_level = alert_level or ALERT_NONE
+
+
+def charge(entry: BudgetEntry, amount: float, alert_percent: float):
+    """Прибавляет расход к бюджету; возвращает уровень уведомления, если порог пересечен впервые за период"""
+    entry.current_spent += amount
+    remaining = entry.amount - entry.current_spent
+    if remaining < 0:
+        level = ALERT_EXCEEDED
+    elif remaining <= entry.amount * alert_percent / 100:
+        level = ALERT_EARLY
+    else:
+        level = ALERT_NONE
+    if level > entry.alert_level:
+        entry.alert_level = level
+        return level
+    return None
+
+
+def stored_alert_level(amount: float, alert_percent: float):
+    """Выражение для UPDATE budgets: alert_level после расхода amount, как в charge.
+
+    Уровень считается по тратам в самой строке, а не берется из индекса: пока
+    запись ждет в очереди, планировщик может начать новый период и обнулить
+    alert_level, и уровень прошлого периода подавил бы первые уведомления."""
+    remaining = Budget.amount - (func.coalesce(Budget.current_spent, 0) + amount)
+    level = case(
+        (remaining < 0, ALERT_EXCEEDED),
+        (remaining <= Budget.amount * alert_percent / 100, ALERT_EARLY),
+        else_=ALERT_NONE,
+    )
+    return func.max(func.coalesce(Budget.alert_level, ALERT_NONE), level)
+
+
+class BudgetIndex:
+    """Бюджеты по пользователю и категории, загружаемые лениво"""
+
+    def __init__(self, read_session_factory, cache_size: int, ttl: float):
+        self.read_session_factory = read_session_factory
+        self.cache = TTLCache("budget_index", cache_size, ttl)
+        self._owners = {}  # budget_id -> user_id, для сброса по id бюджета
+
+    async def for_category(self, user_id: int, category_id: int):
+        budgets = self.cache.get(user_id)
+        if budgets is None:
+            budgets = await self._load(user_id)
+            self.cache.set(user_id, budgets)
+        return budgets.get(category_id, [])
+
+    async def _load(self, user_id: int) -> dict:
+        async with self.read_session_factory() as session:
+            rows = (await session.execute(
+                select(
+                    Budget.id, Budget.category_id, Category.name, Budget.amount,
+                    Budget.period, Budget.current_spent, Budget.alert_level
+                ).outerjoin(Category, Category.id == Budget.category_id).filter(Budget.user_id == user_id)
+            )).all()
+        budgets = {}
+        for row in rows:
+            budgets.setdefault(row.category_id, []).append(BudgetEntry(*row))
+            self._owners[row.id] = user_id
+        return budgets
+
+    def invalidate(self, user_id: int):
+        self.cache.pop(user_id)
+
+    def invalidate_budgets(self, budget_ids):
+        for budget_id in budget_ids:
+            user_id = self._owners.get(budget_id)
+            if user_id is not None:
+                self.cache.pop(user_id)
@@ -0,0 +1,80 @@
+"""
+Небольшие in-process кэши бота.
+
+TTLCache - ограниченный по размеру LRU-кэш, записи которого еще и устаревают
+по времени. Каждый кэш регистрируется по имени, чтобы счетчики попаданий
+и промахов можно было снять со всех кэшей сразу (см. all_stats).
+"""
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+# Все созданные кэши по имени
+caches = {}
+
+
+class TTLCache:
+    """LRU-кэш с ограничением размера, временем жизни записей и счетчиками"""
+
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        caches[name] = self
+
+    def get(self, key, default=None):
+        item = self._data.get(key, _MISSING)
+        if item is not _MISSING:
+            expires_at, value = item
+            if expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key):
+        """Удаляет запись (инвалидация), отсутствие ключа не ошибка"""
+        self._data.pop(key, None)
+
+    def expire(self) -> int:
+        """Удаляет все устаревшие записи, возвращает их число"""
+        now = time.monotonic()
+        expired = [key for key, (expires_at, _) in self._data.items() if expires_at <= now]
+        for key in expired:
+            del self._data[key]
+        return len(expired)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def all_stats() -> dict:
+    """Счетчики всех зарегистрированных кэшей"""
+    return {name: cache.stats() for name, cache in caches.items()}
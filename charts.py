@@ -0,0 +1,119 @@
+"""
+Графики к отчетам в PNG: расходы по категориям (круговая и столбчатая
+диаграммы) и доходы/расходы по месяцам.
+
+Рисование matplotlib - это десятки и сотни миллисекунд CPU на график,
+поэтому оно идет в отдельных процессах (ProcessPoolExecutor), и event loop
+в это время обслуживает других пользователей. Пул создается при старте
+бота, до того как у процесса появятся потоки aiosqlite, и сразу прогревает
+воркеры импортом matplotlib.
+
+Готовые графики кэшируются по (пользователь, вид, период, отпечаток
+данных). Пока новых транзакций нет, данные и отпечаток те же, и повторное
+нажатие обходится без перерисовки. Одинаковые графики, запрошенные
+одновременно, рисуются один раз.
+"""
+import asyncio
+import hashlib
+import importlib.util
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from cache import TTLCache
+
+# Вид графика -> (кнопка, заголовок)
+KINDS = {
+    "pie": ("🥧 Круговая", "Расходы по категориям"),
+    "bar": ("📊 По категориям", "Расходы по категориям"),
+    "trend": ("📈 По месяцам", "Доходы и расходы по месяцам"),
+}
+TOP_CATEGORIES = 8  # Остальные категории на круговой диаграмме - «Другое»
+
+
+def available() -> bool:
+    return importlib.util.find_spec("matplotlib") is not None
+
+
+def fingerprint(data) -> str:
+    """Отпечаток данных графика: меняется вместе с любой суммой"""
+    return hashlib.sha1(repr(data).encode()).hexdigest()
+
+
+def _warm_up():
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot  # noqa: F401
+
+
+def render(kind: str, title: str, data) -> bytes:
+    """
+    Рисует график и возвращает PNG. Выполняется в процессе пула.
+    pie и bar: [(категория, сумма), ...] по убыванию суммы;
+    trend: [(месяц 'ГГГГ-ММ', доходы, расходы), ...] по возрастанию месяца.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(8, 5))
+    try:
+        if kind == "pie":
+            if len(data) > TOP_CATEGORIES:
+                data = data[:TOP_CATEGORIES - 1] + [("Другое", sum(total for _, total in data[TOP_CATEGORIES - 1:]))]
+            ax.pie([total for _, total in data], labels=[name for name, _ in data], autopct="%1.0f%%", startangle=90)
+            ax.axis("equal")
+        elif kind == "bar":
+            names = [name for name, _ in data][::-1]
+            ax.barh(names, [total for _, total in data][::-1], color="tab:red")
+            ax.set_xlabel("₽")
+        elif kind == "trend":
+            months = [month for month, _, _ in data]
+            positions = range(len(months))
+            ax.bar([p - 0.2 for p in positions], [income for _, income, _ in data], width=0.4, label="Доходы", color="tab:green")
+            ax.bar([p + 0.2 for p in positions], [expense for _, _, expense in data], width=0.4, label="Расходы", color="tab:red")
+            ax.set_xticks(list(positions), months, rotation=45, ha="right")
+            ax.set_ylabel("₽")
+            ax.legend()
+        else:
+            raise ValueError(f"Неизвестный вид графика: {kind}")
+        ax.set_title(title)
+        fig.tight_layout()
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format="png", dpi=100)
+        return buffer.getvalue()
+    finally:
+        plt.close(fig)
+
+
+class ChartRenderer:
+    """Пул процессов для рисования и кэш готовых графиков"""
+
+    def __init__(self, workers: int, cache_size: int, ttl: float):
+        self.workers = workers
+        # Значение - то, что можно отправить повторно (file_id уже загруженного фото)
+        self.cache = TTLCache("charts", cache_size, ttl)
+        self.rendered = 0
+        self._pool = None
+        self._inflight = {}
+
+    def start(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("fork"))
+            self._pool.submit(_warm_up)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def render(self, kind: str, title: str, data) -> bytes:
+        key = (kind, title, fingerprint(data))
+        future = self._inflight.get(key)
+        if future is None:
+            self.start()
+            future = asyncio.get_running_loop().run_in_executor(self._pool, render, kind, title, data)
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+            self.rendered += 1
+        return await asyncio.shield(future)
@@ -8,9 +8,147 @@ class Config:
     BOT_TOKEN = os.getenv("BOT_TOKEN")
     if not BOT_TOKEN:
         raise ValueError("Не указан BOT_TOKEN в .env файле")
+    # Адрес Bot API; пусто - api.telegram.org (для тестов - локальный сервер, см. benchmarks/fake_bot_api.py)
+    BOT_API_URL = os.getenv("BOT_API_URL", "")
+
+    # Шардирование (см. sharding.py): фронт раздает обновления SHARD_COUNT процессам-воркерам,
+    # у каждого свой файл базы. SHARD_ID задает фронт процессу воркера, вручную - для manage.py
+    SHARD_COUNT = int(os.getenv("SHARD_COUNT", os.cpu_count() or 1))  # воркеров при запуске через sharding.py
+    SHARD_ID = int(os.environ["SHARD_ID"]) if os.getenv("SHARD_ID") else None
+    SHARD_DB_URL = os.getenv("SHARD_DB_URL", "sqlite:///finance_shard{shard}.db")  # {shard} - номер шарда
+    SHARD_MAP_PATH = os.getenv("SHARD_MAP_PATH", "shards.db")  # файл SQLite с закреплением пользователей за шардами
+    SHARD_MAP_REFRESH = float(os.getenv("SHARD_MAP_REFRESH", 1))  # секунд между проверками карты шардов
+    SHARD_WORKER_HOST = os.getenv("SHARD_WORKER_HOST", "127.0.0.1")
+    SHARD_WORKER_PORT = int(os.getenv("SHARD_WORKER_PORT", 8100))  # воркер N слушает порт SHARD_WORKER_PORT + N
+    SHARD_MAX_CONCURRENCY = int(os.getenv("SHARD_MAX_CONCURRENCY", 256))  # обновлений одновременно в воркерах
+    SHARD_MAX_PENDING = int(os.getenv("SHARD_MAX_PENDING", 5000))  # в обработке и очередях фронта
+    SHARD_MOVE_TIMEOUT = float(os.getenv("SHARD_MOVE_TIMEOUT", 30))  # секунд ждать, пока фронт придержит пользователя
+    SHARD_MOVE_COOLDOWN = int(os.getenv("SHARD_MOVE_COOLDOWN", 3600))  # секунд до возврата пользователя на прежний шард
+    SHARD_RESYNC_INTERVAL = int(os.getenv("SHARD_RESYNC_INTERVAL", 60))  # секунд между сверками расписания бюджетов
 
     # Настройки базы данных
-    DB_URL = "sqlite:///finance.db"  # Путь к SQLite базе данных
+    if SHARD_ID is None:
+        DB_URL = os.getenv("DB_URL", "sqlite:///finance.db")  # Путь к SQLite базе данных
+        # Асинхронный драйвер для обработчиков бота (по умолчанию тот же файл через aiosqlite)
+        ASYNC_DB_URL = os.getenv("ASYNC_DB_URL", DB_URL.replace("sqlite://", "sqlite+aiosqlite://", 1))
+    else:
+        # База шарда задается только шаблоном: DB_URL из .env указывал бы всем воркерам на один файл
+        DB_URL = SHARD_DB_URL.format(shard=SHARD_ID)
+        ASYNC_DB_URL = DB_URL.replace("sqlite://", "sqlite+aiosqlite://", 1)
+
+    # Настройки SQLite: прагмы применяются к каждому новому соединению
+    SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL").upper()  # читатели не ждут писателя
+    SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").upper()  # в WAL безопасно и без fsync на каждый commit
+    SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", -65536))  # страниц, отрицательное значение - КиБ (64 МиБ)
+    SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))  # байт, 0 - выключено
+    SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", 5000))  # мс ожидания блокировки
+    SQLITE_READ_POOL_SIZE = int(os.getenv("SQLITE_READ_POOL_SIZE", 4))  # соединений только для чтения
+    if SQLITE_JOURNAL_MODE not in ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"):
+        raise ValueError(f"Недопустимый SQLITE_JOURNAL_MODE: {SQLITE_JOURNAL_MODE}")
+    if SQLITE_SYNCHRONOUS not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+        raise ValueError(f"Недопустимый SQLITE_SYNCHRONOUS: {SQLITE_SYNCHRONOUS}")
+
+    # Способ получения обновлений: "polling" или "webhook"
+    DELIVERY_MODE = os.getenv("DELIVERY_MODE", "polling")
+    if DELIVERY_MODE not in ("polling", "webhook"):
+        raise ValueError(f"Недопустимый DELIVERY_MODE: {DELIVERY_MODE}")
+    WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+    WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+    WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+    WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Публичный адрес для set_webhook; пусто - не регистрировать
+    WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # Проверка заголовка X-Telegram-Bot-Api-Secret-Token
+    WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", 100))  # одновременно обрабатываемых обновлений
+    WEBHOOK_MAX_PENDING = int(os.getenv("WEBHOOK_MAX_PENDING", 1000))  # сверх этого - 503
+    WEBHOOK_SHUTDOWN_TIMEOUT = float(os.getenv("WEBHOOK_SHUTDOWN_TIMEOUT", 10))  # секунд на завершение начатых
+
+    # Навигация по меню: "reply" (клавиатура под полем ввода, каждый экран - новое
+    # сообщение) или "inline" (экран меню - одно сообщение, которое правится на месте)
+    NAVIGATION_MODE = os.getenv("NAVIGATION_MODE", "reply")
+    if NAVIGATION_MODE not in ("reply", "inline"):
+        raise ValueError(f"Недопустимый NAVIGATION_MODE: {NAVIGATION_MODE}")
+    SCREEN_CACHE_SIZE = int(os.getenv("SCREEN_CACHE_SIZE", 50000))  # чатов с запомненным экраном
+    SCREEN_CACHE_TTL = int(os.getenv("SCREEN_CACHE_TTL", 24 * 60 * 60))  # секунд
+
+    # Хранилище состояний FSM: "sqlite" (переживает перезапуск) или "memory"
+    FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")
+    FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", 24 * 60 * 60))  # секунд простоя до сброса сценария
+    FSM_SWEEP_INTERVAL = int(os.getenv("FSM_SWEEP_INTERVAL", 600))  # период очистки брошенных сценариев
+    FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", 50000))  # ключей в кэше
+
+    # Планировщик сброса бюджетов: максимальный сон между проверками, секунд
+    BUDGET_SCHEDULER_MAX_SLEEP = int(os.getenv("BUDGET_SCHEDULER_MAX_SLEEP", 300))
     
     # Другие настройки
-    BUDGET_ALERT_PERCENT = 20  # Процент для уведомлений
\ No newline at end of file
+    BUDGET_ALERT_PERCENT = 20  # Процент для уведомлений: предупредить, когда остаток лимита опустился до него
+    BUDGET_INDEX_SIZE = int(os.getenv("BUDGET_INDEX_SIZE", 10000))  # пользователей в индексе бюджетов
+    BUDGET_INDEX_TTL = int(os.getenv("BUDGET_INDEX_TTL", 3600))  # секунд до перечитывания из БД
+
+    # Цели накопления: сводки журнала пополнений для прогноза в меню
+    SAVINGS_SUMMARY_CACHE_SIZE = int(os.getenv("SAVINGS_SUMMARY_CACHE_SIZE", 10000))  # пользователей
+    SAVINGS_SUMMARY_CACHE_TTL = int(os.getenv("SAVINGS_SUMMARY_CACHE_TTL", 3600))  # секунд
+    SAVINGS_MIN_PACE_DAYS = int(os.getenv("SAVINGS_MIN_PACE_DAYS", 7))  # дней истории до первого прогноза
+
+    # Кэш клавиатур категорий: (user_id, action) -> разметка; и индекс категорий для быстрого ввода
+    CATEGORY_CACHE_SIZE = int(os.getenv("CATEGORY_CACHE_SIZE", 10000))
+    CATEGORY_CACHE_TTL = int(os.getenv("CATEGORY_CACHE_TTL", 600))  # секунд
+    # Быстрый ввод: минимальная похожесть названия категории (difflib, 0..1)
+    QUICK_ENTRY_MATCH_CUTOFF = float(os.getenv("QUICK_ENTRY_MATCH_CUTOFF", 0.75))
+    CACHE_STATS_INTERVAL = int(os.getenv("CACHE_STATS_INTERVAL", 600))  # период логирования счетчиков, 0 - выкл
+
+    # Групповой commit записей транзакций (write-behind)
+    WRITE_PIPELINE_ENABLED = os.getenv("WRITE_PIPELINE_ENABLED", "0") == "1"
+    WRITE_BATCH_INTERVAL = float(os.getenv("WRITE_BATCH_INTERVAL", 0.02))  # секунд ожидания пачки
+    WRITE_BATCH_MAX = int(os.getenv("WRITE_BATCH_MAX", 100))  # записей в одном commit
+
+    # Импорт выписок CSV
+    IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", 5000))  # строк в одном executemany
+    IMPORT_MAX_FILE_SIZE = int(os.getenv("IMPORT_MAX_FILE_SIZE", 20 * 1024 * 1024))  # байт, лимит Bot API на скачивание
+    IMPORT_PROGRESS_INTERVAL = float(os.getenv("IMPORT_PROGRESS_INTERVAL", 2))  # секунд между обновлениями статуса
+    IMPORT_DEFAULT_CATEGORY = os.getenv("IMPORT_DEFAULT_CATEGORY", "Прочее")  # для строк без категории
+
+    # Выгрузка истории в CSV
+    EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 1000))  # строк за одну выборку курсора
+    EXPORT_MAX_CONCURRENCY = int(os.getenv("EXPORT_MAX_CONCURRENCY", 1))  # одновременных выгрузок, меньше SQLITE_READ_POOL_SIZE
+
+    # Архив закрытых лет: транзакции года переносятся в отдельный файл SQLite
+    ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")  # каталог файлов transactions_<год>.db
+    if SHARD_ID is not None:
+        ARCHIVE_DIR = os.path.join(ARCHIVE_DIR, f"shard{SHARD_ID}")
+    ARCHIVE_HOT_MONTHS = int(os.getenv("ARCHIVE_HOT_MONTHS", 12))  # последние месяцы всегда остаются в основной базе
+    if ARCHIVE_HOT_MONTHS < 12:
+        raise ValueError("ARCHIVE_HOT_MONTHS меньше 12: отчет «За год» читает дневные сводки")
+
+    # История операций категории: операций на странице
+    HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", 10))
+
+    # Графики к отчетам (нужен matplotlib)
+    CHARTS_ENABLED = os.getenv("CHARTS_ENABLED", "1") == "1"
+    CHART_WORKERS = int(os.getenv("CHART_WORKERS", 1))  # процессов для рисования
+    CHART_CACHE_SIZE = int(os.getenv("CHART_CACHE_SIZE", 1000))  # готовых графиков в кэше
+    CHART_CACHE_TTL = int(os.getenv("CHART_CACHE_TTL", 24 * 60 * 60))  # секунд
+
+    # Аналитика расходов (/analytics, нужен numpy)
+    ANALYTICS_CACHE_SIZE = int(os.getenv("ANALYTICS_CACHE_SIZE", 1000))  # пользователей с историей в памяти
+    ANALYTICS_CACHE_TTL = int(os.getenv("ANALYTICS_CACHE_TTL", 3600))  # секунд
+    ANALYTICS_ANOMALY_DAYS = int(os.getenv("ANALYTICS_ANOMALY_DAYS", 30))  # за сколько последних дней искать необычные траты
+    ANALYTICS_ANOMALY_THRESHOLD = float(os.getenv("ANALYTICS_ANOMALY_THRESHOLD", 3.5))  # робастных отклонений от медианы
+    ANALYTICS_MIN_HISTORY = int(os.getenv("ANALYTICS_MIN_HISTORY", 10))  # дней трат в категории, чтобы судить о необычном
+
+    # Метрики обработки обновлений (Prometheus /metrics и список медленных /slow)
+    METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+    METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")  # только локально
+    METRICS_PORT = int(os.getenv("METRICS_PORT", 9101))
+    SLOW_UPDATE_THRESHOLD = float(os.getenv("SLOW_UPDATE_THRESHOLD", 1.0))  # секунд, медленнее - в лог
+    SLOW_UPDATE_KEEP = int(os.getenv("SLOW_UPDATE_KEEP", 20))  # худших обновлений на /slow
+
+    # Очередь исходящих сообщений: ограничения Telegram на отправку
+    OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", 30))  # сообщений в секунду на бота
+    OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", 1))  # сообщений в секунду в один чат
+    OUTBOUND_CHAT_BURST = float(os.getenv("OUTBOUND_CHAT_BURST", 3))  # столько можно отправить в чат подряд
+    OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", 5))  # повторов после 429
+    OUTBOUND_DRAIN_TIMEOUT = float(os.getenv("OUTBOUND_DRAIN_TIMEOUT", 5))  # секунд на досылку при остановке
+
+    # Параллельная обработка обновлений: разные пользователи одновременно, один пользователь - по порядку
+    UPDATE_MAX_CONCURRENCY = int(os.getenv("UPDATE_MAX_CONCURRENCY", 64))  # обновлений в обработке одновременно
+    UPDATE_USER_QUEUE = int(os.getenv("UPDATE_USER_QUEUE", 20))  # ожидающих обновлений одного пользователя
+    UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", 1000))  # всего; сверх этого polling ждет
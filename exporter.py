@@ -0,0 +1,147 @@
+"""
+Выгрузка истории транзакций пользователя в CSV.
+
+Строки читаются серверным курсором (yield_per) порциями по EXPORT_CHUNK_SIZE
+и сразу дописываются в файл на диске, поэтому память не зависит от
+длины истории. Формат совпадает с тем, что понимает импорт (importer.py):
+выгруженный файл можно загрузить обратно.
+
+Архивные годы (archive.py) читаются из своих файлов. Все файлы
+подключаются к соединению сессии заранее, и выгрузка читает основную базу
+и архив в одной транзакции. Снимок основной базы берется раньше снимков
+файлов, а из файла читаются только поколения не новее archived_years.gen
+этого снимка: они уже удалены из основной базы, а более новые в ней еще
+есть. Поэтому строка переносимого месяца видна ровно в одном месте. Между
+архивными годами читаются строки основной базы за промежуток до
+следующего архивного года, так что выгрузка идет по дате, даже если
+средний год возвращен из архива.
+
+SQLite подключает к соединению не больше ATTACH_LIMIT баз. Если архивных
+лет больше, файлы подключаются по одному и читаются в разных транзакциях:
+такая выгрузка, совпавшая с manage.py archive, может пропустить строки
+переносимого месяца (об этом пишется предупреждение в лог).
+"""
+import contextlib
+import csv
+import logging
+import os
+
+from datetime import datetime
+
+from sqlalchemy import select, text
+
+import archive
+from models import ArchivedYear, Category, Transaction
+
+logger = logging.getLogger(__name__)
+
+ATTACH_LIMIT = 10  # SQLITE_MAX_ATTACHED сборки SQLite по умолчанию
+HEADER = ("Дата операции", "Категория", "Сумма", "Тип")
+DATE_FORMAT = "%d.%m.%Y %H:%M:%S"
+
+
+def _query(table, user_id: int, chunk_size: int, date_from=None, date_to=None):
+    query = select(
+        table.c.created_at, Category.name, table.c.amount, table.c.is_income
+    ).outerjoin(Category, Category.id == table.c.category_id).filter(table.c.user_id == user_id)
+    if date_from is not None:
+        query = query.filter(table.c.created_at >= date_from)
+    if date_to is not None:
+        query = query.filter(table.c.created_at < date_to)
+    return query.order_by(table.c.created_at).execution_options(yield_per=chunk_size)
+
+
+def _archive_query(user_id: int, chunk_size: int, gen: int, schema: str = archive.SCHEMA):
+    """Строки файла архива, уже удаленные из основной базы (поколения не новее gen)"""
+    table = archive.archived_transactions
+    query = _query(table, user_id, chunk_size).filter(table.c.gen <= gen)
+    return query.execution_options(schema_translate_map={archive.SCHEMA: schema})
+
+
+async def _write(session, writer, query) -> int:
+    rows = 0
+    result = await session.stream(query)
+    async for chunk in result.partitions():
+        writer.writerows(
+            (
+                created_at.strftime(DATE_FORMAT) if created_at else "",
+                name or "",
+                f"{amount:.2f}",
+                "доход" if is_income else "расход",
+            )
+            for created_at, name, amount, is_income in chunk
+        )
+        rows += len(chunk)
+    return rows
+
+
+async def _archived_years(session) -> list:
+    return (await session.execute(
+        select(ArchivedYear.year, ArchivedYear.path, ArchivedYear.gen).order_by(ArchivedYear.year)
+    )).all()
+
+
+def _files(years) -> set:
+    return {(year, archive_file) for year, archive_file, _ in years}
+
+
+async def _write_segments(session, writer, user_id: int, chunk_size: int, years, schemas: dict) -> int:
+    """Основная база между архивными годами и сами годы по порядку дат.
+    schemas: {год: имя подключенного файла}; None - подключать каждый файл на время чтения."""
+    hot = Transaction.__table__
+    rows = 0
+    date_from = None
+    for year, archive_file, gen in years:
+        year_start = datetime(year, 1, 1)
+        rows += await _write(session, writer, _query(hot, user_id, chunk_size, date_from, year_start))
+        date_from = year_start
+        if schemas is not None and year in schemas:
+            rows += await _write(session, writer, _archive_query(user_id, chunk_size, gen, schemas[year]))
+        elif schemas is None and os.path.exists(archive_file):
+            async with archive.attached(session, archive_file):
+                rows += await _write(session, writer, _archive_query(user_id, chunk_size, gen))
+        else:
+            logger.warning(f"Нет файла архива {archive_file}: {year} год не попадет в выгрузку")
+    rows += await _write(session, writer, _query(hot, user_id, chunk_size, date_from))
+    return rows
+
+
+async def export_transactions(read_session_factory, user_id: int, path: str, chunk_size: int) -> int:
+    """Пишет все транзакции пользователя в CSV-файл path, возвращает число строк"""
+    # utf-8-sig и ";" - чтобы файл сразу открывался в Excel
+    with open(path, "w", encoding="utf-8-sig", newline="") as file:
+        writer = csv.writer(file, delimiter=";")
+        writer.writerow(HEADER)
+        async with read_session_factory() as session:
+            years = await _archived_years(session)
+            while len(years) <= ATTACH_LIMIT:
+                schemas = {
+                    year: f"{archive.SCHEMA}_{year}" for year, archive_file, _ in years if os.path.exists(archive_file)
+                }
+                async with contextlib.AsyncExitStack() as stack:
+                    # ATTACH невозможен внутри транзакции: все файлы подключаются до BEGIN
+                    for year, archive_file, _ in years:
+                        if year in schemas:
+                            await stack.enter_async_context(archive.attached(session, archive_file, schemas[year]))
+                    await session.execute(text("BEGIN"))
+                    try:
+                        # Снимки всех баз берутся сразу, основной - первым (см. начало модуля)
+                        for schema in ("main", *schemas.values()):
+                            await session.execute(text(f"SELECT COUNT(*) FROM {schema}.sqlite_master"))
+                        current = await _archived_years(session)
+                        # Поколения берутся из снимка: перенос месяца не требует подключать файлы заново
+                        if _files(current) == _files(years):
+                            return await _write_segments(session, writer, user_id, chunk_size, current, schemas)
+                    finally:
+                        await session.execute(text("COMMIT"))
+                # Пока подключали файлы, архив изменился: подключаем заново. Файл возвращенного
+                # года, удаленный до ATTACH, SQLite создал заново пустым - убираем его
+                for year, archive_file in _files(years) - _files(current):
+                    if os.path.exists(archive_file) and not os.path.getsize(archive_file):
+                        os.remove(archive_file)
+                years = current
+            logger.warning(
+                f"Архивных лет {len(years)} > {ATTACH_LIMIT}: выгрузка читает их по одному, "
+                "строки, переносимые в архив прямо сейчас, могут в нее не попасть"
+            )
+            return await _write_segments(session, writer, user_id, chunk_size, years, None)
@@ -0,0 +1,122 @@
+"""
+Хранилище состояний FSM в SQLite (таблица fsm_states).
+
+Состояние и данные каждого ключа пишутся в базу сразу (write-through),
+поэтому после перезапуска бота незаконченные сценарии продолжаются.
+Чтения обслуживает in-memory кэш: FSM-middleware aiogram спрашивает
+состояние на каждом обновлении, и для пользователей без активного
+сценария кэшируется и сам факт отсутствия записи.
+
+Сценарии, которые простаивают дольше FSM_STATE_TTL, считаются брошенными:
+при чтении они выглядят пустыми, а фоновая очистка удаляет их из базы
+и кэша, так что память и таблица не растут за недели работы.
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import namedtuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from sqlalchemy import text
+
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+FSMRecord = namedtuple("FSMRecord", "state data updated_at")
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище с записью в SQLite и кэшем в памяти"""
+
+    def __init__(self, session_factory, read_session_factory, ttl: float, sweep_interval: float, cache_size: int):
+        self.session_factory = session_factory
+        self.read_session_factory = read_session_factory
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.cache = TTLCache("fsm_states", cache_size, ttl)
+        self._sweeper = None
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(part) if part is not None else "" for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny
+        ))
+
+    def _empty(self) -> FSMRecord:
+        return FSMRecord(None, {}, time.time())
+
+    async def _load(self, key: StorageKey) -> FSMRecord:
+        record = self.cache.get(key)
+        if record is None:
+            async with self.read_session_factory() as session:
+                row = (await session.execute(
+                    text("SELECT state, data, updated_at FROM fsm_states WHERE key = :key"),
+                    {"key": self._key(key)}
+                )).first()
+            record = FSMRecord(row.state, json.loads(row.data), row.updated_at) if row else self._empty()
+            self.cache.set(key, record)
+        if time.time() - record.updated_at > self.ttl:
+            return self._empty()  # Брошенный сценарий, очистка его еще не удалила
+        return record
+
+    async def _save(self, key: StorageKey, state, data: dict):
+        now = time.time()
+        async with self.session_factory() as session:
+            if state is None and not data:
+                await session.execute(text("DELETE FROM fsm_states WHERE key = :key"), {"key": self._key(key)})
+            else:
+                await session.execute(text(
+                    "INSERT INTO fsm_states (key, state, data, updated_at) VALUES (:key, :state, :data, :now) "
+                    "ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, "
+                    "updated_at = excluded.updated_at"
+                ), {"key": self._key(key), "state": state, "data": json.dumps(data, ensure_ascii=False), "now": now})
+            await session.commit()
+        self.cache.set(key, FSMRecord(state, data, now))
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        state = state.state if isinstance(state, State) else state
+        record = await self._load(key)
+        await self._save(key, state, record.data)
+
+    async def get_state(self, key: StorageKey):
+        return (await self._load(key)).state
+
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        record = await self._load(key)
+        await self._save(key, record.state, dict(data))
+
+    async def get_data(self, key: StorageKey) -> dict:
+        return dict((await self._load(key)).data)
+
+    async def sweep(self) -> int:
+        """Удаляет сценарии, простоявшие дольше TTL; возвращает число удаленных"""
+        cutoff = time.time() - self.ttl
+        async with self.session_factory() as session:
+            result = await session.execute(
+                text("DELETE FROM fsm_states WHERE updated_at < :cutoff"), {"cutoff": cutoff}
+            )
+            await session.commit()
+        self.cache.expire()
+        return result.rowcount
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                removed = await self.sweep()
+                if removed:
+                    logger.info(f"Удалено брошенных FSM-сценариев: {removed}")
+            except Exception as e:
+                logger.error(f"Ошибка очистки FSM-хранилища: {e}")
+
+    async def start(self):
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def close(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
@@ -0,0 +1,81 @@
+"""
+Постраничный просмотр операций категории.
+
+Страницы выбираются по ключу (created_at, id), а не через OFFSET: запрос
+следующей страницы - диапазон индекса ix_transactions_category_created
+(в индексе SQLite есть и rowid, то есть id) от последней показанной
+операции, и глубина страницы на его стоимость не влияет. Фильтр по типу
+проверяется на строках диапазона, фильтр по периоду сужает сам диапазон.
+
+Курсор помещается в callback_data кнопки: направление ('o' - старее,
+'n' - новее) и ключ крайней операции страницы, '0' - первая страница.
+"""
+from datetime import datetime
+
+from sqlalchemy import select, tuple_
+
+from models import Transaction
+
+# Фильтр по типу: код в callback_data -> (кнопка, условие is_income; None - все)
+KINDS = {
+    "a": ("Все", None),
+    "i": ("Доходы", True),
+    "e": ("Расходы", False),
+}
+FIRST_PAGE = "0"
+_CURSOR_FORMAT = "%Y%m%d%H%M%S%f"
+
+
+def encode_cursor(direction: str, transaction) -> str:
+    return f"{direction}{transaction.created_at.strftime(_CURSOR_FORMAT)}-{transaction.id}"
+
+
+def decode_cursor(cursor: str):
+    """(направление, created_at, id); для первой страницы (None, None, None)"""
+    if cursor == FIRST_PAGE:
+        return None, None, None
+    moment, transaction_id = cursor[1:].split("-")
+    return cursor[0], datetime.strptime(moment, _CURSOR_FORMAT), int(transaction_id)
+
+
+class Page:
+    def __init__(self, rows, has_newer: bool, has_older: bool):
+        self.rows = rows  # от новых к старым
+        self.has_newer = has_newer
+        self.has_older = has_older
+
+    def newer_cursor(self):
+        return encode_cursor("n", self.rows[0]) if self.has_newer and self.rows else None
+
+    def older_cursor(self):
+        return encode_cursor("o", self.rows[-1]) if self.has_older and self.rows else None
+
+
+async def fetch_page(session, category_id: int, kind: str, date_from: datetime, cursor: str, page_size: int) -> Page:
+    """Одна страница операций категории: один запрос на page_size + 1 строк"""
+    direction, moment, transaction_id = decode_cursor(cursor)
+    key = tuple_(Transaction.created_at, Transaction.id)
+    query = select(Transaction.id, Transaction.amount, Transaction.is_income, Transaction.created_at).filter(
+        Transaction.category_id == category_id,
+        Transaction.created_at >= date_from,
+    )
+    is_income = KINDS[kind][1]
+    if is_income is not None:
+        query = query.filter(Transaction.is_income == is_income)
+
+    if direction == "n":
+        # Страница новее: ближайшие к курсору по возрастанию, затем разворот
+        query = query.filter(key > (moment, transaction_id)).order_by(
+            Transaction.created_at, Transaction.id
+        )
+    else:
+        if direction == "o":
+            query = query.filter(key < (moment, transaction_id))
+        query = query.order_by(Transaction.created_at.desc(), Transaction.id.desc())
+
+    rows = (await session.execute(query.limit(page_size + 1))).all()
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+    if direction == "n":
+        return Page(rows[::-1], has_newer=more, has_older=True)
+    return Page(rows, has_newer=direction == "o", has_older=more)
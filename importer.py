@@ -0,0 +1,343 @@
+"""
+Импорт банковской выписки из CSV.
+
+Файл читается потоком, строка за строкой, и записывается пачками по
+IMPORT_BATCH_SIZE: одна пачка - один executemany в transactions, одно
+обновление дневных сводок и одно обновление бюджетов. Строки разбираются
+в потоке, а соединение писателя берется только на запись пачки, так что
+ручной ввод не ждет конца импорта. Каждая пачка - отдельный commit, поэтому
+до окончания импорта его операции уже видны в отчетах. Транзакции помечены
+import_id: при ошибке (или после остановки бота посреди импорта) записанные
+пачки откатываются, и выписка загружается либо целиком, либо никак.
+В памяти в каждый момент только одна пачка и словарь категорий, так что
+файл в 100 тысяч строк занимает столько же памяти, сколько в тысячу.
+
+Колонки ищутся по заголовку (см. COLUMNS): обязательны дата и сумма,
+категория и тип операции - по возможности. Без колонки типа знак суммы
+определяет расход (минус) или доход. Отсутствующие категории создаются,
+как при ручном вводе; строки без категории попадают в IMPORT_DEFAULT_CATEGORY.
+"""
+import asyncio
+import codecs
+import csv
+import io
+import re
+from datetime import date, datetime
+
+from sqlalchemy import bindparam, delete, func, insert, or_, select, update
+
+from models import Budget, Category, DailyRollup, StatementImport, Transaction
+from rollups import rollup_upsert_many
+
+# Варианты заголовков колонок (в нижнем регистре)
+COLUMNS = {
+    "date": ("дата", "дата операции", "дата платежа", "date"),
+    "amount": ("сумма", "сумма операции", "сумма платежа", "amount"),
+    "category": ("категория", "category"),
+    "type": ("тип", "тип операции", "type"),
+}
+INCOME_TYPES = {"доход", "пополнение", "зачисление", "income"}
+EXPENSE_TYPES = {"расход", "списание", "покупка", "expense"}
+DATE_FORMATS = (
+    "%d.%m.%Y %H:%M:%S", "%d.%m.%Y %H:%M", "%d.%m.%Y",
+    "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d",
+)
+_NOT_NUMBER = re.compile(r"[^\d,.\-+]")
+
+
+class StatementError(ValueError):
+    """Файл нельзя разобрать как выписку"""
+
+
+class ImportResult:
+    def __init__(self):
+        self.imported = 0
+        self.skipped = 0
+        self.bad_lines = []  # Номера первых пропущенных строк, для ответа пользователю
+        self.categories_created = 0
+
+
+def open_statement(binary) -> io.TextIOWrapper:
+    """Открывает загруженный файл как текст: UTF-8 (с BOM или без) или cp1251"""
+    head = binary.read(64 * 1024)
+    binary.seek(0)
+    encoding = "utf-8-sig"
+    try:
+        # Обрезанный на границе блока символ UTF-8 ошибкой не считается
+        codecs.getincrementaldecoder("utf-8-sig")().decode(head)
+    except UnicodeDecodeError:
+        encoding = "cp1251"
+    return io.TextIOWrapper(binary, encoding=encoding, newline="")
+
+
+def _find_columns(header):
+    names = [column.strip().lower() for column in header]
+    found = {}
+    for field, aliases in COLUMNS.items():
+        for index, name in enumerate(names):
+            if name in aliases:
+                found[field] = index
+                break
+    if "date" not in found or "amount" not in found:
+        raise StatementError("Не найдены колонки с датой и суммой")
+    return found
+
+
+def _parse_amount(value: str) -> float:
+    """
+    Сумма в русском или английском формате: «−1 234,56», «1.234,56», «1,234.56».
+    Десятичный разделитель - последний из встретившихся. Неоднозначное
+    («1.234» - тысяча или единица?) не угадывается, а отклоняется.
+    """
+    value = _NOT_NUMBER.sub("", value.replace("\u2212", "-"))  # В выписках банков минус бывает «−»
+    sign, digits = "", value
+    if digits[:1] in ("-", "+"):
+        sign, digits = digits[0], digits[1:]
+    separators = [char for char in digits if char in ",."]
+    if not separators:
+        return float(sign + digits)
+    decimal = separators[-1]
+    thousands = "," if decimal == "." else "."
+    if separators.count(decimal) > 1:
+        # «1.234.567» - только разделители тысяч
+        groups = digits.split(decimal)
+        if thousands in separators or not 1 <= len(groups[0]) <= 3 or any(len(group) != 3 for group in groups[1:]):
+            raise ValueError(f"Неоднозначная сумма: {value!r}")
+        whole, fraction = digits.replace(decimal, ""), ""
+    else:
+        whole, fraction = digits.split(decimal)
+        if thousands in whole:
+            groups = whole.split(thousands)
+            if not 1 <= len(groups[0]) <= 3 or any(len(group) != 3 for group in groups[1:]):
+                raise ValueError(f"Неоднозначная сумма: {value!r}")
+            whole = "".join(groups)
+        elif len(fraction) == 3 and whole.strip("0"):
+            raise ValueError(f"Неоднозначная сумма: {value!r}")
+    if not whole.isdigit() or not (fraction.isdigit() or not fraction):
+        raise ValueError(f"Неверная сумма: {value!r}")
+    return float(f"{sign}{whole}.{fraction or 0}")
+
+
+class _DateParser:
+    """Пробует форматы по очереди, начиная с последнего подошедшего"""
+
+    def __init__(self):
+        self.formats = list(DATE_FORMATS)
+
+    def __call__(self, value: str) -> datetime:
+        value = value.strip()
+        for i, fmt in enumerate(self.formats):
+            try:
+                moment = datetime.strptime(value, fmt)
+            except ValueError:
+                continue
+            if i:
+                self.formats.insert(0, self.formats.pop(i))
+            return moment
+        raise ValueError(f"Неизвестный формат даты: {value!r}")
+
+
+def parse_statement(text, default_category: str):
+    """
+    Генератор строк выписки: (номер строки, (дата, сумма, доход?, категория))
+    или (номер строки, None), если строку разобрать не удалось.
+    """
+    sample = text.read(4096)
+    text.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=";,\t")
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.reader(text, dialect)
+    header = next(reader, None)
+    if not header:
+        raise StatementError("Файл пуст")
+    columns = _find_columns(header)
+    parse_date = _DateParser()
+
+    for row in reader:
+        if not any(cell.strip() for cell in row):
+            continue
+        try:
+            created_at = parse_date(row[columns["date"]])
+            amount = _parse_amount(row[columns["amount"]])
+            kind = row[columns["type"]].strip().lower() if "type" in columns else ""
+            if kind in INCOME_TYPES:
+                is_income = True
+            elif kind in EXPENSE_TYPES:
+                is_income = False
+            else:
+                is_income = amount > 0
+            amount = abs(amount)
+            if amount == 0:
+                raise ValueError("Нулевая сумма")
+            category = row[columns["category"]].strip() if "category" in columns else ""
+        except (ValueError, IndexError):
+            yield reader.line_num, None
+            continue
+        yield reader.line_num, (created_at, amount, is_income, category or default_category)
+
+
+def _next_batch(rows, batch_size: int, result: ImportResult):
+    """Следующая пачка разобранных строк (до batch_size) и число просмотренных строк файла"""
+    batch = []
+    processed = 0
+    for line_num, row in rows:
+        processed += 1
+        if row is None:
+            result.skipped += 1
+            if len(result.bad_lines) < 10:
+                result.bad_lines.append(line_num)
+            continue
+        batch.append(row)
+        if len(batch) >= batch_size:
+            break
+    return batch, processed
+
+
+async def import_statement(session_factory, user_id: int, rows, batch_size: int, on_progress=None) -> ImportResult:
+    """
+    Записывает строки parse_statement пачками, каждая пачка - в своей короткой
+    сессии session_factory со своим commit. При ошибке уже записанные пачки
+    откатываются (rollback_import), и исключение пробрасывается дальше.
+    on_progress(обработано строк) вызывается после каждой пачки.
+    """
+    result = ImportResult()
+    async with session_factory() as session:
+        marker = StatementImport(user_id=user_id)
+        session.add(marker)
+        categories = dict((await session.execute(
+            select(Category.name, Category.id).filter_by(user_id=user_id)
+        )).all())
+        # Расходы из выписки увеличивают бюджет, только если попали в его текущий период
+        budgets = {}
+        for budget in (await session.execute(
+            select(Budget.id, Budget.category_id, Budget.start_date).filter_by(user_id=user_id)
+        )).all():
+            budgets.setdefault(budget.category_id, []).append(budget)
+        await session.commit()
+    import_id = marker.id
+    budget_table = Budget.__table__
+
+    async def flush(session, batch):
+        new_names = {category for _, _, _, category in batch if category not in categories}
+        if new_names:
+            created = [Category(name=name, user_id=user_id) for name in new_names]
+            session.add_all(created)
+            await session.flush()
+            categories.update((category.name, category.id) for category in created)
+            result.categories_created += len(created)
+
+        transactions = []
+        rollups = {}
+        spent = {}
+        for created_at, amount, is_income, category in batch:
+            category_id = categories[category]
+            transactions.append({
+                "user_id": user_id,
+                "amount": amount,
+                "category_id": category_id,
+                "is_income": is_income,
+                "created_at": created_at,
+                "import_id": import_id,
+            })
+            key = (is_income, created_at.date(), category_id)
+            total, count = rollups.get(key, (0.0, 0))
+            rollups[key] = (total + amount, count + 1)
+            if not is_income:
+                for budget in budgets.get(category_id, ()):
+                    if budget.start_date is None or created_at >= budget.start_date:
+                        spent[budget.id] = spent.get(budget.id, 0.0) + amount
+
+        await session.execute(insert(Transaction), transactions)
+        await session.execute(rollup_upsert_many(), [
+            {"user_id": user_id, "is_income": is_income, "day": day, "category_id": category_id,
+             "total": total, "tx_count": count}
+            for (is_income, day, category_id), (total, count) in rollups.items()
+        ])
+        if spent:
+            # Core UPDATE: executemany с одним выражением на все бюджеты пачки
+            await session.execute(
+                update(budget_table).where(budget_table.c.id == bindparam("budget_id")).values(
+                    current_spent=budget_table.c.current_spent + bindparam("spent")
+                ),
+                [{"budget_id": budget_id, "spent": amount} for budget_id, amount in spent.items()]
+            )
+        result.imported += len(batch)
+
+    processed = 0
+    try:
+        while True:
+            # Разбор строк - работа CPU: идет в потоке, соединение писателя в это время свободно
+            batch, count = await asyncio.to_thread(_next_batch, rows, batch_size, result)
+            processed += count
+            if batch:
+                async with session_factory() as session:
+                    await flush(session, batch)
+                    await session.commit()
+            if on_progress:
+                on_progress(processed)
+            if len(batch) < batch_size:
+                break
+        async with session_factory() as session:
+            await session.execute(delete(StatementImport).filter_by(id=import_id))
+            await session.commit()
+    except Exception:
+        async with session_factory() as session:
+            await rollback_import(session, import_id)
+            await session.commit()
+        raise
+    return result
+
+
+async def rollback_import(session, import_id: int) -> int:
+    """
+    Удаляет транзакции незавершенного импорта и вычитает их из дневных сводок
+    и бюджетов (commit делает вызывающий). Созданные импортом категории остаются.
+    Возвращает число удаленных транзакций.
+    """
+    imported = Transaction.__table__
+    rows = (await session.execute(
+        select(
+            imported.c.user_id, imported.c.is_income, func.date(imported.c.created_at).label("day"),
+            imported.c.category_id, func.sum(imported.c.amount).label("total"),
+            func.count().label("tx_count"),
+        ).where(imported.c.import_id == import_id).group_by(
+            imported.c.user_id, imported.c.is_income, "day", imported.c.category_id
+        )
+    )).all()
+    if rows:
+        await session.execute(rollup_upsert_many(), [
+            {"user_id": row.user_id, "is_income": bool(row.is_income), "day": date.fromisoformat(row.day),
+             "category_id": row.category_id, "total": -row.total, "tx_count": -row.tx_count}
+            for row in rows
+        ])
+        await session.execute(delete(DailyRollup).where(
+            DailyRollup.user_id.in_({row.user_id for row in rows}), DailyRollup.tx_count <= 0
+        ))
+        budget_table = Budget.__table__
+        # Вычитаем те же расходы, что импорт прибавил: категория бюджета и его текущий период
+        spent = select(func.coalesce(func.sum(imported.c.amount), 0.0)).where(
+            imported.c.import_id == import_id,
+            imported.c.is_income.is_(False),
+            imported.c.category_id == budget_table.c.category_id,
+            or_(budget_table.c.start_date.is_(None), imported.c.created_at >= budget_table.c.start_date),
+        ).scalar_subquery()
+        await session.execute(
+            update(budget_table).where(budget_table.c.user_id.in_({row.user_id for row in rows})).values(
+                current_spent=func.max(budget_table.c.current_spent - spent, 0.0)
+            )
+        )
+    deleted = (await session.execute(delete(imported).where(imported.c.import_id == import_id))).rowcount
+    await session.execute(delete(StatementImport).filter_by(id=import_id))
+    return deleted
+
+
+async def recover_imports(session_factory) -> int:
+    """Откатывает импорты, прерванные остановкой бота; возвращает число откаченных"""
+    async with session_factory() as session:
+        import_ids = (await session.execute(select(StatementImport.id))).scalars().all()
+        for import_id in import_ids:
+            await rollback_import(session, import_id)
+        await session.commit()
+    return len(import_ids)
@@ -0,0 +1,163 @@
+"""
+Служебные команды для базы бота.
+
+    python manage.py migrate            # обновить схему до последней версии
+    python manage.py rebuild-rollups    # пересчитать дневные сводки по транзакциям
+    python manage.py archive            # перенести закрытые годы в файлы архива
+    python manage.py archive --year 2021
+    python manage.py rehydrate 2021     # вернуть год из архива в основную базу
+
+С SHARD_ID=N команды выше работают с базой шарда N. Шарды (см. sharding.py):
+
+    python manage.py shard-status       # пользователи и транзакции по шардам
+    python manage.py pin-users          # закрепить найденных в базах шардов (до смены SHARD_COUNT)
+    python manage.py move-user 123456 2 # перенести пользователя на шард 2
+    python manage.py rebalance --max-moves 50 --dry-run
+"""
+import argparse
+import logging
+from datetime import date
+
+from config import Config
+from migrations import LATEST_VERSION, get_version
+from models import engine, init_db
+import archive
+import rebalance
+import rollups
+from sharding import ACTIVE, ShardMap
+
+
+def cmd_migrate(args):
+    raw = engine.raw_connection()
+    try:
+        before = get_version(raw.driver_connection)
+    finally:
+        raw.close()
+    after = init_db()
+    if before == after:
+        print(f"Схема уже на версии {after}")
+    else:
+        print(f"Схема обновлена: {before} -> {after} (последняя {LATEST_VERSION})")
+
+
+def cmd_rebuild_rollups(args):
+    init_db()
+    rows = rollups.rebuild(engine)
+    print(f"Дневные сводки пересчитаны: {rows} строк")
+
+
+def cmd_archive(args):
+    init_db()
+    cutoff = archive.hot_cutoff(date.today(), Config.ARCHIVE_HOT_MONTHS)
+    if args.year is not None:
+        if not archive.is_closed(args.year, cutoff):
+            print(f"{args.year} год еще не закрыт: в основной базе остаются операции с {cutoff:%d.%m.%Y}")
+            return
+        years = [args.year]
+    else:
+        years = archive.closed_years(engine, cutoff)
+    if not years:
+        print("Нет закрытых лет для архивации")
+    for year in years:
+        moved = archive.archive_year(engine, year, Config.ARCHIVE_DIR)
+        print(f"{year}: перенесено {moved} транзакций в {archive.archive_path(Config.ARCHIVE_DIR, year)}")
+
+
+def cmd_rehydrate(args):
+    init_db()
+    restored = archive.rehydrate_year(engine, args.year)
+    if restored is None:
+        print(f"{args.year} года нет в архиве")
+    else:
+        print(f"{args.year}: возвращено {restored} транзакций")
+
+
+def cmd_shard_status(args):
+    shard_map = ShardMap(Config.SHARD_MAP_PATH, Config.SHARD_COUNT)
+    try:
+        for shard, users in enumerate(rebalance.shard_users(shard_map)):
+            print(f"Шард {shard}: {len(users)} пользователей с транзакциями, {sum(users.values())} транзакций")
+        for user_id, shard, state in shard_map.conn.execute(
+            "SELECT user_id, shard, state FROM user_shards WHERE state != ?", (ACTIVE,)
+        ):
+            print(f"Пользователь {user_id} на шарде {shard}: {state}")
+    finally:
+        shard_map.close()
+
+
+def cmd_pin_users(args):
+    shard_map = ShardMap(Config.SHARD_MAP_PATH, Config.SHARD_COUNT)
+    try:
+        print(f"Закреплено пользователей: {rebalance.pin_existing(shard_map)}")
+    finally:
+        shard_map.close()
+
+
+def cmd_move_user(args):
+    shard_map = ShardMap(Config.SHARD_MAP_PATH, Config.SHARD_COUNT)
+    try:
+        copied = rebalance.move_user(shard_map, args.user_id, args.shard, offline=args.offline)
+        print(f"Пользователь {args.user_id} на шарде {args.shard}: {copied} транзакций")
+    except rebalance.MoveError as e:
+        print(e)
+    finally:
+        shard_map.close()
+
+
+def cmd_rebalance(args):
+    shard_map = ShardMap(Config.SHARD_MAP_PATH, Config.SHARD_COUNT)
+    try:
+        moves = rebalance.plan(shard_map, args.max_moves)
+        if not moves:
+            print("Шарды уже выровнены")
+        for user_id, source, target, count in moves:
+            print(f"Пользователь {user_id}: шард {source} -> {target} ({count} транзакций)")
+            if args.dry_run:
+                continue
+            try:
+                rebalance.move_user(shard_map, user_id, target, offline=args.offline)
+            except rebalance.MoveError as e:
+                print(e)
+    finally:
+        shard_map.close()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Служебные команды Numbot")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("migrate", help="Применить миграции схемы").set_defaults(func=cmd_migrate)
+    commands.add_parser(
+        "rebuild-rollups", help="Пересчитать дневные сводки из таблицы транзакций"
+    ).set_defaults(func=cmd_rebuild_rollups)
+    archive_parser = commands.add_parser("archive", help="Перенести закрытые годы в файлы архива")
+    archive_parser.add_argument("--year", type=int, help="только этот год")
+    archive_parser.set_defaults(func=cmd_archive)
+    rehydrate_parser = commands.add_parser("rehydrate", help="Вернуть год из архива в основную базу")
+    rehydrate_parser.add_argument("year", type=int)
+    rehydrate_parser.set_defaults(func=cmd_rehydrate)
+
+    commands.add_parser(
+        "shard-status", help="Пользователи и транзакции по шардам"
+    ).set_defaults(func=cmd_shard_status)
+    commands.add_parser(
+        "pin-users", help="Закрепить пользователей из баз шардов в карте шардов"
+    ).set_defaults(func=cmd_pin_users)
+    move_parser = commands.add_parser("move-user", help="Перенести пользователя на другой шард")
+    move_parser.add_argument("user_id", type=int)
+    move_parser.add_argument("shard", type=int)
+    move_parser.add_argument("--offline", action="store_true", help="фронт остановлен")
+    move_parser.set_defaults(func=cmd_move_user)
+    rebalance_parser = commands.add_parser("rebalance", help="Выровнять шарды по числу транзакций")
+    rebalance_parser.add_argument("--max-moves", type=int, default=100, help="не больше переносов за запуск")
+    rebalance_parser.add_argument("--dry-run", action="store_true", help="только показать план")
+    rebalance_parser.add_argument("--offline", action="store_true", help="фронт остановлен")
+    rebalance_parser.set_defaults(func=cmd_rebalance)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+"""
+Метрики обработки обновлений.
+
+Каждое обновление получает свой набор счетчиков (contextvar): сколько
+SQL-запросов оно сделало и сколько времени они заняли, сколько запросов
+к Bot API и их время, какой обработчик сработал и как изменилось состояние
+FSM. По завершении обновления счетчики попадают в гистограммы с метками
+обработчика, а медленные обновления - в лог и в список худших с разбивкой
+по запросам. Так по одной записи видно, куда ушло время: в SQLite,
+в Telegram или в код обработчика.
+
+Источники данных:
+  - UpdateMetricsMiddleware (outer, dp.update) - начало и конец обновления;
+  - HandlerMetricsMiddleware (inner, dp.message и dp.callback_query) -
+    имя обработчика и переход состояния FSM;
+  - события SQLAlchemy before/after_cursor_execute на движках;
+  - BotApiMetricsMiddleware - middleware сессии Bot для запросов к API.
+
+Запросы, выполненные вне задачи обновления (групповой commit
+write_pipeline, планировщик), попадают только в общие счетчики.
+
+Метрики отдаются в текстовом формате Prometheus на METRICS_HOST:METRICS_PORT
+(/metrics), список худших обновлений - там же (/slow).
+"""
+import bisect
+import contextvars
+import heapq
+import logging
+import re
+import time
+from itertools import count
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiohttp import web
+from sqlalchemy import event
+
+from cache import all_stats
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50)
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self.values = {}  # метки (кортеж пар) -> значение
+
+    def inc(self, labels=(), value: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in sorted(self.values.items()):
+            yield f"{self.name}{_labels(labels)} {value}"
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.series = {}  # метки -> [счетчики по корзинам..., сумма, количество]
+
+    def observe(self, value: float, labels=()):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * len(self.buckets) + [0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, series in sorted(self.series.items()):
+            cumulative = 0
+            for bound, hits in zip(self.buckets, series):
+                cumulative += hits
+                yield f"{self.name}_bucket{_labels(labels + (('le', _number(bound)),))} {cumulative}"
+            yield f"{self.name}_bucket{_labels(labels + (('le', '+Inf'),))} {series[-1]}"
+            yield f"{self.name}_sum{_labels(labels)} {series[-2]}"
+            yield f"{self.name}_count{_labels(labels)} {series[-1]}"
+
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _labels(labels) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+update_seconds = Histogram("bot_update_seconds", "Время обработки обновления", LATENCY_BUCKETS)
+update_db_seconds = Histogram("bot_update_db_seconds", "Время SQL-запросов за обновление", LATENCY_BUCKETS)
+update_api_seconds = Histogram("bot_update_api_seconds", "Время запросов к Bot API за обновление", LATENCY_BUCKETS)
+update_queries = Histogram("bot_update_queries", "SQL-запросов за обновление", QUERY_COUNT_BUCKETS)
+updates_total = Counter("bot_updates_total", "Обработанные обновления")
+update_errors_total = Counter("bot_update_errors_total", "Обновления, завершившиеся исключением")
+fsm_transitions_total = Counter("bot_fsm_transitions_total", "Переходы состояний FSM")
+db_queries_total = Counter("bot_db_queries_total", "SQL-запросы по движкам")
+db_seconds_total = Counter("bot_db_seconds_total", "Время SQL-запросов по движкам")
+api_requests_total = Counter("bot_api_requests_total", "Запросы к Bot API по методам")
+api_seconds = Histogram("bot_api_seconds", "Время запроса к Bot API", LATENCY_BUCKETS)
+
+METRICS = (
+    updates_total, update_errors_total, update_seconds, update_db_seconds, update_api_seconds, update_queries,
+    fsm_transitions_total, db_queries_total, db_seconds_total, api_requests_total, api_seconds,
+)
+
+
+class UpdateStats:
+    """Счетчики одного обновления"""
+    __slots__ = ("update_id", "handler", "started", "elapsed", "queries", "db_time", "api_calls", "api_time", "statements")
+
+    def __init__(self, update_id):
+        self.update_id = update_id
+        self.handler = "unhandled"
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+        self.queries = 0
+        self.db_time = 0.0
+        self.api_calls = 0
+        self.api_time = 0.0
+        self.statements = {}  # текст запроса -> [число, время]
+
+    def breakdown(self, limit: int = 5):
+        """Самые дорогие запросы обновления"""
+        top = sorted(self.statements.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+        return [f"{n}x {seconds * 1000:.1f}ms {statement}" for statement, (n, seconds) in top]
+
+
+_current = contextvars.ContextVar("update_stats", default=None)
+_WHITESPACE = re.compile(r"\s+")
+
+
+def _statement_key(statement: str) -> str:
+    return _WHITESPACE.sub(" ", statement).strip()[:120]
+
+
+def instrument_engine(sync_engine, name: str):
+    """Подключает счетчики запросов к движку (для async - к его sync_engine)"""
+    labels = (("engine", name),)
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        db_queries_total.inc(labels)
+        db_seconds_total.inc(labels, elapsed)
+        stats = _current.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_time += elapsed
+            item = stats.statements.setdefault(_statement_key(statement), [0, 0.0])
+            item[0] += 1
+            item[1] += elapsed
+
+    @event.listens_for(sync_engine, "handle_error")
+    def on_error(context):
+        started = context.connection.info.get("query_started") if context.connection is not None else None
+        if started:
+            started.pop()
+
+
+class BotApiMetricsMiddleware(BaseRequestMiddleware):
+    """Время запросов к Bot API: общее и в счет текущего обновления"""
+
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            elapsed = time.perf_counter() - started
+            labels = (("method", type(method).__name__),)
+            api_requests_total.inc(labels)
+            api_seconds.observe(elapsed, labels)
+            stats = _current.get()
+            if stats is not None:
+                stats.api_calls += 1
+                stats.api_time += elapsed
+
+
+class SlowLog:
+    """Худшие обновления по времени обработки"""
+
+    def __init__(self, threshold: float, keep: int):
+        self.threshold = threshold
+        self.keep = keep
+        self._heap = []  # (время, порядковый номер, запись) - min-heap, на вершине самое быстрое из худших
+        self._seq = count()
+
+    def record(self, stats: UpdateStats):
+        if stats.elapsed < self.threshold:
+            return
+        breakdown = stats.breakdown()
+        logger.warning(
+            f"Медленное обновление {stats.update_id} ({stats.handler}): {stats.elapsed * 1000:.0f}ms, "
+            f"SQL {stats.queries} запросов {stats.db_time * 1000:.0f}ms, "
+            f"Bot API {stats.api_calls} запросов {stats.api_time * 1000:.0f}ms"
+            + "".join(f"\n    {line}" for line in breakdown)
+        )
+        entry = (stats.elapsed, next(self._seq), {
+            "update_id": stats.update_id,
+            "handler": stats.handler,
+            "at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "elapsed": stats.elapsed,
+            "queries": stats.queries,
+            "db_time": stats.db_time,
+            "api_calls": stats.api_calls,
+            "api_time": stats.api_time,
+            "breakdown": breakdown,
+        })
+        if len(self._heap) < self.keep:
+            heapq.heappush(self._heap, entry)
+        elif entry[0] > self._heap[0][0]:
+            heapq.heapreplace(self._heap, entry)
+
+    def render(self) -> str:
+        lines = []
+        for elapsed, _, item in sorted(self._heap, reverse=True):
+            lines.append(
+                f"{item['at']} update {item['update_id']} {item['handler']}: {elapsed * 1000:.0f}ms | "
+                f"SQL {item['queries']} / {item['db_time'] * 1000:.0f}ms | "
+                f"API {item['api_calls']} / {item['api_time'] * 1000:.0f}ms | "
+                f"прочее {(elapsed - item['db_time'] - item['api_time']) * 1000:.0f}ms"
+            )
+            lines.extend(f"    {line}" for line in item["breakdown"])
+        return "\n".join(lines) + "\n" if lines else "Медленных обновлений нет\n"
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Outer-middleware на dp.update: заводит счетчики обновления и сохраняет их"""
+
+    def __init__(self, slow_log: SlowLog):
+        self.slow_log = slow_log
+
+    async def __call__(self, handler, event, data):
+        stats = UpdateStats(event.update_id)
+        token = _current.set(stats)
+        failed = False
+        try:
+            return await handler(event, data)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            _current.reset(token)
+            stats.elapsed = time.perf_counter() - stats.started
+            labels = (("handler", stats.handler),)
+            updates_total.inc(labels)
+            if failed:
+                update_errors_total.inc(labels)
+            update_seconds.observe(stats.elapsed, labels)
+            update_db_seconds.observe(stats.db_time, labels)
+            update_api_seconds.observe(stats.api_time, labels)
+            update_queries.observe(stats.queries, labels)
+            self.slow_log.record(stats)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner-middleware: имя сработавшего обработчика и переход состояния FSM"""
+
+    async def __call__(self, handler, event, data):
+        stats = _current.get()
+        handler_object = data.get("handler")
+        if stats is not None and handler_object is not None:
+            stats.handler = getattr(handler_object.callback, "__name__", "handler")
+        before = data.get("raw_state")
+        try:
+            return await handler(event, data)
+        finally:
+            state = data.get("state")
+            if state is not None:
+                after = await state.get_state()
+                if after != before:
+                    fsm_transitions_total.inc((("from", before or "none"), ("to", after or "none")))
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    # Счетчики in-process кэшей (cache.py)
+    cache_stats = all_stats()
+    for field, kind in (("hits", "counter"), ("misses", "counter"), ("evictions", "counter"), ("size", "gauge")):
+        name = f"bot_cache_{field}" + ("_total" if kind == "counter" else "")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(f'{name}{{cache="{cache}"}} {stats[field]}' for cache, stats in sorted(cache_stats.items()))
+    return "\n".join(lines) + "\n"
+
+
+def setup(dp, bot, engines, slow_threshold: float, slow_keep: int) -> SlowLog:
+    """Подключает middleware и счетчики запросов; engines - {имя: sync engine}"""
+    slow_log = SlowLog(slow_threshold, slow_keep)
+    dp.update.outer_middleware(UpdateMetricsMiddleware(slow_log))
+    for observer in (dp.message, dp.callback_query):
+        observer.middleware(HandlerMetricsMiddleware())
+    bot.session.middleware(BotApiMetricsMiddleware())
+    for name, sync_engine in engines.items():
+        instrument_engine(sync_engine, name)
+    return slow_log
+
+
+class MetricsServer:
+    """Локальный HTTP-сервер с /metrics и /slow"""
+
+    def __init__(self, slow_log: SlowLog, host: str, port: int):
+        self.slow_log = slow_log
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self._metrics)
+        app.router.add_get("/slow", self._slow)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Метрики доступны на http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _metrics(self, request):
+        return web.Response(
+            body=render_metrics().encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+        )
+
+    async def _slow(self, request):
+        return web.Response(text=self.slow_log.render(), content_type="text/plain", charset="utf-8")
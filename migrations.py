@@ -0,0 +1,285 @@
+"""
+Версионированные миграции схемы SQLite.
+
+Номер версии схемы хранится в PRAGMA user_version самого файла базы.
+При старте бота читается одна прагма: если база уже на последней версии,
+схема больше ничего не проверяет. Иначе недостающие миграции применяются
+по порядку, каждая в своей транзакции, вместе с новым номером версии.
+
+Миграции описаны явным SQL, а не через Base.metadata: так старые шаги
+не меняются, когда модели в models.py получают новые поля.
+"""
+import logging
+import os
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+# Пересчет дневных сводок по всей таблице транзакций (используется и командой
+# `python manage.py rebuild-rollups`)
+ROLLUP_BACKFILL_SQL = """
+    INSERT INTO daily_rollups (user_id, is_income, day, category_id, total, tx_count)
+    SELECT user_id, COALESCE(is_income, 0), date(created_at), category_id,
+           COALESCE(SUM(amount), 0), COUNT(*)
+    FROM transactions
+    WHERE user_id IS NOT NULL AND category_id IS NOT NULL AND created_at IS NOT NULL
+    GROUP BY user_id, COALESCE(is_income, 0), date(created_at), category_id
+"""
+
+def _archive_generations(conn):
+    """
+    Файлы архива получают номер поколения строки: месяц года, как их
+    переносил manage.py archive. Возвращает наибольший id в файлах архива.
+    """
+    top = 0
+    for year, path in conn.execute("SELECT year, path FROM archived_years").fetchall():
+        if not os.path.exists(path):
+            continue
+        archive = sqlite3.connect(path)
+        try:
+            columns = [row[1] for row in archive.execute("PRAGMA table_info(transactions)")]
+            if "gen" not in columns:
+                archive.execute("ALTER TABLE transactions ADD COLUMN gen INTEGER NOT NULL DEFAULT 0")
+                archive.execute("UPDATE transactions SET gen = CAST(strftime('%m', created_at) AS INTEGER)")
+                archive.commit()
+            top = max(top, archive.execute("SELECT COALESCE(MAX(id), 0) FROM transactions").fetchone()[0])
+        finally:
+            archive.close()
+        conn.execute("UPDATE archived_years SET gen = 12 WHERE year = ?", (year,))
+    return top
+
+
+def _autoincrement_transactions(conn):
+    """Пересоздает transactions с AUTOINCREMENT: id не повторяются после переноса строк в архив"""
+    archived_top = _archive_generations(conn)
+    conn.execute("""CREATE TABLE transactions_new (
+        id INTEGER NOT NULL,
+        user_id INTEGER,
+        amount FLOAT,
+        category_id INTEGER,
+        is_income BOOLEAN,
+        created_at DATETIME,
+        import_id INTEGER,
+        PRIMARY KEY (id AUTOINCREMENT),
+        FOREIGN KEY(category_id) REFERENCES categories (id)
+    )""")
+    conn.execute(
+        "INSERT INTO transactions_new (id, user_id, amount, category_id, is_income, created_at, import_id) "
+        "SELECT id, user_id, amount, category_id, is_income, created_at, import_id FROM transactions"
+    )
+    conn.execute("DROP TABLE transactions")
+    conn.execute("ALTER TABLE transactions_new RENAME TO transactions")
+    for sql in (
+        "CREATE INDEX ix_transactions_user_income_created ON transactions (user_id, is_income, created_at)",
+        "CREATE INDEX ix_transactions_category_created ON transactions (category_id, created_at)",
+        "CREATE INDEX ix_transactions_created ON transactions (created_at)",
+        "CREATE INDEX ix_transactions_import ON transactions (import_id) WHERE import_id IS NOT NULL",
+    ):
+        conn.execute(sql)
+    # Новые id - выше всех, что уже есть в основной базе и в файлах архива
+    top = max(archived_top, conn.execute("SELECT COALESCE(MAX(id), 0) FROM transactions").fetchone()[0])
+    conn.execute("DELETE FROM sqlite_sequence WHERE name = 'transactions'")
+    conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('transactions', ?)", (top,))
+
+
+# (версия, описание, список шагов). Шаг - SQL-строка или функция,
+# принимающая sqlite3-соединение (для переноса данных).
+MIGRATIONS = [
+    (1, "Базовая схема", [
+        """CREATE TABLE IF NOT EXISTS users (
+            id INTEGER NOT NULL,
+            telegram_id INTEGER,
+            created_at DATETIME,
+            PRIMARY KEY (id),
+            UNIQUE (telegram_id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS categories (
+            id INTEGER NOT NULL,
+            name VARCHAR NOT NULL,
+            user_id INTEGER,
+            PRIMARY KEY (id),
+            FOREIGN KEY(user_id) REFERENCES users (id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER NOT NULL,
+            user_id INTEGER,
+            amount FLOAT,
+            category_id INTEGER,
+            is_income BOOLEAN,
+            created_at DATETIME,
+            PRIMARY KEY (id),
+            FOREIGN KEY(category_id) REFERENCES categories (id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS savings_goals (
+            id INTEGER NOT NULL,
+            user_id INTEGER,
+            name VARCHAR NOT NULL,
+            target_amount FLOAT NOT NULL,
+            current_amount FLOAT,
+            target_date DATETIME,
+            created_at DATETIME,
+            PRIMARY KEY (id),
+            FOREIGN KEY(user_id) REFERENCES users (id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS budgets (
+            id INTEGER NOT NULL,
+            user_id INTEGER,
+            category_id INTEGER,
+            amount FLOAT NOT NULL,
+            period VARCHAR NOT NULL,
+            start_date DATETIME,
+            current_spent FLOAT,
+            PRIMARY KEY (id),
+            FOREIGN KEY(user_id) REFERENCES users (id),
+            FOREIGN KEY(category_id) REFERENCES categories (id)
+        )""",
+    ]),
+    (2, "Индексы под запросы отчетов, категорий и бюджетов", [
+        # generate_report: фильтр по пользователю, типу и дате
+        "CREATE INDEX IF NOT EXISTS ix_transactions_user_income_created "
+        "ON transactions (user_id, is_income, created_at)",
+        # view_category и статистика категорий: выборка по категории с сортировкой по дате
+        "CREATE INDEX IF NOT EXISTS ix_transactions_category_created "
+        "ON transactions (category_id, created_at)",
+        # Список категорий пользователя и проверка дубликата по имени
+        "CREATE INDEX IF NOT EXISTS ix_categories_user_name ON categories (user_id, name)",
+        # Бюджеты пользователя и бюджеты категории при сохранении расхода
+        "CREATE INDEX IF NOT EXISTS ix_budgets_user_category ON budgets (user_id, category_id)",
+        "CREATE INDEX IF NOT EXISTS ix_budgets_category ON budgets (category_id)",
+        "CREATE INDEX IF NOT EXISTS ix_savings_goals_user ON savings_goals (user_id)",
+    ]),
+    (3, "Дневные сводки транзакций для отчетов", [
+        """CREATE TABLE IF NOT EXISTS daily_rollups (
+            user_id INTEGER NOT NULL,
+            is_income BOOLEAN NOT NULL,
+            day DATE NOT NULL,
+            category_id INTEGER NOT NULL,
+            total FLOAT NOT NULL DEFAULT 0,
+            tx_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, is_income, day, category_id)
+        ) WITHOUT ROWID""",
+        # Заполняем сводки по уже накопленной истории
+        ROLLUP_BACKFILL_SQL,
+    ]),
+    (4, "Хранилище состояний FSM", [
+        """CREATE TABLE IF NOT EXISTS fsm_states (
+            key VARCHAR NOT NULL,
+            state VARCHAR,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at FLOAT NOT NULL,
+            PRIMARY KEY (key)
+        )""",
+        # Очистка брошенных сценариев идет по времени последнего изменения
+        "CREATE INDEX IF NOT EXISTS ix_fsm_states_updated ON fsm_states (updated_at)",
+    ]),
+    (5, "Уровень отправленных уведомлений бюджета за период", [
+        "ALTER TABLE budgets ADD COLUMN alert_level INTEGER NOT NULL DEFAULT 0",
+    ]),
+    (6, "Журнал пополнений целей накопления", [
+        """CREATE TABLE IF NOT EXISTS savings_deposits (
+            id INTEGER NOT NULL,
+            goal_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            amount FLOAT NOT NULL,
+            created_at DATETIME NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY(goal_id) REFERENCES savings_goals (id)
+        )""",
+        # Сводка по целям пользователя и история пополнений цели
+        "CREATE INDEX IF NOT EXISTS ix_savings_deposits_user_goal ON savings_deposits (user_id, goal_id)",
+        "CREATE INDEX IF NOT EXISTS ix_savings_deposits_goal_created ON savings_deposits (goal_id, created_at)",
+        # Накопленное до журнала - одно пополнение на дату создания цели
+        """INSERT INTO savings_deposits (goal_id, user_id, amount, created_at)
+           SELECT id, user_id, current_amount, COALESCE(created_at, CURRENT_TIMESTAMP)
+           FROM savings_goals
+           WHERE current_amount > 0 AND user_id IS NOT NULL""",
+    ]),
+    (7, "Годовые сводки и реестр архивных лет", [
+        # Перенос года в архив и обратно выбирает транзакции по диапазону дат
+        "CREATE INDEX IF NOT EXISTS ix_transactions_created ON transactions (created_at)",
+        """CREATE TABLE IF NOT EXISTS yearly_rollups (
+            user_id INTEGER NOT NULL,
+            is_income BOOLEAN NOT NULL,
+            year INTEGER NOT NULL,
+            category_id INTEGER NOT NULL,
+            total FLOAT NOT NULL DEFAULT 0,
+            tx_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, is_income, year, category_id)
+        ) WITHOUT ROWID""",
+        """CREATE TABLE IF NOT EXISTS archived_years (
+            year INTEGER NOT NULL,
+            path VARCHAR NOT NULL,
+            tx_count INTEGER NOT NULL DEFAULT 0,
+            archived_at DATETIME NOT NULL,
+            PRIMARY KEY (year)
+        )""",
+    ]),
+    (8, "Отметка импорта выписки для отката при сбое", [
+        # Строка живет, пока импорт не завершен: оставшиеся после сбоя откатываются
+        # AUTOINCREMENT: номер завершенного импорта не достается следующему,
+        # иначе откат нового задел бы транзакции старого
+        """CREATE TABLE IF NOT EXISTS imports (
+            id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            started_at DATETIME NOT NULL,
+            PRIMARY KEY (id AUTOINCREMENT)
+        )""",
+        "ALTER TABLE transactions ADD COLUMN import_id INTEGER",
+        # Откат импорта выбирает его транзакции; ручной ввод в индекс не попадает
+        "CREATE INDEX IF NOT EXISTS ix_transactions_import ON transactions (import_id) "
+        "WHERE import_id IS NOT NULL",
+    ]),
+    (9, "Монотонные id транзакций и поколения переноса в архив", [
+        # Последнее поколение строк года, удаленное из основной базы (см. archive.py)
+        "ALTER TABLE archived_years ADD COLUMN gen INTEGER NOT NULL DEFAULT 0",
+        _autoincrement_transactions,
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_version(conn) -> int:
+    """Текущая версия схемы sqlite3-соединения"""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def upgrade(engine) -> int:
+    """Применяет недостающие миграции и возвращает итоговую версию схемы"""
+    raw = engine.raw_connection()
+    try:
+        conn = raw.driver_connection
+        version = get_version(conn)
+        if version >= LATEST_VERSION:
+            return version
+
+        isolation_level = conn.isolation_level
+        conn.isolation_level = None  # Транзакциями управляем вручную
+        try:
+            for target, description, steps in MIGRATIONS:
+                if target <= version:
+                    continue
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    # Другой процесс мог успеть обновить схему, пока мы ждали блокировку
+                    version = get_version(conn)
+                    if target <= version:
+                        conn.execute("COMMIT")
+                        continue
+                    logger.info(f"Миграция схемы до версии {target}: {description}")
+                    for step in steps:
+                        if callable(step):
+                            step(conn)
+                        else:
+                            conn.execute(step)
+                    conn.execute(f"PRAGMA user_version = {target}")
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+                version = target
+        finally:
+            conn.isolation_level = isolation_level
+    finally:
+        raw.close()
+    return version
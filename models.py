@@ -1,11 +1,40 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, Boolean, DateTime, ForeignKey
+from sqlalchemy import create_engine, event, Column, Integer, String, Float, Boolean, Date, DateTime, ForeignKey, Index
 from sqlalchemy.orm import sessionmaker, declarative_base, relationship
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from datetime import datetime
 from config import Config
+from migrations import upgrade
+
+def _sqlite_pragmas(read_only: bool = False):
+    """Обработчик события connect: настраивает каждое новое соединение SQLite"""
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA busy_timeout = {Config.SQLITE_BUSY_TIMEOUT}")
+        cursor.execute(f"PRAGMA journal_mode = {Config.SQLITE_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous = {Config.SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA cache_size = {Config.SQLITE_CACHE_SIZE}")
+        cursor.execute(f"PRAGMA mmap_size = {Config.SQLITE_MMAP_SIZE}")
+        if read_only:
+            cursor.execute("PRAGMA query_only = ON")
+        cursor.close()
+    return on_connect
 
 # Инициализация базы данных
 engine = create_engine(Config.DB_URL)
+event.listen(engine, "connect", _sqlite_pragmas())
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Асинхронные движки для обработчиков бота: запросы не блокируют event loop.
+# Писатель в SQLite все равно один, поэтому записи идут через единственное
+# соединение и выстраиваются в очередь пула, а не в busy-ожидание блокировки.
+# Отчеты и меню читают через отдельный пул и в режиме WAL не ждут записей.
+async_engine = create_async_engine(Config.ASYNC_DB_URL, pool_size=1, max_overflow=0)
+event.listen(async_engine.sync_engine, "connect", _sqlite_pragmas())
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+async_read_engine = create_async_engine(
+    Config.ASYNC_DB_URL, pool_size=Config.SQLITE_READ_POOL_SIZE, max_overflow=0
+)
+event.listen(async_read_engine.sync_engine, "connect", _sqlite_pragmas(read_only=True))
+AsyncReadSessionLocal = async_sessionmaker(async_read_engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 class User(Base):
@@ -22,6 +51,9 @@ class Category(Base):
     name = Column(String, nullable=False)
     user_id = Column(Integer, ForeignKey('users.id'))
     user = relationship("User")
+    __table_args__ = (
+        Index('ix_categories_user_name', 'user_id', 'name'),
+    )
 
 class Transaction(Base):
     __tablename__ = 'transactions'
@@ -31,7 +63,16 @@ class Transaction(Base):
     category_id = Column(Integer, ForeignKey('categories.id'))
     is_income = Column(Boolean)
     created_at = Column(DateTime, default=datetime.now)
+    import_id = Column(Integer)  # Импорт выписки, которым загружена транзакция (importer.py)
     category = relationship("Category")
+    __table_args__ = (
+        Index('ix_transactions_user_income_created', 'user_id', 'is_income', 'created_at'),
+        Index('ix_transactions_category_created', 'category_id', 'created_at'),
+        Index('ix_transactions_created', 'created_at'),
+        Index('ix_transactions_import', 'import_id', sqlite_where=import_id.isnot(None)),
+        # id не переиспользуются: строки архива сохраняют свои id (archive.py)
+        {'sqlite_autoincrement': True},
+    )
 
 class SavingsGoal(Base):
     __tablename__ = 'savings_goals'
@@ -43,6 +84,22 @@ class SavingsGoal(Base):
     target_date = Column(DateTime, nullable=True)
     created_at = Column(DateTime, default=datetime.now)
     user = relationship("User", back_populates="savings_goals")
+    __table_args__ = (
+        Index('ix_savings_goals_user', 'user_id'),
+    )
+
+class SavingsDeposit(Base):
+    """Пополнение цели накопления (журнал; сумма цели - в savings_goals.current_amount)"""
+    __tablename__ = 'savings_deposits'
+    id = Column(Integer, primary_key=True)
+    goal_id = Column(Integer, ForeignKey('savings_goals.id'), nullable=False)
+    user_id = Column(Integer, nullable=False)
+    amount = Column(Float, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.now)
+    __table_args__ = (
+        Index('ix_savings_deposits_user_goal', 'user_id', 'goal_id'),
+        Index('ix_savings_deposits_goal_created', 'goal_id', 'created_at'),
+    )
 
 class Budget(Base):
     __tablename__ = 'budgets'
@@ -53,9 +110,52 @@ class Budget(Base):
     period = Column(String, nullable=False)  # 'day', 'week', 'month', 'year'
     start_date = Column(DateTime, default=datetime.now)
     current_spent = Column(Float, default=0.0)
+    alert_level = Column(Integer, nullable=False, default=0)  # Отправленные за период уведомления (budget_index)
     user = relationship("User", back_populates="budgets")
     category = relationship("Category")
+    __table_args__ = (
+        Index('ix_budgets_user_category', 'user_id', 'category_id'),
+        Index('ix_budgets_category', 'category_id'),
+    )
+
+class DailyRollup(Base):
+    """Дневная сводка транзакций пользователя по категории (для отчетов)"""
+    __tablename__ = 'daily_rollups'
+    # Порядок ключа совпадает с фильтром отчетов: пользователь, тип, диапазон дат
+    user_id = Column(Integer, primary_key=True)
+    is_income = Column(Boolean, primary_key=True)
+    day = Column(Date, primary_key=True)
+    category_id = Column(Integer, primary_key=True)
+    total = Column(Float, nullable=False, default=0.0)
+    tx_count = Column(Integer, nullable=False, default=0)
+
+class YearlyRollup(Base):
+    """Годовая сводка транзакций архивного года (сами транзакции - в файле архива, см. archive.py)"""
+    __tablename__ = 'yearly_rollups'
+    user_id = Column(Integer, primary_key=True)
+    is_income = Column(Boolean, primary_key=True)
+    year = Column(Integer, primary_key=True)
+    category_id = Column(Integer, primary_key=True)
+    total = Column(Float, nullable=False, default=0.0)
+    tx_count = Column(Integer, nullable=False, default=0)
+
+class ArchivedYear(Base):
+    """Год, транзакции которого перенесены в отдельный файл SQLite"""
+    __tablename__ = 'archived_years'
+    year = Column(Integer, primary_key=True)
+    path = Column(String, nullable=False)
+    tx_count = Column(Integer, nullable=False, default=0)
+    archived_at = Column(DateTime, nullable=False, default=datetime.now)
+    gen = Column(Integer, nullable=False, default=0)  # Последнее поколение строк, удаленное из основной базы
+
+class StatementImport(Base):
+    """Незавершенный импорт выписки: его транзакции помечены import_id и откатываются при сбое"""
+    __tablename__ = 'imports'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    started_at = Column(DateTime, nullable=False, default=datetime.now)
+    __table_args__ = {'sqlite_autoincrement': True}
 
 def init_db():
-    """Создает все таблицы в базе данных"""
-    Base.metadata.create_all(bind=engine)
\ No newline at end of file
+    """Приводит схему базы данных к последней версии (см. migrations.py)"""
+    return upgrade(engine)
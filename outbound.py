@@ -0,0 +1,204 @@
+"""
+Очередь исходящих сообщений с учетом ограничений Telegram.
+
+Очередь подключена как middleware сессии Bot, поэтому через нее проходят
+все отправки всех обработчиков (message.answer, bot.send_message, правка
+сообщений, файлы) без изменений в самих обработчиках. Запросы с chat_id
+становятся в очередь своего чата и уходят по порядку, когда есть токены
+в ведре чата и в глобальном ведре (TokenBucket). Остальные методы
+(answerCallbackQuery, getFile, setWebhook...) идут напрямую.
+
+Если Telegram все же ответил 429 (TelegramRetryAfter), чат ждет указанное
+время и повторяет тот же запрос, не более OUTBOUND_MAX_RETRIES раз.
+
+Несколько текстов, ожидающих отправки в один чат (например, подтверждение
+сохранения и предупреждения о бюджетах), склеиваются в одно сообщение,
+если у них одинаковое форматирование и клавиатура есть только у последнего.
+Все вызывающие получают один и тот же объект Message.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096
+COALESCE_SEPARATOR = "\n\n"
+# Поля SendMessage, которые должны совпадать, чтобы тексты можно было склеить
+_COALESCE_KEYS = (
+    "chat_id", "business_connection_id", "message_thread_id", "parse_mode",
+    "disable_notification", "protect_content", "link_preview_options", "disable_web_page_preview",
+)
+
+
+class TokenBucket:
+    """rate токенов в секунду, не больше capacity про запас"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0  # После 429 от Telegram
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Сколько ждать до свободного токена (0 - можно сейчас)"""
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(self.paused_until - now, 0.0)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class OutboundQueue(BaseRequestMiddleware):
+    """Middleware сессии Bot: очереди по чатам, ведра токенов, повтор после 429, склейка текстов"""
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float, max_retries: int):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        # Ведро чата живет, пока чат активен; через минуту простоя оно все равно полное
+        self._buckets = TTLCache("outbound_buckets", 100000, 60)
+        self._queues = {}  # chat_id -> deque[(make_request, bot, method, future)]
+        self._workers = {}  # chat_id -> задача, разбирающая очередь чата
+        self._global_lock = asyncio.Lock()
+        self.sent = 0
+        self.coalesced = 0
+        self.retried = 0
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(chat_id, deque()).append((make_request, bot, method, future))
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._drain(chat_id))
+        return await future
+
+    def _bucket(self, chat_id) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+        self._buckets.set(chat_id, bucket)
+        return bucket
+
+    async def _acquire(self, bucket: TokenBucket):
+        while True:
+            wait = bucket.delay()
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        # Глобальное ведро общее для всех чатов: очередь за ним по одному
+        async with self._global_lock:
+            while True:
+                wait = self.global_bucket.delay()
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            self.global_bucket.take()
+        bucket.take()
+
+    def _take_batch(self, queue: deque):
+        """Снимает с головы очереди один запрос или несколько склеиваемых текстов"""
+        first = queue.popleft()
+        batch = [first]
+        method = first[2]
+        if not _can_coalesce(method):
+            return batch, method
+        text = method.text
+        markup = method.reply_markup
+        while queue and markup is None:
+            candidate = queue[0][2]
+            if not _can_coalesce(candidate) or any(
+                getattr(candidate, key) != getattr(method, key) for key in _COALESCE_KEYS
+            ):
+                break
+            if len(text) + len(COALESCE_SEPARATOR) + len(candidate.text) > MAX_MESSAGE_LENGTH:
+                break
+            batch.append(queue.popleft())
+            text += COALESCE_SEPARATOR + candidate.text
+            markup = candidate.reply_markup
+        if len(batch) > 1:
+            self.coalesced += len(batch) - 1
+            method = method.model_copy(update={"text": text, "reply_markup": markup})
+        return batch, method
+
+    async def _drain(self, chat_id):
+        queue = self._queues[chat_id]
+        bucket = self._bucket(chat_id)
+        batch = []
+        try:
+            while queue:
+                await self._acquire(bucket)
+                batch, method = self._take_batch(queue)
+                make_request, bot = batch[0][0], batch[0][1]
+                try:
+                    result = await self._send(make_request, bot, method, bucket)
+                except Exception as e:
+                    for *_, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    for *_, future in batch:
+                        if not future.done():
+                            future.set_result(result)
+        finally:
+            del self._workers[chat_id]
+            # Задачу отменили при остановке: ожидающие получают отмену, а не вечное ожидание
+            for *_, future in list(batch) + list(queue):
+                if not future.done():
+                    future.cancel()
+            del self._queues[chat_id]
+
+    async def _send(self, make_request, bot, method, bucket: TokenBucket):
+        attempt = 0
+        while True:
+            try:
+                result = await make_request(bot, method)
+                self.sent += 1
+                return result
+            except TelegramRetryAfter as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                self.retried += 1
+                logger.warning(f"Flood control для чата {method.chat_id}: повтор через {e.retry_after} с")
+                bucket.pause(e.retry_after)
+                await self._acquire(bucket)
+
+    async def close(self, timeout: float):
+        """Дожидается отправки очереди (не дольше timeout), затем отменяет остаток"""
+        workers = list(self._workers.values())
+        if not workers:
+            return
+        done, pending = await asyncio.wait(workers, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(f"Не отправлены сообщения в {len(pending)} чатов: очередь остановлена")
+
+
+def _can_coalesce(method) -> bool:
+    return type(method) is SendMessage and not method.entities and method.reply_parameters is None \
+        and method.reply_to_message_id is None
@@ -0,0 +1,87 @@
+"""
+Быстрый ввод операции одним сообщением: «-450 кофе», «+50000 зарплата».
+
+Знак задает тип (минус - расход, плюс - доход), дальше сумма и категория.
+Категория ищется по индексу категорий пользователя (CategoryIndex, хранится
+в кэше бота): точное совпадение без учета регистра и «ё», совпадение одного
+из слов сообщения, единственная категория с таким началом, затем нечеткое
+сравнение difflib - опечатка вроде «кофк» находит «Кофе».
+
+Если категория не найдена или подходит несколько похожих, match возвращает
+None и кандидатов: бот переходит в обычный сценарий Form с уже введенной
+суммой и предлагает выбрать категорию кнопкой.
+"""
+import difflib
+import re
+
+QUICK_ENTRY_RE = re.compile(
+    r"^\s*(?P<sign>[+-])\s*(?P<amount>\d[\d\s]*(?:[.,]\d+)?)\s*(?:₽|руб\.?|р\.?)?(?:\s+(?P<category>.+?))?\s*$",
+    re.IGNORECASE
+)
+FUZZY_MARGIN = 0.1  # На столько лучшее совпадение должно опережать второе
+_PUNCTUATION = re.compile(r"[^\w\s]+")
+
+
+class QuickEntry:
+    __slots__ = ("is_income", "amount", "category")
+
+    def __init__(self, is_income: bool, amount: float, category: str):
+        self.is_income = is_income
+        self.amount = amount
+        self.category = category  # Текст после суммы; пустая строка - не указана
+
+
+def parse(text: str):
+    """QuickEntry из текста сообщения или None, если это не быстрый ввод"""
+    match = QUICK_ENTRY_RE.match(text or "")
+    if not match:
+        return None
+    try:
+        amount = float(re.sub(r"\s", "", match["amount"]).replace(",", "."))
+    except ValueError:
+        return None
+    if amount <= 0:
+        return None
+    return QuickEntry(match["sign"] == "+", amount, match["category"] or "")
+
+
+def normalize(name: str) -> str:
+    return " ".join(_PUNCTUATION.sub(" ", name.casefold().replace("ё", "е")).split())
+
+
+class CategoryIndex:
+    """Категории пользователя (строки с полями id и name) с ключами для сопоставления"""
+
+    def __init__(self, categories):
+        self.categories = list(categories)
+        self.by_id = {category.id: category for category in self.categories}
+        self.by_key = {}
+        for category in self.categories:
+            self.by_key.setdefault(normalize(category.name), category)
+
+    def match(self, text: str, cutoff: float):
+        """(категория, []) при однозначном совпадении, иначе (None, похожие категории)"""
+        query = normalize(text)
+        if not query:
+            return None, []
+        category = self.by_key.get(query)
+        if category is not None:
+            return category, []
+
+        words = [self.by_key[word] for word in query.split() if word in self.by_key]
+        if len({category.id for category in words}) == 1:
+            return words[0], []
+
+        prefixed = [category for key, category in self.by_key.items() if key.startswith(query)]
+        if len(prefixed) == 1 and len(query) >= 3:
+            return prefixed[0], []
+
+        scored = sorted(
+            ((difflib.SequenceMatcher(None, query, key).ratio(), category) for key, category in self.by_key.items()),
+            key=lambda item: item[0],
+            reverse=True
+        )
+        similar = [category for score, category in scored if score >= cutoff]
+        if similar and (len(scored) == 1 or scored[0][0] - scored[1][0] >= FUZZY_MARGIN):
+            return similar[0], []
+        return None, similar or prefixed
@@ -0,0 +1,319 @@
+"""
+Перенос пользователей между шардами (см. sharding.py).
+
+    python manage.py move-user 123456 2     # перенести пользователя на шард 2
+    python manage.py rebalance              # выровнять шарды по числу транзакций
+
+Перенос идет при работающем фронте. Пользователь помечается в карте
+'moving', фронт перестает отдавать его обновления воркеру и, когда
+начатые обработаны, отмечает 'held'. Дальше:
+
+1. на шарде-получателе удаляются остатки пользователя от прошлых попыток;
+2. копируются его категории, цели, бюджеты, взносы и транзакции с новыми
+   id (ссылки пересчитываются), в том числе строки из файлов архива
+   источника - у получателя они лежат в основной таблице до следующего
+   manage.py archive; дневные сводки пересчитываются;
+3. карта указывает на получателя, придержанные обновления уходят туда;
+4. данные пользователя удаляются с источника, включая файлы архива.
+
+До шага 3 пользователя обслуживает источник, и сбой на любом шаге
+оставляет его там: повторный запуск начинает с чистого листа. Сбой
+после шага 3 оставляет на источнике копию, которую удалит следующий
+перенос пользователя на этот шард (шаг 1). Сценарий, начатый в диалоге
+(FSM), не переносится: пользователь начнет его заново.
+
+Кэши воркера-источника (бюджеты, накопления) про ушедшего пользователя
+доживают до своего TTL, поэтому вернуть пользователя на прежний шард
+можно не раньше, чем через SHARD_MOVE_COOLDOWN секунд.
+"""
+import contextlib
+import logging
+import os
+import sqlite3
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+
+from archive import SCHEMA as ARCHIVE_SCHEMA
+from config import Config
+from migrations import ROLLUP_BACKFILL_SQL, upgrade
+from sharding import ACTIVE, HELD, MOVING, default_shard
+
+logger = logging.getLogger(__name__)
+
+SOURCE = "source"  # Имя подключенной базы источника в запросах
+
+# Транзакции пользователя из подключенной базы с новыми id категорий
+COPY_TRANSACTIONS_SQL = """
+    INSERT INTO main.transactions (user_id, amount, category_id, is_income, created_at)
+    SELECT t.user_id, t.amount, m.new_id, t.is_income, t.created_at
+    FROM {schema}.transactions AS t LEFT JOIN temp.category_map AS m ON m.old_id = t.category_id
+    WHERE t.user_id = ?{condition}
+    ORDER BY t.id
+"""
+# Из файла архива - только поколения, уже удаленные из основной базы (см. archive.py)
+ARCHIVED_CONDITION = " AND t.gen <= ?"
+
+# Дневные сводки одного пользователя (ROLLUP_BACKFILL_SQL с фильтром)
+USER_ROLLUPS_SQL = ROLLUP_BACKFILL_SQL.replace("WHERE user_id IS NOT NULL", "WHERE user_id = :user_id")
+
+
+class MoveError(Exception):
+    """Перенос невозможен; пользователь остался на прежнем шарде"""
+
+
+def shard_path(shard: int) -> str:
+    return make_url(Config.SHARD_DB_URL.format(shard=shard)).database
+
+
+def prepare_shard(shard: int) -> str:
+    """Приводит схему базы шарда к последней версии, возвращает путь к файлу"""
+    engine = create_engine(Config.SHARD_DB_URL.format(shard=shard))
+    try:
+        upgrade(engine)
+    finally:
+        engine.dispose()
+    return shard_path(shard)
+
+
+def _connect(path: str):
+    return sqlite3.connect(path, timeout=Config.SQLITE_BUSY_TIMEOUT / 1000, isolation_level=None)
+
+
+@contextlib.contextmanager
+def _transaction(conn):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+@contextlib.contextmanager
+def _attached(conn, path: str, name: str):
+    """ATTACH вне транзакции; SQLite подключает не больше 10 баз, поэтому по одной"""
+    conn.execute(f"ATTACH DATABASE ? AS {name}", (path,))
+    try:
+        yield conn
+    finally:
+        conn.execute(f"DETACH DATABASE {name}")
+
+
+def _archive_files(conn, schema: str = "main") -> list:
+    return [path for path, in conn.execute(f"SELECT path FROM {schema}.archived_years ORDER BY year")]
+
+
+def _archive_generations(conn, schema: str = "main") -> list:
+    """[(путь файла архива, последнее поколение, удаленное из основной базы), ...]"""
+    return conn.execute(f"SELECT path, gen FROM {schema}.archived_years ORDER BY year").fetchall()
+
+
+def _fsm_keys(conn, user_id: int) -> list:
+    """Ключи состояний FSM пользователя (bot:chat:user:thread:connection:destiny)"""
+    rows = conn.execute("SELECT key FROM fsm_states WHERE key LIKE ?", (f"%:{user_id}:%",)).fetchall()
+    return [(key,) for key, in rows if key.split(":")[2] == str(user_id)]
+
+
+def delete_user(conn, user_id: int) -> int:
+    """Удаляет данные пользователя из базы шарда и ее архива, возвращает число транзакций"""
+    with _transaction(conn):
+        deleted = conn.execute("DELETE FROM transactions WHERE user_id = ?", (user_id,)).rowcount
+        for table in ("savings_deposits", "savings_goals", "budgets", "categories", "daily_rollups", "yearly_rollups"):
+            conn.execute(f"DELETE FROM {table} WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM users WHERE telegram_id = ?", (user_id,))
+        conn.executemany("DELETE FROM fsm_states WHERE key = ?", _fsm_keys(conn, user_id))
+    for path in _archive_files(conn):
+        if not os.path.exists(path):
+            continue
+        with _attached(conn, path, ARCHIVE_SCHEMA), _transaction(conn):
+            deleted += conn.execute(
+                f"DELETE FROM {ARCHIVE_SCHEMA}.transactions WHERE user_id = ?", (user_id,)
+            ).rowcount
+            conn.execute(
+                f"UPDATE archived_years SET tx_count = (SELECT COUNT(*) FROM {ARCHIVE_SCHEMA}.transactions) "
+                "WHERE path = ?", (path,)
+            )
+    return deleted
+
+
+def _copy_rows(conn, table: str, columns: list, user_id: int, remap: dict = None) -> dict:
+    """Копирует строки пользователя из источника с новыми id, возвращает {старый id: новый}.
+    remap: {колонка: {старый id: новый}} для ссылок на уже скопированные строки."""
+    remap = {columns.index(column): ids for column, ids in (remap or {}).items()}
+    listed = ", ".join(columns)
+    insert = f"INSERT INTO main.{table} ({listed}) VALUES ({', '.join('?' * len(columns))})"
+    ids = {}
+    rows = conn.execute(f"SELECT id, {listed} FROM {SOURCE}.{table} WHERE user_id = ? ORDER BY id", (user_id,))
+    for old_id, *values in rows.fetchall():
+        for index, mapping in remap.items():
+            values[index] = mapping.get(values[index])
+        ids[old_id] = conn.execute(insert, values).lastrowid
+    return ids
+
+
+def copy_user(conn, source_path: str, user_id: int) -> int:
+    """Копирует пользователя из базы source_path в базу conn, возвращает число транзакций"""
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS category_map (old_id INTEGER PRIMARY KEY, new_id INTEGER)")
+    with _attached(conn, source_path, SOURCE):
+        archives = _archive_generations(conn, SOURCE)
+        with _transaction(conn):
+            conn.execute(
+                f"INSERT OR IGNORE INTO main.users (telegram_id, created_at) "
+                f"SELECT telegram_id, created_at FROM {SOURCE}.users WHERE telegram_id = ?", (user_id,)
+            )
+            categories = _copy_rows(conn, "categories", ["name", "user_id"], user_id)
+            goals = _copy_rows(conn, "savings_goals", [
+                "user_id", "name", "target_amount", "current_amount", "target_date", "created_at"
+            ], user_id)
+            _copy_rows(conn, "budgets", [
+                "user_id", "category_id", "amount", "period", "start_date", "current_spent", "alert_level"
+            ], user_id, remap={"category_id": categories})
+            _copy_rows(conn, "savings_deposits", ["goal_id", "user_id", "amount", "created_at"], user_id,
+                       remap={"goal_id": goals})
+            conn.execute("DELETE FROM temp.category_map")
+            conn.executemany("INSERT INTO temp.category_map VALUES (?, ?)", categories.items())
+            copied = conn.execute(
+                COPY_TRANSACTIONS_SQL.format(schema=SOURCE, condition=""), (user_id,)
+            ).rowcount
+    for path, gen in archives:
+        if not os.path.exists(path):
+            raise MoveError(f"Нет файла архива источника {path}")
+        with _attached(conn, path, ARCHIVE_SCHEMA), _transaction(conn):
+            copied += conn.execute(
+                COPY_TRANSACTIONS_SQL.format(schema=ARCHIVE_SCHEMA, condition=ARCHIVED_CONDITION), (user_id, gen)
+            ).rowcount
+    with _transaction(conn):
+        conn.execute("DELETE FROM daily_rollups WHERE user_id = ?", (user_id,))
+        conn.execute(USER_ROLLUPS_SQL, {"user_id": user_id})
+    return copied
+
+
+def _wait_held(shard_map, user_id: int, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if shard_map.lookup(user_id)[1] == HELD:
+            return
+        time.sleep(0.1)
+    raise MoveError(
+        f"Фронт не придержал обновления пользователя {user_id} за {timeout} с "
+        "(фронт не запущен? тогда --offline)"
+    )
+
+
+def check_move(shard_map, user_id: int, target: int, now: float = None):
+    """Шард пользователя, если его можно перенести на target; иначе MoveError"""
+    source, state, previous, moved_at = shard_map.lookup(user_id)
+    if not 0 <= target < shard_map.count:
+        raise MoveError(f"Нет шарда {target}: их {shard_map.count}")
+    if target == source:
+        raise MoveError(f"Пользователь {user_id} уже на шарде {target}")
+    if state != ACTIVE:
+        raise MoveError(f"Пользователь {user_id} уже переносится ({state})")
+    now = time.time() if now is None else now
+    if previous == target and moved_at is not None and now - moved_at < Config.SHARD_MOVE_COOLDOWN:
+        left = int(Config.SHARD_MOVE_COOLDOWN - (now - moved_at))
+        raise MoveError(f"Пользователь {user_id} ушел с шарда {target} недавно, вернуть можно через {left} с")
+    return source
+
+
+def move_user(shard_map, user_id: int, target: int, offline: bool = False) -> int:
+    """Переносит пользователя на шард target, возвращает число перенесенных транзакций.
+    offline - фронт остановлен, придерживать обновления некому."""
+    source = check_move(shard_map, user_id, target)
+    source_path, target_path = prepare_shard(source), prepare_shard(target)
+    shard_map.set_state(user_id, source, HELD if offline else MOVING)
+    try:
+        if not offline:
+            _wait_held(shard_map, user_id, Config.SHARD_MOVE_TIMEOUT)
+        conn = _connect(target_path)
+        try:
+            delete_user(conn, user_id)
+            copied = copy_user(conn, source_path, user_id)
+        finally:
+            conn.close()
+    except BaseException:
+        shard_map.set_state(user_id, source, ACTIVE)
+        raise
+    shard_map.assign(user_id, target, source)
+    conn = _connect(source_path)
+    try:
+        delete_user(conn, user_id)
+    finally:
+        conn.close()
+    logger.info(f"Пользователь {user_id} перенесен: шард {source} -> {target}, {copied} транзакций")
+    return copied
+
+
+def shard_users(shard_map) -> list:
+    """Для каждого шарда {user_id: транзакций в основной таблице} его пользователей по карте"""
+    pinned = dict(shard_map.conn.execute("SELECT user_id, shard FROM user_shards"))
+    result = []
+    for shard in range(shard_map.count):
+        path = shard_path(shard)
+        users = {}
+        if os.path.exists(path):
+            conn = _connect(path)
+            try:
+                for user_id, count in conn.execute(
+                    "SELECT user_id, COUNT(*) FROM transactions WHERE user_id IS NOT NULL GROUP BY user_id"
+                ):
+                    # Остатки после сбоя переноса не считаются: пользователь уже на другом шарде
+                    if pinned.get(user_id, default_shard(user_id, shard_map.count)) == shard:
+                        users[user_id] = count
+            finally:
+                conn.close()
+        result.append(users)
+    return result
+
+
+def plan(shard_map, max_moves: int) -> list:
+    """Жадный план выравнивания: [(user_id, откуда, куда, транзакций), ...]"""
+    users = shard_users(shard_map)
+    load = [sum(shard.values()) for shard in users]
+    now = time.time()
+    moves = []
+    while len(moves) < max_moves:
+        heavy = max(range(len(load)), key=load.__getitem__)
+        light = min(range(len(load)), key=load.__getitem__)
+        gap = load[heavy] - load[light]
+        candidates = []
+        for user_id, count in users[heavy].items():
+            # Перенос полезен, только если разница между шардами уменьшится
+            if not 0 < count < gap:
+                continue
+            try:
+                check_move(shard_map, user_id, light, now)
+            except MoveError:
+                continue
+            candidates.append((abs(gap / 2 - count), user_id, count))
+        if not candidates:
+            break
+        _, user_id, count = min(candidates)
+        del users[heavy][user_id]
+        users[light][user_id] = count
+        load[heavy] -= count
+        load[light] += count
+        moves.append((user_id, heavy, light, count))
+    return moves
+
+
+def pin_existing(shard_map) -> int:
+    """Закрепляет в карте пользователей, найденных в базах шардов, за их шардом"""
+    pinned = 0
+    for shard in range(shard_map.count):
+        path = shard_path(shard)
+        if not os.path.exists(path):
+            continue
+        conn = _connect(path)
+        try:
+            user_ids = [user_id for user_id, in conn.execute(
+                "SELECT telegram_id FROM users WHERE telegram_id IS NOT NULL "
+                "UNION SELECT DISTINCT user_id FROM transactions WHERE user_id IS NOT NULL"
+            )]
+        finally:
+            conn.close()
+        pinned += shard_map.pin(user_ids, shard)
+    return pinned
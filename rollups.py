@@ -0,0 +1,127 @@
+"""
+Дневные сводки транзакций (таблица daily_rollups).
+
+Каждая запись транзакции сразу увеличивает строку сводки
+(пользователь, тип, день, категория) в той же сессии и том же commit,
+поэтому отчеты читают сотни строк сводки вместо всей истории.
+
+Годы, перенесенные в архив (archive.py), представлены годовыми сводками
+yearly_rollups: суммы по категориям за период складывают дневные сводки
+с годовыми тех архивных лет, что целиком попадают в период.
+"""
+from datetime import date
+
+from sqlalchemy import func, select, text, union_all
+from sqlalchemy.dialects.sqlite import insert
+
+from migrations import ROLLUP_BACKFILL_SQL
+from models import Category, DailyRollup, Transaction, YearlyRollup
+
+
+def rollup_upsert(user_id: int, category_id: int, is_income: bool, day: date, amount: float, count: int = 1):
+    """Выражение INSERT ... ON CONFLICT, прибавляющее сумму к дневной сводке"""
+    stmt = insert(DailyRollup).values(
+        user_id=user_id,
+        is_income=bool(is_income),
+        day=day,
+        category_id=category_id,
+        total=amount,
+        tx_count=count,
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=[DailyRollup.user_id, DailyRollup.is_income, DailyRollup.day, DailyRollup.category_id],
+        set_={
+            "total": DailyRollup.total + stmt.excluded.total,
+            "tx_count": DailyRollup.tx_count + stmt.excluded.tx_count,
+        },
+    )
+
+
+def rollup_upsert_many():
+    """То же выражение для executemany: параметры - словари со всеми колонками сводки"""
+    stmt = insert(DailyRollup)
+    return stmt.on_conflict_do_update(
+        index_elements=[DailyRollup.user_id, DailyRollup.is_income, DailyRollup.day, DailyRollup.category_id],
+        set_={
+            "total": DailyRollup.total + stmt.excluded.total,
+            "tx_count": DailyRollup.tx_count + stmt.excluded.tx_count,
+        },
+    )
+
+
+async def add_transaction(session, transaction: Transaction) -> Transaction:
+    """Добавляет транзакцию в сессию и обновляет ее дневную сводку (commit делает вызывающий)"""
+    session.add(transaction)
+    await session.execute(rollup_upsert(
+        transaction.user_id,
+        transaction.category_id,
+        transaction.is_income,
+        transaction.created_at.date(),
+        transaction.amount,
+    ))
+    return transaction
+
+
+def period_rollups(user_id: int, day_from: date):
+    """
+    Строки сводок пользователя с day_from: дневные и годовые. Архивный год
+    попадает в период, только если начинается не раньше day_from; период
+    «За год» архивных лет не касается (ARCHIVE_HOT_MONTHS не меньше 12).
+    """
+    first_year = day_from.year if (day_from.month, day_from.day) == (1, 1) else day_from.year + 1
+    daily = select(
+        DailyRollup.is_income, DailyRollup.category_id, DailyRollup.total, DailyRollup.tx_count
+    ).filter(DailyRollup.user_id == user_id, DailyRollup.day >= day_from)
+    yearly = select(
+        YearlyRollup.is_income, YearlyRollup.category_id, YearlyRollup.total, YearlyRollup.tx_count
+    ).filter(YearlyRollup.user_id == user_id, YearlyRollup.year >= first_year)
+    return union_all(daily, yearly).subquery()
+
+
+def totals_by_category(user_id: int, day_from: date):
+    """Суммы доходов и расходов пользователя по категориям начиная с day_from"""
+    rollups = period_rollups(user_id, day_from)
+    return select(
+        rollups.c.is_income,
+        Category.name,
+        func.sum(rollups.c.total).label('total'),
+    ).outerjoin(Category, Category.id == rollups.c.category_id).group_by(rollups.c.is_income, Category.name)
+
+
+def monthly_totals(user_id: int, day_from: date):
+    """Доходы и расходы пользователя по месяцам ('ГГГГ-ММ') начиная с day_from (без архивных лет)"""
+    month = func.strftime('%Y-%m', DailyRollup.day).label('month')
+    return select(
+        month,
+        DailyRollup.is_income,
+        func.sum(DailyRollup.total).label('total'),
+    ).filter(
+        DailyRollup.user_id == user_id,
+        DailyRollup.day >= day_from,
+    ).group_by(month, DailyRollup.is_income).order_by(month)
+
+
+def category_stats(user_id: int):
+    """Категории пользователя с числом транзакций и суммой - один сгруппированный запрос"""
+    rollups = period_rollups(user_id, date.min)
+    stats = select(
+        rollups.c.category_id,
+        func.sum(rollups.c.tx_count).label('tx_count'),
+        func.sum(rollups.c.total).label('total'),
+    ).group_by(rollups.c.category_id).subquery()
+    return select(
+        Category.id,
+        Category.name,
+        func.coalesce(stats.c.tx_count, 0).label('tx_count'),
+        func.coalesce(stats.c.total, 0).label('total'),
+    ).outerjoin(stats, stats.c.category_id == Category.id).filter(
+        Category.user_id == user_id
+    ).order_by(Category.id)
+
+
+def rebuild(engine) -> int:
+    """Пересчитывает все сводки по таблице транзакций, возвращает число строк"""
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM daily_rollups"))
+        conn.execute(text(ROLLUP_BACKFILL_SQL))
+        return conn.execute(text("SELECT COUNT(*) FROM daily_rollups")).scalar()
@@ -0,0 +1,134 @@
+"""
+Пополнения целей накопления и прогноз их достижения.
+
+Каждое пополнение - строка журнала savings_deposits и увеличение
+savings_goals.current_amount прямо в SQL (current_amount + :amount)
+в одной транзакции. Одновременные пополнения одной цели не теряются,
+как при чтении суммы в Python и записи обратно.
+
+Меню целей показывает темп накопления и прогноз. Для них нужна сводка
+журнала по цели: сумма, число пополнений, первое и последнее. Сводки
+всех целей пользователя загружаются одним сгруппированным запросом,
+хранятся в кэше и дальше обновляются на месте при каждом пополнении,
+так что меню журнал не перечитывает.
+
+Темп - сумма пополнений, деленная на число дней от создания цели (или
+первого пополнения, если оно раньше) до сегодня. Пока прошло меньше
+SAVINGS_MIN_PACE_DAYS дней, темп не считается: одно пополнение в день
+создания цели дало бы прогноз «завтра».
+"""
+import math
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import func, insert, select, update
+
+from cache import TTLCache
+from models import SavingsDeposit, SavingsGoal
+
+
+class GoalSummary:
+    """Сводка журнала пополнений одной цели"""
+    __slots__ = ("total", "count", "first", "last")
+
+    def __init__(self, total=0.0, count=0, first=None, last=None):
+        self.total = total or 0.0
+        self.count = count or 0
+        self.first = first
+        self.last = last
+
+    def add(self, amount: float, when: datetime):
+        self.total += amount
+        self.count += 1
+        if self.first is None or when < self.first:
+            self.first = when
+        if self.last is None or when > self.last:
+            self.last = when
+
+
+class Projection:
+    """Прогноз по цели: темп в день, дата достижения и успевает ли цель к сроку"""
+    __slots__ = ("rate", "completion", "on_track", "required_rate")
+
+    def __init__(self, rate, completion, on_track, required_rate):
+        self.rate = rate  # ₽ в день
+        self.completion = completion  # date; None - темп нулевой
+        self.on_track = on_track  # None - срок не задан
+        self.required_rate = required_rate  # ₽ в день, чтобы успеть к сроку; None - срок не задан или прошел
+
+
+def project(goal, summary: GoalSummary, today: date, min_pace_days: int):
+    """Прогноз для цели (нужны поля target_amount, current_amount, target_date, created_at) или None"""
+    remaining = goal.target_amount - (goal.current_amount or 0.0)
+    if remaining <= 0 or not summary.count:
+        return None
+    starts = [moment.date() for moment in (goal.created_at, summary.first) if moment is not None]
+    days = (today - min(starts)).days
+    if days < min_pace_days:
+        return None
+
+    rate = summary.total / days
+    completion = today + timedelta(days=math.ceil(remaining / rate)) if rate > 0 else None
+    on_track = required_rate = None
+    if goal.target_date:
+        deadline = goal.target_date.date() if isinstance(goal.target_date, datetime) else goal.target_date
+        on_track = completion is not None and completion <= deadline
+        if deadline > today:
+            required_rate = remaining / (deadline - today).days
+    return Projection(rate, completion, on_track, required_rate)
+
+
+class SavingsLedger:
+    """Журнал пополнений с атомарным увеличением суммы цели и кэшем сводок"""
+
+    def __init__(self, session_factory, read_session_factory, cache_size: int, ttl: float):
+        self.session_factory = session_factory
+        self.read_session_factory = read_session_factory
+        self.cache = TTLCache("savings_summaries", cache_size, ttl)
+
+    async def deposit(self, user_id: int, goal_id: int, amount: float):
+        """
+        Пополняет цель пользователя. Возвращает строку цели уже с новой суммой
+        (name, target_amount, current_amount, target_date) или None, если такой
+        цели у пользователя нет.
+        """
+        when = datetime.now()
+        async with self.session_factory() as session:
+            goal = (await session.execute(
+                update(SavingsGoal)
+                .where(SavingsGoal.id == goal_id, SavingsGoal.user_id == user_id)
+                .values(current_amount=func.coalesce(SavingsGoal.current_amount, 0) + amount)
+                .returning(
+                    SavingsGoal.name, SavingsGoal.target_amount,
+                    SavingsGoal.current_amount, SavingsGoal.target_date
+                )
+            )).first()
+            if goal is None:
+                return None
+            await session.execute(insert(SavingsDeposit).values(
+                goal_id=goal_id, user_id=user_id, amount=amount, created_at=when
+            ))
+            await session.commit()
+
+        # Сводки в кэше дополняются только после commit
+        summaries = self.cache.get(user_id)
+        if summaries is not None:
+            summaries.setdefault(goal_id, GoalSummary()).add(amount, when)
+        return goal
+
+    async def summaries(self, user_id: int) -> dict:
+        """goal_id -> GoalSummary для всех целей пользователя, у которых есть пополнения"""
+        summaries = self.cache.get(user_id)
+        if summaries is None:
+            async with self.read_session_factory() as session:
+                rows = (await session.execute(
+                    select(
+                        SavingsDeposit.goal_id,
+                        func.sum(SavingsDeposit.amount),
+                        func.count(),
+                        func.min(SavingsDeposit.created_at),
+                        func.max(SavingsDeposit.created_at),
+                    ).filter(SavingsDeposit.user_id == user_id).group_by(SavingsDeposit.goal_id)
+                )).all()
+            summaries = {goal_id: GoalSummary(*values) for goal_id, *values in rows}
+            self.cache.set(user_id, summaries)
+        return summaries
@@ -0,0 +1,174 @@
+"""
+Автоматическое обнуление бюджетов по окончании периода.
+
+Периоды бюджетов календарные: день заканчивается в полночь, неделя -
+в понедельник, месяц - первого числа, год - первого января. Планировщик
+держит min-heap ближайших границ периодов и спит до самой ранней из них,
+не перебирая все бюджеты на каждом шаге. Истекшие бюджеты сбрасываются
+пачкой: один UPDATE на каждое новое начало периода, все в одном commit.
+
+При старте выполняется догоняющий проход: бюджеты, период которых
+закончился, пока бот был выключен, сбрасываются сразу.
+
+С resync_interval планировщик еще и периодически сверяет расписание с
+таблицей budgets: у воркера шарда бюджеты появляются и исчезают в обход
+бота, когда пользователя переносят между шардами (manage.py move-user).
+"""
+import asyncio
+import heapq
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update
+
+from models import Budget
+
+logger = logging.getLogger(__name__)
+
+PERIODS = ("день", "неделя", "месяц", "год")
+
+
+def window_start(moment: datetime, period: str) -> datetime:
+    """Начало календарного периода, в который попадает moment"""
+    day = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == "день":
+        return day
+    if period == "неделя":
+        return day - timedelta(days=day.weekday())
+    if period == "месяц":
+        return day.replace(day=1)
+    if period == "год":
+        return day.replace(month=1, day=1)
+    raise ValueError(f"Неизвестный период бюджета: {period}")
+
+
+def window_end(moment: datetime, period: str) -> datetime:
+    """Граница, на которой заканчивается период, содержащий moment"""
+    start = window_start(moment, period)
+    if period == "день":
+        return start + timedelta(days=1)
+    if period == "неделя":
+        return start + timedelta(weeks=1)
+    if period == "месяц":
+        return start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+    return start.replace(year=start.year + 1)
+
+
+class BudgetScheduler:
+    """Сбрасывает current_spent бюджетов на границах их периодов"""
+
+    def __init__(self, session_factory, max_sleep: float = 300, on_rollover=None, resync_interval=None):
+        self.session_factory = session_factory
+        self.max_sleep = max_sleep  # Страховка от перевода системных часов
+        self.on_rollover = on_rollover  # Вызывается со списком id сброшенных бюджетов
+        self.resync_interval = resync_interval  # секунд; None - расписание меняет только schedule
+        self.rolled_over = 0
+        self._heap = []  # (граница, budget_id, period)
+        self._due = {}  # budget_id -> актуальная граница; устаревшие записи heap пропускаются
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._next_resync = None
+
+    def schedule(self, budget_id: int, period: str, start_date: datetime):
+        """Ставит (или переставляет) бюджет на границу его текущего периода"""
+        if period not in PERIODS:
+            logger.warning(f"Бюджет {budget_id}: неизвестный период {period!r}, сброс не планируется")
+            return
+        boundary = window_end(start_date or datetime.now(), period)
+        self._due[budget_id] = boundary
+        if not self._heap or boundary < self._heap[0][0]:
+            self._wakeup.set()
+        heapq.heappush(self._heap, (boundary, budget_id, period))
+
+    async def start(self):
+        """Загружает бюджеты, догоняет пропущенные сбросы и запускает цикл"""
+        await self.resync()
+        caught_up = await self._rollover_due()
+        if caught_up:
+            logger.info(f"Догоняющий сброс бюджетов после простоя: {caught_up}")
+        self._task = asyncio.create_task(self._run())
+
+    async def resync(self) -> int:
+        """Ставит в расписание бюджеты, которых в нем нет, и забывает удаленные; возвращает число новых"""
+        async with self.session_factory() as session:
+            rows = (await session.execute(select(Budget.id, Budget.period, Budget.start_date))).all()
+        added = 0
+        for row in rows:
+            if row.id not in self._due:
+                self.schedule(row.id, row.period, row.start_date)
+                added += 1
+        for budget_id in self._due.keys() - {row.id for row in rows}:
+            del self._due[budget_id]  # Запись в heap станет устаревшей и будет пропущена
+        if self.resync_interval:
+            self._next_resync = datetime.now() + timedelta(seconds=self.resync_interval)
+        return added
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _pop_due(self, now: datetime):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            boundary, budget_id, period = heapq.heappop(self._heap)
+            if self._due.get(budget_id) == boundary:
+                del self._due[budget_id]
+                due.append((budget_id, period))
+        return due
+
+    async def _rollover_due(self) -> int:
+        now = datetime.now()
+        due = self._pop_due(now)
+        if not due:
+            return 0
+        # Один UPDATE на каждое новое начало периода
+        groups = {}
+        for budget_id, period in due:
+            groups.setdefault((period, window_start(now, period)), []).append(budget_id)
+        try:
+            async with self.session_factory() as session:
+                for (_, start), ids in groups.items():
+                    await session.execute(
+                        update(Budget).where(Budget.id.in_(ids)).values(
+                            current_spent=0, alert_level=0, start_date=start
+                        )
+                    )
+                await session.commit()
+        except Exception:
+            # Повторим через минуту, бюджеты не должны выпасть из расписания
+            retry_at = now + timedelta(minutes=1)
+            for budget_id, period in due:
+                self._due[budget_id] = retry_at
+                heapq.heappush(self._heap, (retry_at, budget_id, period))
+            raise
+        for (period, start), ids in groups.items():
+            for budget_id in ids:
+                self.schedule(budget_id, period, start)
+        if self.on_rollover:
+            self.on_rollover([budget_id for budget_id, _ in due])
+        self.rolled_over += len(due)
+        return len(due)
+
+    async def _run(self):
+        while True:
+            try:
+                if self._next_resync and datetime.now() >= self._next_resync:
+                    added = await self.resync()
+                    if added:
+                        logger.info(f"В расписание добавлены бюджеты из базы: {added}")
+                rolled = await self._rollover_due()
+                if rolled:
+                    logger.info(f"Начат новый период для бюджетов: {rolled}")
+            except Exception as e:
+                logger.error(f"Ошибка сброса бюджетов: {e}")
+            timeout = self.max_sleep
+            if self._heap:
+                timeout = min(timeout, max((self._heap[0][0] - datetime.now()).total_seconds(), 0))
+            if self._next_resync:
+                timeout = min(timeout, max((self._next_resync - datetime.now()).total_seconds(), 0))
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,63 @@
+"""
+Экраны меню, которые правятся на месте (NAVIGATION_MODE=inline).
+
+В режиме inline главное меню, бюджеты, накопления и категории - это одно
+сообщение с inline-клавиатурой. Нажатие кнопки меняет текст и клавиатуру
+этого же сообщения (editMessageText) вместо отправки нового, и история
+чата не растет.
+
+ScreenTracker помнит для каждого чата последнее сообщение-экран и отпечаток
+его содержимого. Если экран после нажатия выглядит так же, как уже
+показанный (повторное нажатие «Бюджеты», обновление без изменений), правка
+не отправляется вовсе. Ответ на введенный текст (сумма, название) остается
+новым сообщением и становится текущим экраном чата.
+"""
+import hashlib
+import logging
+
+from aiogram.exceptions import TelegramBadRequest
+
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+def fingerprint(text: str, reply_markup, parse_mode) -> str:
+    markup = reply_markup.model_dump_json(exclude_none=True) if reply_markup is not None else ""
+    return hashlib.sha1(f"{parse_mode}\0{text}\0{markup}".encode()).hexdigest()
+
+
+class ScreenTracker:
+    """Текущее сообщение-экран по чатам: chat_id -> (message_id, отпечаток)"""
+
+    def __init__(self, cache_size: int, ttl: float):
+        self.cache = TTLCache("screens", cache_size, ttl)
+        self.sent = 0
+        self.edited = 0
+        self.skipped = 0
+
+    async def send(self, message, text: str, reply_markup=None, parse_mode=None):
+        """Новое сообщение-экран в чат message"""
+        sent = await message.answer(text, reply_markup=reply_markup, parse_mode=parse_mode)
+        self.sent += 1
+        self.cache.set(message.chat.id, (sent.message_id, fingerprint(text, reply_markup, parse_mode)))
+        return sent
+
+    async def edit(self, message, text: str, reply_markup=None, parse_mode=None):
+        """Показывает экран в сообщении message (нажатом); без изменений - без запроса к Bot API"""
+        digest = fingerprint(text, reply_markup, parse_mode)
+        if self.cache.get(message.chat.id) == (message.message_id, digest):
+            self.skipped += 1
+            return
+        try:
+            await message.edit_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+            self.edited += 1
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                self.skipped += 1  # Экран после перезапуска бота: кэш пуст, сообщение то же
+            else:
+                # Сообщение удалено или слишком старое для правки
+                logger.info(f"Экран в чате {message.chat.id} не изменить ({e}), отправляю заново")
+                await self.send(message, text, reply_markup, parse_mode)
+                return
+        self.cache.set(message.chat.id, (message.message_id, digest))
@@ -0,0 +1,532 @@
+"""
+Шардирование пользователей между процессами-воркерами.
+
+Один процесс бота упирается в одно ядро и в единственного писателя
+SQLite. Команда
+
+    SHARD_COUNT=4 python sharding.py
+
+запускает фронт и SHARD_COUNT воркеров. Воркер - обычный bot.py в режиме
+webhook на локальном порту SHARD_WORKER_PORT + N со своей базой
+SHARD_DB_URL (та же схема models.py и migrations.py). Фронт получает
+обновления от Telegram так же, как бот (DELIVERY_MODE: polling или
+webhook), и пересылает каждое воркеру шарда его пользователя
+(from_user.id). Обновления одного пользователя уходят воркеру строго по
+одному и по порядку, разных - параллельно, не больше SHARD_MAX_CONCURRENCY.
+
+Закрепление пользователей хранит карта шардов (SHARD_MAP_PATH, SQLite).
+Новый пользователь попадает на шард user_id % SHARD_COUNT и тут же
+закрепляется за ним, поэтому смена SHARD_COUNT старых пользователей не
+двигает: переносит их manage.py move-user и rebalance (см. rebalance.py).
+Пока пользователь переносится ('moving'), фронт придерживает его новые
+обновления, а когда у воркеров не остается его необработанных, отмечает в
+карте 'held': с этого момента данные пользователя можно копировать.
+
+Ответ воркера с методом Bot API (answerCallbackQuery, см. webhook.py)
+фронт в режиме webhook отдает Telegram в ответе на запрос, в режиме
+polling вызывает сам. Лимит отправки на бота делится между воркерами
+поровну (OUTBOUND_GLOBAL_RATE / SHARD_COUNT).
+
+Все процессы работают на одной машине; упавший воркер перезапускается,
+а его обновления ждут, пока он снова не начнет принимать запросы.
+"""
+import asyncio
+import logging
+import os
+import secrets
+import signal
+import sqlite3
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+from config import Config
+from webhook import SECRET_HEADER
+
+logger = logging.getLogger(__name__)
+
+ACTIVE, MOVING, HELD = "active", "moving", "held"
+WORKER_PATH = "/update"
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+POLL_TIMEOUT = 30  # секунд long polling getUpdates
+FORWARD_RETRY_DELAY = 0.5  # секунд между попытками передать обновление воркеру
+FORWARD_GIVE_UP = 60  # секунд, после которых обновление пропускается
+
+MAP_SCHEMA_SQL = [
+    """CREATE TABLE IF NOT EXISTS user_shards (
+        user_id INTEGER NOT NULL,
+        shard INTEGER NOT NULL,
+        state VARCHAR NOT NULL DEFAULT 'active',
+        previous_shard INTEGER,
+        moved_at FLOAT,
+        PRIMARY KEY (user_id)
+    )""",
+    # Фронт перечитывает только переносимых и перенесенных с прошлой проверки
+    "CREATE INDEX IF NOT EXISTS ix_user_shards_state ON user_shards (state)",
+    "CREATE INDEX IF NOT EXISTS ix_user_shards_moved ON user_shards (moved_at)",
+]
+
+
+def default_shard(user_id: int, count: int) -> int:
+    return user_id % count
+
+
+def route_key(update: dict):
+    """Чей шард обслуживает обновление: id пользователя, иначе чата; None - любой"""
+    for kind, payload in update.items():
+        if kind == "update_id" or not isinstance(payload, dict):
+            continue
+        user = payload.get("from") or payload.get("user")
+        if user:
+            return user["id"]
+        chat = payload.get("chat") or (payload.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+    return None
+
+
+class ShardMap:
+    """Карта шардов: user_id -> (шард, состояние), в памяти фронта и в файле SQLite"""
+
+    def __init__(self, path: str, count: int):
+        self.count = count
+        self.conn = sqlite3.connect(path, timeout=Config.SQLITE_BUSY_TIMEOUT / 1000, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        for sql in MAP_SCHEMA_SQL:
+            self.conn.execute(sql)
+        self.users = {}
+        self._new = {}  # Еще не записанные закрепления новых пользователей
+        self._data_version = None
+        self._moved_since = 0.0
+
+    def close(self):
+        self.conn.close()
+
+    # Фронт: закрепления в памяти, файл перечитывается только после чужих изменений
+
+    def load(self) -> bool:
+        """Подтягивает изменения карты, сделанные другими процессами; True - что-то изменилось"""
+        version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if version == self._data_version:
+            return False
+        if self._data_version is None:
+            rows = self.conn.execute("SELECT user_id, shard, state, moved_at FROM user_shards").fetchall()
+        else:
+            rows = self.conn.execute(
+                "SELECT user_id, shard, state, moved_at FROM user_shards WHERE state != ? OR moved_at >= ?",
+                (ACTIVE, self._moved_since)
+            ).fetchall()
+            # Переносы, отмененные по тайм-ауту: пользователь снова active на прежнем шарде
+            listed = {row[0] for row in rows}
+            for user_id, (shard, state) in list(self.users.items()):
+                if state != ACTIVE and user_id not in listed:
+                    self.users[user_id] = (shard, ACTIVE)
+        self._data_version = version
+        for user_id, shard, state, moved_at in rows:
+            self.users[user_id] = (shard, state)
+            if moved_at is not None:
+                # С запасом: перенос мог закончиться в ту же секунду, что и прошлая проверка
+                self._moved_since = max(self._moved_since, moved_at - 1)
+        return True
+
+    def get(self, user_id: int):
+        """(шард, состояние); нового пользователя закрепляет за шардом по умолчанию"""
+        entry = self.users.get(user_id)
+        if entry is None:
+            entry = (default_shard(user_id, self.count), ACTIVE)
+            self.users[user_id] = self._new[user_id] = entry
+        return entry
+
+    def flush(self):
+        """Записывает закрепления новых пользователей; уже закрепленных не трогает"""
+        if not self._new:
+            return
+        new, self._new = self._new, {}
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO user_shards (user_id, shard) VALUES (?, ?)",
+                [(user_id, shard) for user_id, (shard, _) in new.items()]
+            )
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            self._new.update(new)
+            raise
+
+    def hold(self, user_ids) -> list:
+        """Отмечает переносимых пользователей придержанными, возвращает отмеченных"""
+        held = []
+        for user_id in user_ids:
+            if self.conn.execute(
+                "UPDATE user_shards SET state = ? WHERE user_id = ? AND state = ?", (HELD, user_id, MOVING)
+            ).rowcount:
+                self.users[user_id] = (self.users[user_id][0], HELD)
+                held.append(user_id)
+        return held
+
+    # manage.py: чтение и запись напрямую в файл
+
+    def lookup(self, user_id: int):
+        """(шард, состояние, прежний шард, время переноса) из файла; новый - шард по умолчанию"""
+        row = self.conn.execute(
+            "SELECT shard, state, previous_shard, moved_at FROM user_shards WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return row or (default_shard(user_id, self.count), ACTIVE, None, None)
+
+    def set_state(self, user_id: int, shard: int, state: str):
+        self.conn.execute(
+            "INSERT INTO user_shards (user_id, shard, state) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET shard = excluded.shard, state = excluded.state",
+            (user_id, shard, state)
+        )
+
+    def assign(self, user_id: int, shard: int, previous_shard: int):
+        """Завершает перенос: пользователь на шарде shard, его обновления больше не придерживаются"""
+        self.conn.execute(
+            "UPDATE user_shards SET shard = ?, state = ?, previous_shard = ?, moved_at = ? WHERE user_id = ?",
+            (shard, ACTIVE, previous_shard, time.time(), user_id)
+        )
+
+    def pin(self, user_ids, shard: int) -> int:
+        """Закрепляет за шардом пользователей, еще не записанных в карту"""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            pinned = self.conn.executemany(
+                "INSERT OR IGNORE INTO user_shards (user_id, shard) VALUES (?, ?)",
+                [(user_id, shard) for user_id in user_ids]
+            ).rowcount
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return pinned
+
+
+class Front:
+    """Раздает обновления воркерам шардов с порядком внутри пользователя"""
+
+    def __init__(self, shard_map: ShardMap, worker_urls, secret: str, max_concurrency: int, max_pending: int):
+        self.shard_map = shard_map
+        self.worker_urls = worker_urls
+        self.secret = secret
+        self.max_pending = max_pending
+        self.pending = 0
+        self.forwarded = 0
+        self.session = None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._locks = {}  # ключ -> (Lock, число обновлений в очереди ключа)
+        self._forwarding = {}  # ключ -> обновлений этого ключа у воркера прямо сейчас
+        self._capacity = asyncio.Event()
+        self._capacity.set()
+        self._map_changed = asyncio.Event()
+        self._refresh_task = None
+
+    async def start(self):
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None))
+        self.shard_map.load()
+        self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def close(self):
+        if self._refresh_task:
+            self._refresh_task.cancel()
+        self.shard_map.flush()
+        if self.session:
+            await self.session.close()
+
+    async def drain(self, timeout: float):
+        """Ждет, пока разойдутся принятые обновления (не дольше timeout секунд)"""
+        deadline = time.monotonic() + timeout
+        while self.pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    def refresh(self):
+        if self.shard_map.load():
+            changed, self._map_changed = self._map_changed, asyncio.Event()
+            changed.set()
+        moving = [
+            user_id for user_id, (_, state) in self.shard_map.users.items()
+            if state == MOVING and not self._forwarding.get(user_id)
+        ]
+        if moving:
+            for user_id in self.shard_map.hold(moving):
+                logger.info(f"Пользователь {user_id} переносится, его обновления придержаны")
+        self.shard_map.flush()
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(Config.SHARD_MAP_REFRESH)
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Ошибка обновления карты шардов: {e}")
+
+    async def _shard_for(self, key) -> int:
+        if key is None:
+            return 0
+        while True:
+            shard, state = self.shard_map.get(key)
+            if state == ACTIVE:
+                return shard
+            await self._map_changed.wait()
+
+    async def dispatch(self, update: dict):
+        """Передает обновление воркеру; возвращает метод Bot API из ответа воркера или None"""
+        key = route_key(update)
+        lock, queued = self._locks.get(key, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._locks[key] = (lock, queued + 1)
+        self.pending += 1
+        if self.pending >= self.max_pending:
+            self._capacity.clear()
+        try:
+            async with lock:
+                shard = await self._shard_for(key)
+                # Сразу после выбора шарда: иначе перенос мог бы начаться, пока ждем семафор
+                self._forwarding[key] = self._forwarding.get(key, 0) + 1
+                try:
+                    async with self._semaphore:
+                        return await self._forward(shard, update)
+                finally:
+                    self._forwarding[key] -= 1
+                    if not self._forwarding[key]:
+                        del self._forwarding[key]
+        finally:
+            lock, queued = self._locks[key]
+            if queued == 1:
+                del self._locks[key]
+            else:
+                self._locks[key] = (lock, queued - 1)
+            self.pending -= 1
+            if self.pending < self.max_pending:
+                self._capacity.set()
+
+    async def _forward(self, shard: int, update: dict):
+        url = self.worker_urls[shard]
+        deadline = time.monotonic() + FORWARD_GIVE_UP
+        while True:
+            try:
+                async with self.session.post(url, json=update, headers={SECRET_HEADER: self.secret}) as response:
+                    if response.status == 200:
+                        self.forwarded += 1
+                        body = await response.read()
+                        return await response.json() if body else None
+                    problem = f"HTTP {response.status}"
+            except aiohttp.ClientError as e:
+                problem = str(e) or e.__class__.__name__  # Воркер перезапускается
+            if time.monotonic() >= deadline:
+                logger.error(f"Обновление {update.get('update_id')} не передано шарду {shard}: {problem}")
+                return None
+            await asyncio.sleep(FORWARD_RETRY_DELAY)
+
+    async def wait_for_capacity(self):
+        await self._capacity.wait()
+
+
+class BotAPI:
+    """Минимальный клиент Bot API на сырых JSON: фронту не нужны модели aiogram"""
+
+    def __init__(self, session: aiohttp.ClientSession, token: str, base_url: str):
+        self.session = session
+        self.url = f"{(base_url or 'https://api.telegram.org').rstrip('/')}/bot{token}/"
+
+    async def call(self, method: str, request_timeout: float = 60, **params):
+        # Как aiogram: параметры None не передаются вовсе, а не как null
+        params = {key: value for key, value in params.items() if value is not None}
+        async with self.session.post(
+            self.url + method, json=params, timeout=aiohttp.ClientTimeout(total=request_timeout)
+        ) as response:
+            data = await response.json(content_type=None)
+        if not data.get("ok"):
+            raise RuntimeError(f"{method}: {data.get('description')}")
+        return data["result"]
+
+
+class Worker:
+    """Процесс bot.py одного шарда; перезапускается, если упал"""
+
+    def __init__(self, shard: int, port: int, env: dict):
+        self.shard = shard
+        self.port = port
+        self.env = env
+        self.process = None
+        self._stopping = False
+        self._task = None
+
+    async def start(self):
+        await self._spawn()
+        self._task = asyncio.create_task(self._supervise())
+
+    async def _spawn(self):
+        # Своя группа процессов: Ctrl+C получает только фронт, воркеров он останавливает сам
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, BOT_SCRIPT, env=self.env, start_new_session=True
+        )
+        logger.info(f"Воркер шарда {self.shard} запущен (pid {self.process.pid}, порт {self.port})")
+
+    async def wait_ready(self, timeout: float):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                _, writer = await asyncio.open_connection(Config.SHARD_WORKER_HOST, self.port)
+                writer.close()
+                return True
+            except OSError:
+                await asyncio.sleep(0.2)
+        return False
+
+    async def _supervise(self):
+        while True:
+            code = await self.process.wait()
+            if self._stopping:
+                return
+            logger.error(f"Воркер шарда {self.shard} завершился с кодом {code}, перезапуск")
+            await asyncio.sleep(1)
+            await self._spawn()
+
+    async def stop(self, timeout: float):
+        self._stopping = True
+        if self.process and self.process.returncode is None:
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                await asyncio.wait_for(self.process.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Воркер шарда {self.shard} не остановился за {timeout} с, kill")
+                self.process.kill()
+                await self.process.wait()
+        if self._task:
+            self._task.cancel()
+
+
+def worker_env(shard: int, port: int, secret: str, count: int) -> dict:
+    return dict(
+        os.environ,
+        SHARD_ID=str(shard),
+        DELIVERY_MODE="webhook",
+        WEBHOOK_HOST=Config.SHARD_WORKER_HOST,
+        WEBHOOK_PORT=str(port),
+        WEBHOOK_PATH=WORKER_PATH,
+        WEBHOOK_URL="",  # Воркер не регистрирует webhook: обновления ему передает фронт
+        WEBHOOK_SECRET=secret,
+        METRICS_PORT=str(Config.METRICS_PORT + shard),
+        OUTBOUND_GLOBAL_RATE=str(Config.OUTBOUND_GLOBAL_RATE / count),
+    )
+
+
+async def poll(front: Front, api: BotAPI, stop: asyncio.Event):
+    """Long polling: обновления раздаются воркерам, ответы воркеров вызываются здесь"""
+    async def handle(update):
+        method = await front.dispatch(update)
+        if method:
+            try:
+                await api.call(method.pop("method"), **method)
+            except Exception as e:
+                logger.error(f"Ошибка ответа на обновление {update.get('update_id')}: {e}")
+
+    offset = None
+    tasks = set()
+    while not stop.is_set():
+        await front.wait_for_capacity()
+        getting = asyncio.create_task(
+            api.call("getUpdates", POLL_TIMEOUT + 10, offset=offset, timeout=POLL_TIMEOUT)
+        )
+        stopping = asyncio.create_task(stop.wait())
+        await asyncio.wait({getting, stopping}, return_when=asyncio.FIRST_COMPLETED)
+        stopping.cancel()
+        if not getting.done():
+            getting.cancel()
+            break
+        try:
+            updates = getting.result()
+        except Exception as e:
+            logger.error(f"Ошибка getUpdates: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            offset = update["update_id"] + 1
+            task = asyncio.create_task(handle(update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    if offset is not None:
+        # Подтверждаем полученное, чтобы после перезапуска Telegram не прислал его снова
+        await api.call("getUpdates", offset=offset, timeout=0, limit=1)
+    if tasks:
+        await asyncio.wait(tasks, timeout=Config.WEBHOOK_SHUTDOWN_TIMEOUT)
+
+
+def create_app(front: Front) -> web.Application:
+    async def handle(request: web.Request) -> web.Response:
+        if Config.WEBHOOK_SECRET and request.headers.get(SECRET_HEADER) != Config.WEBHOOK_SECRET:
+            return web.Response(status=401)
+        if front.pending >= front.max_pending:
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        method = await front.dispatch(update)
+        return web.json_response(method) if method else web.Response()
+
+    app = web.Application()
+    app.router.add_post(Config.WEBHOOK_PATH, handle)
+    return app
+
+
+async def main():
+    count = Config.SHARD_COUNT
+    secret = secrets.token_urlsafe(32)  # Воркеры принимают обновления только от своего фронта
+    workers = [
+        Worker(shard, Config.SHARD_WORKER_PORT + shard, worker_env(shard, Config.SHARD_WORKER_PORT + shard, secret, count))
+        for shard in range(count)
+    ]
+    for worker in workers:
+        await worker.start()
+    for worker in workers:
+        if not await worker.wait_ready(60):
+            logger.error(f"Воркер шарда {worker.shard} не начал принимать запросы за 60 с")
+
+    front = Front(
+        ShardMap(Config.SHARD_MAP_PATH, count),
+        [f"http://{Config.SHARD_WORKER_HOST}:{worker.port}{WORKER_PATH}" for worker in workers],
+        secret,
+        max_concurrency=Config.SHARD_MAX_CONCURRENCY,
+        max_pending=Config.SHARD_MAX_PENDING,
+    )
+    await front.start()
+    api = BotAPI(front.session, Config.BOT_TOKEN, Config.BOT_API_URL)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    logger.info(f"Фронт запущен: {count} шардов, режим {Config.DELIVERY_MODE}")
+    try:
+        if Config.DELIVERY_MODE == "webhook":
+            runner = web.AppRunner(create_app(front), shutdown_timeout=Config.WEBHOOK_SHUTDOWN_TIMEOUT)
+            await runner.setup()
+            await web.TCPSite(runner, Config.WEBHOOK_HOST, Config.WEBHOOK_PORT).start()
+            if Config.WEBHOOK_URL:
+                await api.call(
+                    "setWebhook", url=Config.WEBHOOK_URL, secret_token=Config.WEBHOOK_SECRET or None,
+                    max_connections=min(Config.SHARD_MAX_CONCURRENCY, 100)
+                )
+            await stop.wait()
+            await runner.cleanup()  # Дожидается начатых запросов
+        else:
+            await poll(front, api, stop)
+        await front.drain(Config.WEBHOOK_SHUTDOWN_TIMEOUT)
+    finally:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(sig)
+        await front.close()
+        front.shard_map.close()
+        await asyncio.gather(*(worker.stop(Config.WEBHOOK_SHUTDOWN_TIMEOUT + 5) for worker in workers))
+        logger.info("Фронт остановлен")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
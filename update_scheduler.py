@@ -0,0 +1,106 @@
+"""
+Параллельная обработка обновлений с сохранением порядка внутри пользователя.
+
+aiogram при polling запускает каждое обновление отдельной задачей, а
+webhook обрабатывает запросы одновременно. Обновления разных пользователей
+от этого только выигрывают, но быстрые нажатия одного пользователя гонятся
+друг с другом: второе обновление читает состояние FSM до того, как первое
+его записало, и сценарии Form ломаются.
+
+OrderedDispatcher - Dispatcher, у которого feed_update (общий вход и для
+polling, и для webhook) сначала встает в очередь своего пользователя.
+Обновления одного пользователя выполняются строго по одному в порядке
+поступления, обновления разных пользователей - параллельно, но не больше
+UPDATE_MAX_CONCURRENCY одновременно. Очередь ждет до того, как
+FSM-middleware прочитает состояние, поэтому каждое обновление видит
+результат предыдущего.
+
+Ограничения очередей:
+  - у пользователя в очереди не больше UPDATE_USER_QUEUE обновлений,
+    лишние отбрасываются (так выглядит только залипшая кнопка или флуд);
+  - всего в обработке и ожидании не больше UPDATE_MAX_PENDING обновлений:
+    PollingBackpressure задерживает следующий getUpdates, пока очередь
+    не разгрузится, и необработанные обновления остаются у Telegram.
+"""
+import asyncio
+import logging
+
+from aiogram import Dispatcher
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
+from aiogram.methods import GetUpdates
+
+logger = logging.getLogger(__name__)
+
+
+def ordering_key(update):
+    """Чьи обновления нужно выполнять по порядку: пользователя, иначе чата"""
+    context = UserContextMiddleware.resolve_event_context(update)
+    if context.user is not None:
+        return context.user.id
+    if context.chat is not None:
+        return f"chat:{context.chat.id}"
+    return None
+
+
+class OrderedDispatcher(Dispatcher):
+    """Dispatcher с очередью на пользователя и общим ограничением параллельности"""
+
+    def __init__(self, *args, max_concurrency: int, max_user_queue: int, max_pending: int, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_user_queue = max_user_queue
+        self.max_pending = max_pending
+        self.pending = 0
+        self.dropped = 0
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._locks = {}  # ключ -> (Lock, число обновлений в очереди ключа)
+        self._capacity = asyncio.Event()
+        self._capacity.set()
+
+    async def feed_update(self, bot, update, **kwargs):
+        key = ordering_key(update)
+        if key is None:
+            async with self._semaphore:
+                return await super().feed_update(bot, update, **kwargs)
+
+        lock, queued = self._locks.get(key, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        elif queued >= self.max_user_queue:
+            self.dropped += 1
+            logger.warning(f"Очередь обновлений пользователя {key} переполнена, обновление {update.update_id} пропущено")
+            return UNHANDLED
+        self._locks[key] = (lock, queued + 1)
+        self.pending += 1
+        if self.pending >= self.max_pending:
+            self._capacity.clear()
+        try:
+            # asyncio.Lock отдает блокировку ожидающим строго по очереди
+            async with lock:
+                async with self._semaphore:
+                    return await super().feed_update(bot, update, **kwargs)
+        finally:
+            lock, queued = self._locks[key]
+            if queued == 1:
+                del self._locks[key]
+            else:
+                self._locks[key] = (lock, queued - 1)
+            self.pending -= 1
+            if self.pending < self.max_pending:
+                self._capacity.set()
+
+    async def wait_for_capacity(self):
+        await self._capacity.wait()
+
+
+class PollingBackpressure(BaseRequestMiddleware):
+    """Middleware сессии Bot: не забирать новые обновления, пока очередь переполнена"""
+
+    def __init__(self, dispatcher: OrderedDispatcher):
+        self.dispatcher = dispatcher
+
+    async def __call__(self, make_request, bot, method):
+        if isinstance(method, GetUpdates):
+            await self.dispatcher.wait_for_capacity()
+        return await make_request(bot, method)
@@ -0,0 +1,147 @@
+"""
+Прием обновлений через webhook вместо long polling.
+
+Встроенный aiohttp-сервер принимает POST с JSON обновления Telegram
+и передает его в тот же Dispatcher, что и polling. Одновременно
+обрабатывается не больше WEBHOOK_MAX_CONCURRENCY обновлений, еще
+WEBHOOK_MAX_PENDING ждут очереди; сверх этого сервер отвечает 503,
+и Telegram повторит доставку позже.
+
+Один вызов Bot API за обновление можно вернуть прямо в теле ответа на
+запрос Telegram (reply_in_response): так отвечаются нажатия inline-кнопок
+(answerCallbackQuery), и отдельного исходящего запроса они не требуют.
+Результат такого вызова недоступен, поэтому годится он только для методов,
+ответ которых не нужен.
+
+Для локальной проверки WEBHOOK_URL можно не задавать (set_webhook не
+вызывается) и отправлять обновления вручную:
+
+    DELIVERY_MODE=webhook python bot.py
+    curl -X POST localhost:8080/webhook -H 'Content-Type: application/json' \\
+         -d '{"update_id": 1, "message": {"message_id": 1, "date": 0,
+              "chat": {"id": 1, "type": "private"},
+              "from": {"id": 1, "is_bot": false, "first_name": "Test"},
+              "text": "/start"}}'
+"""
+import asyncio
+import contextvars
+import logging
+import signal
+
+from aiohttp import web
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+# Вызов Bot API для тела ответа на текущий запрос: список из не более чем одного
+# метода; None - обновление пришло не через webhook
+_response_method = contextvars.ContextVar("webhook_response_method", default=None)
+
+
+def reply_in_response(method) -> bool:
+    """
+    Отправляет method в теле ответа на запрос с текущим обновлением.
+    False - обновление не из webhook или место уже занято: вызовите метод сами.
+    """
+    slot = _response_method.get()
+    if slot is None or slot:
+        return False
+    slot.append(method)
+    return True
+
+
+def response_body(method) -> dict:
+    return {"method": method.__api_method__, **method.model_dump(mode="json", exclude_none=True)}
+
+
+class UpdateHandler:
+    """aiohttp-обработчик POST-запросов с обновлениями"""
+
+    def __init__(self, dp, bot, max_concurrency: int, max_pending: int, secret: str = ""):
+        self.dp = dp
+        self.bot = bot
+        self.secret = secret
+        self.max_pending = max_pending
+        self.pending = 0
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def __call__(self, request: web.Request) -> web.Response:
+        if self.secret and request.headers.get(SECRET_HEADER) != self.secret:
+            return web.Response(status=401)
+        if self.pending >= self.max_pending:
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        self.pending += 1
+        slot = []
+        token = _response_method.set(slot)
+        try:
+            async with self._semaphore:
+                await self.dp.feed_raw_update(self.bot, update)
+        except Exception as e:
+            # Обновление уже принято: повторная доставка не поможет
+            logger.error(f"Ошибка обработки обновления {update.get('update_id')}: {e}")
+        finally:
+            _response_method.reset(token)
+            self.pending -= 1
+        if slot:
+            return web.json_response(response_body(slot[0]))
+        return web.Response()
+
+
+def create_app(dp, bot) -> web.Application:
+    app = web.Application()
+    app.router.add_post(Config.WEBHOOK_PATH, UpdateHandler(
+        dp, bot,
+        max_concurrency=Config.WEBHOOK_MAX_CONCURRENCY,
+        max_pending=Config.WEBHOOK_MAX_PENDING,
+        secret=Config.WEBHOOK_SECRET,
+    ))
+
+    async def on_startup(app):
+        await dp.emit_startup(bot=bot)
+        if Config.WEBHOOK_URL:
+            await bot.set_webhook(
+                Config.WEBHOOK_URL,
+                secret_token=Config.WEBHOOK_SECRET or None,
+                max_connections=min(Config.WEBHOOK_MAX_CONCURRENCY, 100),
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+            logger.info(f"Webhook установлен: {Config.WEBHOOK_URL}")
+
+    async def on_cleanup(app):
+        # aiohttp вызывает cleanup после того, как начатые запросы доработали
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+async def run_webhook(dp, bot):
+    """Запускает сервер и работает до SIGINT/SIGTERM, затем корректно останавливается"""
+    runner = web.AppRunner(create_app(dp, bot), shutdown_timeout=Config.WEBHOOK_SHUTDOWN_TIMEOUT)
+    await runner.setup()
+    site = web.TCPSite(runner, Config.WEBHOOK_HOST, Config.WEBHOOK_PORT)
+    await site.start()
+    logger.info(f"Webhook-сервер слушает {Config.WEBHOOK_HOST}:{Config.WEBHOOK_PORT}{Config.WEBHOOK_PATH}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        # Новые соединения больше не принимаются, начатые обновления дорабатывают
+        # в пределах shutdown_timeout, затем срабатывает dp.emit_shutdown
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(sig)
+        await runner.cleanup()
@@ -0,0 +1,122 @@
+"""
+Групповая фиксация записей в БД.
+
+Обработчик передает функцию записи `async def work(session)` и ждет ее
+результат. WritePipeline копит такие функции от многих обработчиков и
+выполняет пачку в одной сессии с одним commit (один fsync на пачку).
+Пачка сбрасывается по таймеру или при достижении размера. Результат
+возвращается обработчику только после успешного commit, поэтому отвечать
+пользователю можно сразу после await.
+
+Если пачка падает, она откатывается, и каждая запись повторяется отдельно:
+ошибка одной записи не теряет остальные. Функции записи поэтому должны
+создавать свои объекты внутри себя и быть безопасны для повтора.
+
+DirectWriter - тот же интерфейс без группировки: сессия и commit на запись.
+"""
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class DirectWriter:
+    """Каждая запись в своей транзакции"""
+
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def submit(self, work):
+        async with self.session_factory() as session:
+            result = await work(session)
+            await session.commit()
+            return result
+
+
+class WritePipeline:
+    """Write-behind очередь: пачка записей от разных обработчиков - один commit"""
+
+    def __init__(self, session_factory, interval: float, max_batch: int):
+        self.session_factory = session_factory
+        self.interval = interval
+        self.max_batch = max_batch
+        self.batches = 0
+        self.writes = 0
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает цикл, дописывая все, что уже в очереди"""
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        self._queue.put_nowait(None)  # Маркер остановки встает после всех записей
+        await task
+
+    async def submit(self, work):
+        if self._task is None:
+            raise RuntimeError("WritePipeline не запущен")
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((work, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.interval
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        try:
+            async with self.session_factory() as session:
+                results = [await work(session) for work, _ in batch]
+                await session.commit()
+        except Exception as e:
+            logger.warning(f"Групповой commit из {len(batch)} записей не удался ({e}), повтор по одной")
+            for work, future in batch:
+                await self._flush_one(work, future)
+        else:
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        self.batches += 1
+        self.writes += len(batch)
+
+    async def _flush_one(self, work, future):
+        try:
+            async with self.session_factory() as session:
+                result = await work(session)
+                await session.commit()
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)